@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Minimal stand-in for the Client-Server API used by the bridge.
+
+It accepts every request the bridge makes, keeps just enough state to answer
+``/joined_members``, and reports every message the puppets send through ``on_message``.
+"""
+
+import asyncio
+import logging
+import time
+
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Optional, Set
+
+from aiohttp import web
+
+MessageCallback = Callable[[str, str, Dict, float], None]
+
+
+class FakeHomeserver(object):
+    def __init__(self, domain: str, bot_mxid: str, latency: float = 0,
+                 on_message: Optional[MessageCallback] = None) -> None:
+        self.log = logging.getLogger("bench.homeserver")
+        self.domain = domain
+        self.bot_mxid = bot_mxid
+        self.latency = latency
+        self.on_message = on_message
+
+        self.requests = Counter()
+        self.members: Dict[str, Set[str]] = defaultdict(set)
+        self._event_counter = 0
+
+        self.app = web.Application()
+        self.app.router.add_route("*", "/_matrix/{tail:.*}", self._handle)
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str, port: int) -> None:
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+
+    def _user(self, request: web.Request) -> str:
+        return request.query.get("user_id", self.bot_mxid)
+
+    async def _json(self, request: web.Request) -> Dict:
+        if not request.can_read_body:
+            return {}
+        try:
+            return await request.json()
+        except ValueError:
+            return {}
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        parts = request.match_info["tail"].split("/")
+        # client/r0/<endpoint>/...
+        path = parts[2:] if len(parts) > 2 and parts[0] == "client" else parts
+        endpoint = path[0] if path else ""
+        user = self._user(request)
+
+        if endpoint == "rooms" and len(path) >= 3:
+            room_id, action = path[1], path[2]
+            self.requests[action] += 1
+
+            if action == "send":
+                content = await self._json(request)
+                self._event_counter += 1
+                if self.on_message:
+                    self.on_message(room_id, user, content, time.monotonic())
+                return web.json_response({"event_id": f"$bench{self._event_counter}"})
+            elif action == "join":
+                self.members[room_id].add(user)
+                return web.json_response({"room_id": room_id})
+            elif action == "leave":
+                self.members[room_id].discard(user)
+                return web.json_response({})
+            elif action == "joined_members":
+                joined = {member: {"display_name": member[1:].split(":")[0], "avatar_url": None}
+                          for member in self.members[room_id]}
+                return web.json_response({"joined": joined})
+            elif action == "state" and len(path) >= 4 and path[3] == "m.room.power_levels":
+                return web.json_response({"users_default": 100, "events_default": 0,
+                                          "state_default": 0, "users": {}, "events": {}})
+            return web.json_response({})
+
+        self.requests[endpoint] += 1
+
+        if endpoint == "join" and len(path) >= 2:
+            self.members[path[1]].add(user)
+            return web.json_response({"room_id": path[1]})
+        elif endpoint == "account" and path[1:2] == ["whoami"]:
+            return web.json_response({"user_id": user})
+        elif endpoint == "profile" and request.method == "GET":
+            return web.json_response({"displayname": path[1][1:].split(":")[0]})
+        elif endpoint == "register":
+            body = await self._json(request)
+            return web.json_response({"user_id": f"@{body.get('username')}:{self.domain}"})
+        elif endpoint == "joined_rooms":
+            return web.json_response({"joined_rooms": [room for room, members in self.members.items()
+                                                       if user in members]})
+        return web.json_response({})
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Minimal SpringRTS lobby server speaking the subset of the protocol the bridge uses.
+
+It greets with ``TASSERVER``, accepts any ``LOGIN``, answers ``JOIN`` with ``JOIN``/``CLIENTS``,
+and reports every command it receives through ``on_command``. The benchmark pushes
+``SAID``/``SAIDEX``/``JOINED``/``LEFT``/``CLIENTS`` lines to the bridge with :meth:`send`.
+"""
+
+import asyncio
+import logging
+import time
+
+from collections import Counter
+from typing import Callable, List, Optional
+
+CommandCallback = Callable[[str, List[str], float], None]
+
+
+class _LobbyConnection(asyncio.Protocol):
+    def __init__(self, server: 'FakeLobby') -> None:
+        self.server = server
+        self.transport: Optional[asyncio.Transport] = None
+        self.username: Optional[str] = None
+        self._buffer = b""
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.server.connections.append(self)
+        self.write("TASSERVER 0.38-33-ga5f3b28 * 8201 0")
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self in self.server.connections:
+            self.server.connections.remove(self)
+
+    def write(self, line: str) -> None:
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(line.encode("utf-8") + b"\n")
+
+    def data_received(self, data: bytes) -> None:
+        now = time.monotonic()
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for raw in lines:
+            line = raw.decode("utf-8", errors="replace").rstrip("\r")
+            if line:
+                self.handle(line, now)
+
+    def handle(self, line: str, now: float) -> None:
+        command, _, rest = line.partition(" ")
+        self.server.commands[command] += 1
+
+        if command == "LOGIN":
+            self.username = rest.split(" ", 1)[0]
+            self.write(f"ACCEPTED {self.username}")
+            self.write("MOTD bench")
+            self.write("LOGININFOEND")
+        elif command == "JOIN":
+            channel = rest.split(" ", 1)[0].lstrip("#")
+            self.write(f"JOIN {channel}")
+            self.write(f"CLIENTS {channel} {self.username}")
+        elif command == "PING":
+            self.write("PONG")
+
+        if self.server.on_command:
+            self.server.on_command(command, rest.split(" "), now)
+
+
+class FakeLobby(object):
+    def __init__(self, on_command: Optional[CommandCallback] = None) -> None:
+        self.log = logging.getLogger("bench.lobby")
+        self.on_command = on_command
+        self.commands = Counter()
+        self.connections: List[_LobbyConnection] = list()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str, port: int) -> None:
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(lambda: _LobbyConnection(self), host, port)
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    @property
+    def logged_in(self) -> bool:
+        return any(conn.username for conn in self.connections)
+
+    def send(self, line: str) -> None:
+        for conn in self.connections:
+            if conn.username:
+                conn.write(line)
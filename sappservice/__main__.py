@@ -24,10 +24,13 @@ import asyncio
 import sys
 
 from sappservice.sappservice import sappservice
+from sappservice.sharding import ShardFront, sharded
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--config')
+# set by the front process of a sharded bridge
+parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
 args = parser.parse_args()
 
 config_filename = args.config
@@ -39,6 +42,9 @@ Ussage: sappservice -c config.yaml
     sys.exit(1)
 
 loop = asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
-loop.run_until_complete(sappservice(config_filename=config_filename, loop=loop))
+if args.worker is None and sharded(config_filename):
+    loop.run_until_complete(ShardFront(config_filename, loop).start())
+else:
+    loop.run_until_complete(sappservice(config_filename=config_filename, loop=loop, worker=args.worker))
 loop.run_forever()
 
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ssl
+
+from typing import List, Optional
+
+import aiohttp
+
+from aiohttp import TraceConfig, web
+from mautrix.appservice import AppService
+from mautrix.appservice.api import AppServiceAPI
+
+
+class TracedAppService(AppService):
+    """
+    An :class:`AppService` whose homeserver session is created with ``trace_configs``.
+
+    mautrix creates the session in :meth:`AppService.start` and takes no trace configs, so this
+    is the same start with them passed to ``aiohttp.ClientSession``. Append to ``trace_configs``
+    before starting.
+    """
+
+    trace_configs: List[TraceConfig]
+
+    def __init__(self, *args, trace_configs: Optional[List[TraceConfig]] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.trace_configs = list(trace_configs or ())
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        await self.state_store.open()
+        connector = None
+        self.log.debug(f"Starting appservice web server on {host}:{port}")
+        if self.server.startswith("https://") and not self.verify_ssl:
+            connector = aiohttp.TCPConnector(verify_ssl=False)
+        self._http_session = aiohttp.ClientSession(loop=self.loop, connector=connector,
+                                                   trace_configs=self.trace_configs)
+        self._intent = AppServiceAPI(base_url=self.server, bot_mxid=self.bot_mxid, log=self.log,
+                                     token=self.as_token, state_store=self.state_store,
+                                     real_user_content_key=self.real_user_content_key,
+                                     client_session=self._http_session).bot_intent()
+        ssl_ctx = None
+        if self.tls_cert and self.tls_key:
+            ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_ctx.load_cert_chain(self.tls_cert, self.tls_key)
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port, ssl_context=ssl_ctx)
+        await site.start()
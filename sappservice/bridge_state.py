@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Bridge bookkeeping persisted next to the Matrix state cache.
+
+Rooms whose member list has been fetched once are recorded so later syncs can read their members
+from the state cache instead of the homeserver. Recently handled event IDs are kept here too when
+:class:`~sappservice.dedupe.Deduplicator` persistence is enabled, and so is chat waiting for a
+lobby connection when :class:`~sappservice.outbox.LobbyOutbox` persistence is.
+"""
+
+import logging
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from asyncpg import Connection
+from mautrix.types import EventID, RoomID
+from mautrix.util.async_db import Database, UpgradeTable
+
+from sappservice.outbox import OutboxEntry
+
+upgrade_table = UpgradeTable(version_table_name="sappservice_version", database_name="bridge state",
+                             log=logging.getLogger("bridge_state.upgrade"))
+
+
+@upgrade_table.register(description="Initial revision")
+async def upgrade_v1(conn: Connection) -> None:
+    # rooms whose full member list has been loaded into the state cache at least once
+    await conn.execute("""CREATE TABLE bridged_room (
+        room_id TEXT PRIMARY KEY
+    )""")
+    await conn.execute("""CREATE TABLE handled_event (
+        event_id TEXT PRIMARY KEY,
+        seen_at  DOUBLE PRECISION NOT NULL
+    )""")
+    await conn.execute("CREATE INDEX handled_event_seen_at_idx ON handled_event (seen_at)")
+    await conn.execute("""CREATE TABLE media_link (
+        short_id TEXT PRIMARY KEY,
+        mxc      TEXT NOT NULL
+    )""")
+    await conn.execute("""CREATE TABLE lobby_outbox (
+        id         BIGSERIAL PRIMARY KEY,
+        connection TEXT NOT NULL,
+        channel    TEXT NOT NULL,
+        domain     TEXT NOT NULL,
+        username   TEXT NOT NULL,
+        body       TEXT NOT NULL,
+        queued_at  DOUBLE PRECISION NOT NULL
+    )""")
+
+
+class BridgeStateStore(object):
+    log: logging.Logger
+    db: Database
+
+    def __init__(self, db: Database) -> None:
+        self.log = logging.getLogger("bridge_state")
+        self.db = db
+
+    async def synced_rooms(self, room_ids: Iterable[RoomID]) -> Set[RoomID]:
+        rows = await self.db.fetch("SELECT room_id FROM bridged_room WHERE room_id = ANY($1::text[])",
+                                   list(room_ids))
+        return {row["room_id"] for row in rows}
+
+    async def mark_synced(self, room_ids: Iterable[RoomID]) -> None:
+        async with self.db.acquire() as conn:
+            await conn.executemany("INSERT INTO bridged_room (room_id) VALUES ($1) ON CONFLICT DO NOTHING",
+                                   [(room_id,) for room_id in room_ids])
+
+    async def joined_members(self, room_ids: Iterable[RoomID]) -> Dict[RoomID, Dict[str, Optional[str]]]:
+        """
+        Joined users and their display names per room, read from the Matrix state cache that the
+        appservice keeps current from ``m.room.member`` events.
+        """
+        rows = await self.db.fetch("SELECT room_id, user_id, displayname FROM mx_user_profile "
+                                   "WHERE room_id = ANY($1::text[]) AND membership='join'", list(room_ids))
+        members: Dict[RoomID, Dict[str, Optional[str]]] = dict()
+        for row in rows:
+            members.setdefault(row["room_id"], dict())[row["user_id"]] = row["displayname"]
+        return members
+
+    async def seen_events(self, since: float) -> List[Tuple[EventID, float]]:
+        rows = await self.db.fetch("SELECT event_id, seen_at FROM handled_event WHERE seen_at >= $1", since)
+        return [(row["event_id"], row["seen_at"]) for row in rows]
+
+    async def save_seen_events(self, events: List[Tuple[EventID, float]]) -> None:
+        async with self.db.acquire() as conn:
+            await conn.executemany("INSERT INTO handled_event (event_id, seen_at) VALUES ($1, $2) "
+                                   "ON CONFLICT (event_id) DO NOTHING", events)
+
+    async def prune_seen_events(self, before: float) -> None:
+        await self.db.execute("DELETE FROM handled_event WHERE seen_at < $1", before)
+
+    async def media_link(self, short_id: str) -> Optional[str]:
+        return await self.db.fetchval("SELECT mxc FROM media_link WHERE short_id=$1", short_id)
+
+    async def save_media_link(self, short_id: str, mxc: str) -> None:
+        await self.db.execute("INSERT INTO media_link (short_id, mxc) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                              short_id, mxc)
+
+    async def outbox(self, connections: List[str]) -> List[OutboxEntry]:
+        rows = await self.db.fetch("SELECT connection, channel, domain, username, body, queued_at "
+                                   "FROM lobby_outbox WHERE connection = ANY($1) ORDER BY id", connections)
+        return [OutboxEntry(row["connection"], row["channel"], row["domain"], row["username"], row["body"],
+                            row["queued_at"]) for row in rows]
+
+    async def save_outbox(self, entries: List[OutboxEntry]) -> None:
+        async with self.db.acquire() as conn:
+            await conn.executemany("INSERT INTO lobby_outbox (connection, channel, domain, username, body, queued_at) "
+                                   "VALUES ($1, $2, $3, $4, $5, $6)", entries)
+
+    async def clear_outbox(self, connection: str) -> None:
+        await self.db.execute("DELETE FROM lobby_outbox WHERE connection=$1", connection)
+
+    async def prune_outbox(self, before: float) -> None:
+        await self.db.execute("DELETE FROM lobby_outbox WHERE queued_at < $1", before)
@@ -15,17 +15,124 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-from typing import Optional, Dict, List, Any
+from types import MappingProxyType
+from typing import Optional, Dict, List, Any, Mapping, NamedTuple, Tuple
 
 from mautrix.bridge.config import (BaseBridgeConfig, ConfigUpdateHelper)
+from mautrix.util.config import ConfigValueError
 
 from ruamel.yaml import YAML
 
+from sappservice.rooms import DEFAULT_CONNECTION, to_bool
+
 yaml = YAML()
 yaml.indent(4)
 yaml.width = 200
 
 
+class HomeserverSettings(NamedTuple):
+    address: str
+    domain: str
+    verify_ssl: bool
+
+
+class AppserviceSettings(NamedTuple):
+    address: Optional[str]
+    hostname: str
+    port: int
+    max_body_size: int
+    database: str
+
+    as_token: str
+    hs_token: str
+
+    bot_username: str
+    bot_displayname: Optional[str]
+    bot_avatar: Optional[str]
+    namespace: str
+
+    # derived
+    bot_mxid: str
+    puppet_prefix: str
+    puppet_suffix: str
+
+
+class LobbyConnectionSettings(NamedTuple):
+    name: str
+    address: str
+    port: int
+    ssl: bool
+    bot_username: str
+    bot_password: str
+    client_name: str
+    client_flags: str
+
+
+class SpringSettings(NamedTuple):
+    address: str
+    port: int
+    ssl: bool
+    bot_username: str
+    bot_password: str
+    client_name: str
+    client_flags: str
+    connect_timeout: float
+    reconnect_delay: float
+    reconnect_max_delay: float
+    # the top level settings as the default connection first, then ``spring.connections``
+    connections: Tuple[LobbyConnectionSettings, ...]
+
+
+class BridgeSettings(NamedTuple):
+    rooms: Mapping[str, Mapping[str, Any]]
+    sync_concurrency: int
+    profile_cache_size: int
+    profile_cache_ttl: float
+    identity_rules: Optional[Tuple[Tuple[str, str], ...]]
+    ignored_users: Optional[Tuple[str, ...]]
+    outbound_max_depth: int
+    outbound_merge_window: float
+    receipt_interval: float
+    debug_sample_rate: float
+    homeserver_concurrency: Mapping[str, int]
+    homeserver_max_retries: int
+    lobby_rate: float
+    lobby_burst: float
+    dedupe_max_transactions: int
+    dedupe_max_events: int
+    dedupe_ttl: float
+    dedupe_persist: bool
+    outbox_max_size: int
+    outbox_max_age: float
+    outbox_persist: bool
+    presence_enabled: bool
+    presence_interval: float
+    presence_slots: int
+    presence_flap_window: float
+    media_public_url: Optional[str]
+    media_cache_dir: str
+    media_max_size: int
+    media_thumbnails: bool
+    media_thumbnail_size: int
+    sharding_workers: int
+    sharding_base_port: int
+    # lobby connection -> worker index
+    sharding_assignment: Mapping[str, int]
+
+
+class Settings(NamedTuple):
+    """
+    Immutable, typed view of the config with the environment overrides applied.
+
+    Built once at startup by :meth:`Config.snapshot` so event handlers never go through
+    :meth:`Config.__getitem__`.
+    """
+    homeserver: HomeserverSettings
+    appservice: AppserviceSettings
+    spring: SpringSettings
+    bridge: BridgeSettings
+
+
 class Config(BaseBridgeConfig):
     def __getitem__(self, key: str) -> Any:
         try:
@@ -57,6 +164,7 @@ class Config(BaseBridgeConfig):
         copy("appservice.database")
 
         copy("appservice.id")
+        copy("appservice.namespace")
 
         copy("appservice.bot_username")
         copy("appservice.bot_displayname")
@@ -80,14 +188,225 @@ class Config(BaseBridgeConfig):
         copy("spring.client_name")
         copy("spring.client_flags")
         copy("spring.comunity_id")
+        copy("spring.connect_timeout")
+        copy("spring.reconnect.initial_delay")
+        copy("spring.reconnect.max_delay")
+        copy("spring.connections")
 
         copy("bridge.command_prefix")
         copy("bridge.username_template")
         copy("bridge.alias_template")
         copy("bridge.rooms")
+        copy("bridge.sync_concurrency")
+        copy("bridge.profile_cache.max_size")
+        copy("bridge.profile_cache.ttl")
+        copy("bridge.identity_rules")
+        copy("bridge.ignored_users")
+        copy("bridge.outbound.max_depth")
+        copy("bridge.outbound.merge_window")
+        copy("bridge.receipt_interval")
+        copy("bridge.debug_sample_rate")
+        copy("bridge.homeserver.concurrency")
+        copy("bridge.homeserver.max_retries")
+        copy("bridge.lobby_rate.commands_per_second")
+        copy("bridge.lobby_rate.burst")
+        copy("bridge.dedupe.max_transactions")
+        copy("bridge.dedupe.max_events")
+        copy("bridge.dedupe.ttl")
+        copy("bridge.dedupe.persist")
+        copy("bridge.outbox.max_size")
+        copy("bridge.outbox.max_age")
+        copy("bridge.outbox.persist")
+        copy("bridge.presence.enabled")
+        copy("bridge.presence.refresh_interval")
+        copy("bridge.presence.slots")
+        copy("bridge.presence.flap_window")
+        copy("bridge.media.public_url")
+        copy("bridge.media.cache_dir")
+        copy("bridge.media.max_size")
+        copy("bridge.media.thumbnails")
+        copy("bridge.media.thumbnail_size")
+        copy("bridge.sharding.workers")
+        copy("bridge.sharding.base_port")
+        copy("bridge.sharding.assignment")
 
         copy("logging")
 
+    def _required(self, key: str) -> Any:
+        value = self[key]
+        if value is None or value == "":
+            raise ConfigValueError(key, "")
+        return value
+
+    def _number(self, key: str, default: Any, cast: type = int) -> Any:
+        value = self[key]
+        if value is None or value == "":
+            return default
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            raise ConfigValueError(key, f"Expected a number, got {value!r}")
+
+    def _mapping(self, key: str, what: str) -> Mapping:
+        # environment overrides are plain strings, so nested settings are checked before use
+        value = self[key] or {}
+        if not isinstance(value, Mapping):
+            raise ConfigValueError(key, f"Expected a mapping of {what}, got {value!r}")
+        return value
+
+    def _list(self, key: str, what: str) -> List[Any]:
+        value = self[key] or []
+        if not isinstance(value, (list, tuple)):
+            raise ConfigValueError(key, f"Expected a list of {what}, got {value!r}")
+        return list(value)
+
+    def _connections(self) -> Tuple[LobbyConnectionSettings, ...]:
+        default = LobbyConnectionSettings(
+            name=DEFAULT_CONNECTION,
+            address=self._required("spring.address"),
+            port=self._number("spring.port", 8200),
+            ssl=to_bool(self["spring.ssl"]),
+            bot_username=self._required("spring.bot_username"),
+            bot_password=self._required("spring.bot_password"),
+            client_name=self["spring.client_name"] or "",
+            client_flags=self["spring.client_flags"] or "",
+        )
+
+        extra = self._mapping("spring.connections", "connection name to lobby server")
+
+        connections = [default]
+        for name, values in extra.items():
+            key = f"spring.connections.{name}"
+            if str(name) == DEFAULT_CONNECTION:
+                raise ConfigValueError(key, f"{DEFAULT_CONNECTION!r} is the top level spring connection")
+            values = dict(values or {})
+            try:
+                connections.append(default._replace(
+                    name=str(name),
+                    **{field: values[field] for field in ("address", "bot_username", "bot_password",
+                                                          "client_name", "client_flags") if values.get(field)},
+                    **({"port": int(values["port"])} if values.get("port") else {}),
+                    **({"ssl": to_bool(values["ssl"])} if "ssl" in values else {}),
+                ))
+            except (TypeError, ValueError):
+                raise ConfigValueError(f"{key}.port", f"Expected a number, got {values['port']!r}")
+        return tuple(connections)
+
+    def snapshot(self) -> Settings:
+        """
+        Resolve and validate every setting the bridge uses.
+        """
+        domain = self._required("homeserver.domain")
+        namespace = self._required("appservice.namespace")
+        bot_username = self._required("appservice.bot_username")
+
+        rooms = self._mapping("bridge.rooms", "lobby channel to room")
+        rooms = MappingProxyType({str(channel): MappingProxyType(dict(room_data))
+                                  for channel, room_data in rooms.items()})
+
+        connections = self._connections()
+        names = {connection.name for connection in connections}
+        for channel, room_data in rooms.items():
+            if room_data.get("connection") and str(room_data["connection"]) not in names:
+                raise ConfigValueError(f"bridge.rooms.{channel}.connection",
+                                       f"Unknown lobby connection {room_data['connection']!r}")
+
+        workers = self._number("bridge.sharding.workers", 0)
+        # a lobby connection is a single login, so its channels can only be served by one worker
+        if workers > len(names):
+            raise ConfigValueError("bridge.sharding.workers",
+                                   f"Expected at most one worker per lobby connection ({len(names)}), got {workers}")
+        assignment = self._mapping("bridge.sharding.assignment", "connection to worker")
+        for name, worker in assignment.items():
+            if str(name) not in names:
+                raise ConfigValueError(f"bridge.sharding.assignment.{name}", f"Unknown lobby connection {name!r}")
+            if not isinstance(worker, int) or not 0 <= worker < max(1, workers):
+                raise ConfigValueError(f"bridge.sharding.assignment.{name}",
+                                       f"Expected a worker index below {max(1, workers)}, got {worker!r}")
+
+        identity_rules = self._mapping("bridge.identity_rules", "localpart prefix to lobby domain")
+        ignored_users = self._list("bridge.ignored_users", "Matrix localparts")
+
+        concurrency = self._mapping("bridge.homeserver.concurrency", "endpoint class to request limit")
+        try:
+            concurrency = {str(endpoint): int(limit) for endpoint, limit in concurrency.items()}
+        except (TypeError, ValueError):
+            raise ConfigValueError("bridge.homeserver.concurrency", f"Expected a number per endpoint class, got {concurrency!r}")
+
+        return Settings(
+            homeserver=HomeserverSettings(
+                address=self._required("homeserver.address"),
+                domain=domain,
+                verify_ssl=to_bool(self["homeserver.verify_ssl"]),
+            ),
+            appservice=AppserviceSettings(
+                address=self["appservice.address"],
+                hostname=self["appservice.hostname"] or "127.0.0.1",
+                port=self._number("appservice.port", 8080),
+                max_body_size=self._number("appservice.max_body_size", 1),
+                database=self._required("appservice.database"),
+                as_token=self._required("appservice.as_token"),
+                hs_token=self._required("appservice.hs_token"),
+                bot_username=bot_username,
+                bot_displayname=self["appservice.bot_displayname"],
+                bot_avatar=self["appservice.bot_avatar"],
+                namespace=namespace,
+                bot_mxid=f"@{bot_username}:{domain}",
+                puppet_prefix=f"@{namespace}_",
+                puppet_suffix=f":{domain}",
+            ),
+            spring=SpringSettings(
+                address=connections[0].address,
+                port=connections[0].port,
+                ssl=connections[0].ssl,
+                bot_username=connections[0].bot_username,
+                bot_password=connections[0].bot_password,
+                client_name=connections[0].client_name,
+                client_flags=connections[0].client_flags,
+                connect_timeout=self._number("spring.connect_timeout", 10, float),
+                reconnect_delay=self._number("spring.reconnect.initial_delay", 0.5, float),
+                reconnect_max_delay=self._number("spring.reconnect.max_delay", 60, float),
+                connections=connections,
+            ),
+            bridge=BridgeSettings(
+                rooms=rooms,
+                sync_concurrency=self._number("bridge.sync_concurrency", 8),
+                profile_cache_size=self._number("bridge.profile_cache.max_size", 10000),
+                profile_cache_ttl=self._number("bridge.profile_cache.ttl", 3600, float),
+                identity_rules=(tuple((str(prefix), str(domain)) for prefix, domain in identity_rules.items())
+                                if identity_rules else None),
+                ignored_users=tuple(ignored_users) if ignored_users else None,
+                outbound_max_depth=self._number("bridge.outbound.max_depth", 100),
+                outbound_merge_window=self._number("bridge.outbound.merge_window", 0, float),
+                receipt_interval=self._number("bridge.receipt_interval", 2, float),
+                debug_sample_rate=self._number("bridge.debug_sample_rate", 1, float),
+                homeserver_concurrency=MappingProxyType(concurrency),
+                homeserver_max_retries=self._number("bridge.homeserver.max_retries", 5),
+                lobby_rate=self._number("bridge.lobby_rate.commands_per_second", 20, float),
+                lobby_burst=self._number("bridge.lobby_rate.burst", 40, float),
+                dedupe_max_transactions=self._number("bridge.dedupe.max_transactions", 1000),
+                dedupe_max_events=self._number("bridge.dedupe.max_events", 10000),
+                dedupe_ttl=self._number("bridge.dedupe.ttl", 3600, float),
+                dedupe_persist=to_bool(self["bridge.dedupe.persist"]),
+                outbox_max_size=self._number("bridge.outbox.max_size", 1000),
+                outbox_max_age=self._number("bridge.outbox.max_age", 300, float),
+                outbox_persist=to_bool(self["bridge.outbox.persist"]),
+                presence_enabled=(self["bridge.presence.enabled"] is None
+                                  or to_bool(self["bridge.presence.enabled"])),
+                presence_interval=self._number("bridge.presence.refresh_interval", 30, float),
+                presence_slots=self._number("bridge.presence.slots", 30),
+                presence_flap_window=self._number("bridge.presence.flap_window", 2, float),
+                media_public_url=self["bridge.media.public_url"] or None,
+                media_cache_dir=self["bridge.media.cache_dir"] or "media_cache",
+                media_max_size=self._number("bridge.media.max_size", 512) * 1024 ** 2,
+                media_thumbnails=to_bool(self["bridge.media.thumbnails"]),
+                media_thumbnail_size=self._number("bridge.media.thumbnail_size", 320),
+                sharding_workers=workers,
+                sharding_base_port=self._number("bridge.sharding.base_port", 29400),
+                sharding_assignment=MappingProxyType({str(name): worker for name, worker in assignment.items()}),
+            ),
+        )
+
     @property
     def namespaces(self) -> Dict[str, List[Dict[str, Any]]]:
         homeserver = self["homeserver.domain"]
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from aiohttp import web
+from mautrix.types import EventID
+
+from sappservice.metrics import DUPLICATES
+
+
+class RecentIds(object):
+    """
+    Bounded set of recently seen IDs. The least recently added ID is evicted past ``max_size``
+    and every ID expires ``ttl`` seconds after it was added.
+
+    Supports ``in`` and :meth:`add`, so it can stand in for the unbounded ``AppService.transactions``.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600) -> None:
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, float]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        expires = self._entries.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._entries[key]
+            return False
+        return True
+
+    def add(self, key: str, age: float = 0) -> None:
+        self._entries[key] = time.monotonic() + self.ttl - age
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def seen(self, key: str) -> bool:
+        """
+        Whether ``key`` was seen before; remembers it if not.
+        """
+        if key in self:
+            return True
+        self.add(key)
+        return False
+
+
+class Deduplicator(object):
+    """
+    Drops homeserver transaction retries and redelivered events before the bridge does any work.
+
+    Transactions are checked by an aiohttp middleware from the URL alone, before the body is read.
+    A transaction ID counts as seen once a delivery of it was answered with a 2xx; a retry of a
+    transaction that is still being delivered waits for that first delivery and is only handled
+    again if it failed.
+
+    mautrix answers a transaction as soon as it has started a task per event, before any handler
+    ran, so the transaction ID says nothing about whether its events were bridged. Events are
+    therefore checked on their own at the top of ``Matrix.handle_event``: an event ID counts as
+    seen once its handler completed, a redelivery while it is still running is dropped, and one
+    after the handler failed is handled again.
+
+    With a ``store``, new event IDs are written in batches every ``interval`` seconds and reloaded
+    on start, so redeliveries are also caught across restarts.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, max_transactions: int = 1000, max_events: int = 10000, ttl: float = 3600,
+                 store=None, interval: float = 5, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("dedupe")
+        self.transactions = RecentIds(max_transactions, ttl)
+        self.events = RecentIds(max_events, ttl)
+        self.store = store
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.hs_token: Optional[str] = None
+        self._pending: List[Tuple[EventID, float]] = list()
+        self._handling: Set[EventID] = set()
+        # transaction ID -> whether its delivery in progress succeeded
+        self._inflight: Dict[str, asyncio.Future] = dict()
+        self._task: Optional[asyncio.Task] = None
+
+    def duplicate_event(self, event_id: Optional[EventID]) -> bool:
+        """
+        Whether ``event_id`` was handled before or is being handled now. If not, it is being
+        handled from now on and the caller must report the outcome to :meth:`event_handled`.
+        """
+        if not event_id:
+            return False
+        if event_id in self.events or event_id in self._handling:
+            DUPLICATES.inc("event")
+            return True
+        self._handling.add(event_id)
+        return False
+
+    def event_handled(self, event_id: Optional[EventID], succeeded: bool) -> None:
+        if not event_id:
+            return
+        self._handling.discard(event_id)
+        if not succeeded:
+            return
+        self.events.add(event_id)
+        if self.store is not None:
+            self._pending.append((event_id, time.time()))
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        if request.method == "PUT":
+            txn_id = request.match_info.get("transaction_id")
+            if txn_id and self._authorized(request):
+                if txn_id in self.transactions:
+                    DUPLICATES.inc("transaction")
+                    return web.json_response({})
+                first = self._inflight.get(txn_id)
+                if first is not None and await asyncio.shield(first):
+                    DUPLICATES.inc("transaction")
+                    return web.json_response({})
+                return await self._handle(request, handler, txn_id)
+        return await handler(request)
+
+    async def _handle(self, request: web.Request, handler, txn_id: str) -> web.StreamResponse:
+        done = self._inflight[txn_id] = self.loop.create_future()
+        succeeded = False
+        try:
+            response = await handler(request)
+            succeeded = 200 <= response.status < 300
+            return response
+        finally:
+            if succeeded:
+                self.transactions.add(txn_id)
+            if self._inflight.get(txn_id) is done:
+                del self._inflight[txn_id]
+            done.set_result(succeeded)
+
+    def _authorized(self, request: web.Request) -> bool:
+        token = request.query.get("access_token")
+        if token is None:
+            token = request.headers.get("Authorization", "")[len("Bearer "):]
+        return token == self.hs_token
+
+    def install(self, appserv) -> None:
+        """
+        Bound the appservice's own transaction set and check transactions ahead of it.
+        """
+        self.hs_token = appserv.hs_token
+        # mautrix adds IDs after handling; it gets its own set so the middleware's early marking
+        # does not make it skip the first delivery
+        appserv.transactions = RecentIds(self.transactions.max_size, self.transactions.ttl)
+        appserv.app.middlewares.append(self.middleware)
+
+    async def start(self) -> None:
+        if self.store is None:
+            return
+
+        now = time.time()
+        seen: Iterable[Tuple[EventID, float]] = await self.store.seen_events(now - self.events.ttl)
+        for event_id, seen_at in seen:
+            self.events.add(event_id, age=now - seen_at)
+        self.log.info(f"Loaded {len(self.events)} recently handled event IDs")
+
+        await self.store.prune_seen_events(now - self.events.ttl)
+        self._task = self.loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, list()
+        try:
+            await self.store.save_seen_events(pending)
+            await self.store.prune_seen_events(time.time() - self.events.ttl)
+        except Exception:
+            self.log.exception(f"Failed to persist {len(pending)} event IDs")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.store is not None:
+            await self.flush()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from aiohttp import ClientError, ClientSession, TraceConfig
+from mautrix.errors import IntentError, MatrixConnectionError, MLimitExceeded
+
+from sappservice.metrics import HOMESERVER_RATE_LIMITED, HOMESERVER_RETRIES
+from sappservice.util.backoff import Backoff
+
+T = TypeVar("T")
+
+DEFAULT_CONCURRENCY = {"send": 10, "join": 5, "leave": 5, "profile": 5, "receipt": 2, "presence": 5, "other": 10}
+
+# mautrix wraps most connection failures in MatrixConnectionError, but not all of them
+RETRYABLE = (MLimitExceeded, MatrixConnectionError, ClientError, asyncio.TimeoutError)
+
+
+def _cause(error: BaseException) -> BaseException:
+    """
+    The underlying request error of an ``IntentError``, which mautrix raises for failures inside
+    ``ensure_registered``/``ensure_joined``.
+    """
+    while isinstance(error, IntentError):
+        nested = error.__cause__ or next((arg for arg in error.args if isinstance(arg, BaseException)), None)
+        if nested is None:
+            break
+        error = nested
+    return error
+
+
+class HomeserverScheduler(object):
+    """
+    Shared gate for the homeserver requests made by puppets and the bridge bot.
+
+    Each request runs under the concurrency cap of its endpoint class (send, join, profile, ...).
+    When the homeserver answers ``M_LIMIT_EXCEEDED``, the ``retry_after_ms`` it asks for is read
+    by an aiohttp trace hook and the limited user waits that long before any further request; a
+    limit on the bridge bot pauses everyone. Rate limited requests are retried, and so are
+    connection failures of idempotent ones, up to ``max_retries`` times. Under sustained limits
+    throughput drops to what the homeserver allows instead of messages being lost.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, bot_mxid: str, concurrency: Optional[Dict[str, int]] = None, max_retries: int = 5,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("homeserver.scheduler")
+        self.bot_mxid = bot_mxid
+        self.max_retries = max_retries
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.limits = dict(DEFAULT_CONCURRENCY)
+        self.limits.update(concurrency or {})
+        self._semaphores = {endpoint: asyncio.Semaphore(max(1, limit)) for endpoint, limit in self.limits.items()}
+
+        self.waiting = 0
+        self._global_until = 0.0
+        self._user_until: Dict[str, float] = dict()
+
+    def limit(self, endpoint: str) -> int:
+        return max(1, self.limits.get(endpoint, self.limits["other"]))
+
+    def limited(self, user_id: Optional[str], retry_after: float) -> None:
+        """
+        Record that the homeserver asked ``user_id`` to wait ``retry_after`` seconds.
+        """
+        until = time.monotonic() + retry_after
+        if not user_id or user_id == self.bot_mxid:
+            self._global_until = max(self._global_until, until)
+        else:
+            self._user_until[user_id] = max(self._user_until.get(user_id, 0), until)
+
+    def _delay(self, user_id: Optional[str]) -> float:
+        now = time.monotonic()
+        until = self._global_until
+        if user_id:
+            user_until = self._user_until.get(user_id)
+            if user_until is not None:
+                if user_until <= now:
+                    del self._user_until[user_id]
+                else:
+                    until = max(until, user_until)
+        return until - now
+
+    async def run(self, endpoint: str, user_id: Optional[str], request: Callable[[], Awaitable[T]],
+                  idempotent: bool = True) -> T:
+        """
+        Run ``request()`` under the limits for ``endpoint`` and ``user_id``, retrying as needed.
+        ``request`` is called again for every attempt.
+        """
+        semaphore = self._semaphores.get(endpoint) or self._semaphores["other"]
+        backoff = None
+        attempt = 0
+
+        while True:
+            delay = self._delay(user_id)
+            if delay > 0:
+                self.waiting += 1
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self.waiting -= 1
+
+            retry_delay = 0
+            async with semaphore:
+                try:
+                    return await request()
+                except (IntentError,) + RETRYABLE as e:
+                    error = _cause(e)
+                    if isinstance(error, MLimitExceeded):
+                        HOMESERVER_RATE_LIMITED.inc(endpoint)
+                    elif not isinstance(error, RETRYABLE) or not idempotent:
+                        raise
+                    if attempt >= self.max_retries:
+                        raise
+
+                    backoff = backoff or Backoff(initial=1, maximum=30)
+                    if not isinstance(error, MLimitExceeded):
+                        retry_delay = backoff.next()
+                    elif self._delay(user_id) <= 0:
+                        # no retry_after_ms seen for this request
+                        self.limited(user_id, backoff.next())
+
+            # the endpoint slot is free for other requests while this one waits to retry
+            if retry_delay:
+                await asyncio.sleep(retry_delay)
+
+            attempt += 1
+            HOMESERVER_RETRIES.inc(endpoint)
+            self.log.debug(f"Retrying {endpoint} request for {user_id} (attempt {attempt})")
+
+    async def _on_request_end(self, _: ClientSession, ctx, params) -> None:
+        response = params.response
+        if response.status != 429:
+            return
+
+        retry_after = None
+        try:
+            # the body is cached, mautrix reads it again afterwards
+            retry_after = (await response.json()).get("retry_after_ms", 0) / 1000
+        except Exception:
+            pass
+        if not retry_after:
+            try:
+                retry_after = float(response.headers.get("Retry-After", 0))
+            except ValueError:
+                retry_after = 0
+        if retry_after:
+            self.limited(params.url.query.get("user_id"), retry_after)
+
+    def trace_config(self) -> TraceConfig:
+        """
+        Reads ``retry_after_ms`` from rate limited responses of the session it is passed to in
+        ``trace_configs``.
+        """
+        trace_config = TraceConfig()
+        trace_config.on_request_end.append(self._on_request_end)
+        return trace_config
+
+    def stats(self) -> Dict[str, int]:
+        now = time.monotonic()
+        return {
+            "waiting": self.waiting,
+            "limited_users": sum(1 for until in self._user_until.values() if until > now),
+            "globally_limited": int(self._global_until > now),
+        }
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from mautrix.appservice import AppService, IntentAPI
+from mautrix.types import UserID
+
+# Matrix localpart prefix of other bridges -> lobby domain their users are shown under
+DEFAULT_IDENTITY_RULES = (
+    ("_discord_", "discord"),
+    ("freenode_", "freenode.org"),
+    ("spring_", "springlobby"),
+)
+
+DEFAULT_IGNORED_USERS = ("_discord_bot",)
+
+# Lobby usernames and domains are limited to this many characters
+MAX_LENGTH = 15
+
+
+class LobbyIdentity(NamedTuple):
+    domain: str
+    username: str
+
+
+class IdentityMapper(object):
+    """
+    Translates Matrix users to lobby identities and lobby usernames to puppet intents.
+
+    Both directions are memoized, so after the first event from a user the hot paths are a single
+    dict lookup; past ``max_size`` the least recently used entry is dropped. Matrix users that
+    must not be bridged (the appservice bot, our own puppets and the configured ignore list) map
+    to ``None``.
+    """
+
+    log: logging.Logger
+    appserv: AppService
+
+    def __init__(self, appserv: AppService, domain: str, namespace: str, bot_username: str,
+                 rules: Optional[Iterable[Tuple[str, str]]] = None,
+                 ignored_users: Optional[Iterable[str]] = None,
+                 max_size: int = 50000) -> None:
+        self.log = logging.getLogger("identity")
+        self.appserv = appserv
+
+        self.domain = domain
+        self.namespace = namespace
+        self.bot_username = bot_username
+        self.max_size = max(1, max_size)
+
+        self.rules: Tuple[Tuple[str, str], ...] = tuple(rules or DEFAULT_IDENTITY_RULES)
+        self.ignored_users = frozenset(ignored_users or DEFAULT_IGNORED_USERS)
+
+        self._puppet_prefix = f"@{namespace}_"
+        self._puppet_suffix = f":{domain}"
+        self._bot_mxid = f"@{bot_username}:{domain}"
+
+        # One alternation with a capture group per rule; the index of the group that matched
+        # selects the lobby domain.
+        self._rule_domains = tuple(domain.replace('-', '_')[:MAX_LENGTH] for _, domain in self.rules)
+        pattern = "|".join(f"({re.escape(prefix)})" for prefix, _ in self.rules)
+        self._rule_re = re.compile(f"^(?:{pattern})") if pattern else None
+
+        self._identities: 'OrderedDict[UserID, Optional[LobbyIdentity]]' = OrderedDict()
+        self._puppets: 'OrderedDict[str, IntentAPI]' = OrderedDict()
+
+    @classmethod
+    def from_settings(cls, appserv: AppService, settings) -> 'IdentityMapper':
+        return cls(appserv,
+                   domain=settings.homeserver.domain,
+                   namespace=settings.appservice.namespace,
+                   bot_username=settings.appservice.bot_username,
+                   rules=settings.bridge.identity_rules,
+                   ignored_users=settings.bridge.ignored_users)
+
+    def _map(self, user_id: UserID) -> Optional[LobbyIdentity]:
+        if user_id.startswith(self._puppet_prefix) and user_id.endswith(self._puppet_suffix):
+            return None
+
+        localpart, domain = self.appserv.intent.parse_user_id(user_id)
+
+        if localpart in self.ignored_users:
+            return None
+        elif localpart == self.bot_username and domain == self.domain:
+            return None
+
+        match = self._rule_re.match(localpart) if self._rule_re else None
+        if match:
+            localpart = localpart[match.end():]
+            domain = self._rule_domains[match.lastindex - 1]
+        else:
+            domain = domain[:MAX_LENGTH].replace('-', '_')
+
+        return LobbyIdentity(domain=domain, username=localpart[:MAX_LENGTH].lower())
+
+    def is_own(self, user_id: UserID) -> bool:
+        """
+        Whether ``user_id`` is one of our puppets or the appservice bot.
+        """
+        return user_id == self._bot_mxid or (user_id.startswith(self._puppet_prefix)
+                                            and user_id.endswith(self._puppet_suffix))
+
+    def lobby_identity(self, user_id: UserID) -> Optional[LobbyIdentity]:
+        """
+        Lobby domain and username for a Matrix user, or ``None`` if it is not bridged.
+        """
+        try:
+            identity = self._identities[user_id]
+            self._identities.move_to_end(user_id)
+            return identity
+        except KeyError:
+            pass
+
+        identity = self._identities[user_id] = self._map(user_id)
+        while len(self._identities) > self.max_size:
+            self._identities.popitem(last=False)
+        return identity
+
+    def puppet(self, username: str) -> IntentAPI:
+        """
+        Intent of the Matrix puppet that represents a lobby user.
+        """
+        try:
+            intent = self._puppets[username]
+            self._puppets.move_to_end(username)
+            return intent
+        except KeyError:
+            pass
+
+        intent = self._puppets[username] = self.appserv.intent.user(self.puppet_id(username))
+        while len(self._puppets) > self.max_size:
+            self._puppets.popitem(last=False)
+        return intent
+
+    def puppet_id(self, username: str) -> UserID:
+        """
+        Matrix ID of the puppet that represents a lobby user, without creating its intent.
+        """
+        return UserID(f"{self._puppet_prefix}{username.lower()}{self._puppet_suffix}")
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from typing import Callable, Dict, Optional
+
+from asyncblink import signal as asignal
+
+from asyncspring.lobby import LobbyProtocol, LobbyProtocolWrapper, connections
+
+from sappservice.config import LobbyConnectionSettings, Settings
+from sappservice.lobby_scheduler import BULK, CHAT, MEMBERSHIP, LobbyCommandScheduler
+from sappservice.lobby_writer import CoalescingTransport
+from sappservice.metrics import LOBBY_RECONNECTS
+from sappservice.rooms import RoomRegistry
+from sappservice.util.backoff import Backoff
+
+
+class LobbyConnection(object):
+    """
+    One logged in bot account on one lobby server.
+
+    Every connection has its own backoff and reconnect task, and its own command scheduler so
+    each stays under the flood limit of its own server. Rooms name the connection their channel
+    is bridged through with ``connection``; the rest belong to the default one.
+    """
+
+    log: logging.Logger
+    settings: LobbyConnectionSettings
+    rooms: RoomRegistry
+
+    def __init__(self, settings: LobbyConnectionSettings, global_settings: Settings, rooms: RoomRegistry,
+                 loop: asyncio.AbstractEventLoop) -> None:
+        self.log = logging.getLogger(f"lobby.{settings.name}")
+        self.settings = settings
+        self.name = settings.name
+        self.client_name = settings.client_name
+        self.rooms = rooms
+        self.loop = loop
+
+        self.bot = None
+        self.backoff = Backoff(initial=global_settings.spring.reconnect_delay,
+                               maximum=global_settings.spring.reconnect_max_delay)
+        self.connect_timeout = global_settings.spring.connect_timeout
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+        # set once the server accepted the login and held chat was handed to the scheduler
+        self.accepted = False
+        # counts lost connections, so work started in one session can tell it has ended
+        self.session = 0
+
+        self._transport: Optional[CoalescingTransport] = None
+        # lines and socket writes of the transports replaced by reconnects
+        self._lines = 0
+        self._writes = 0
+
+        self.commands = LobbyCommandScheduler(lambda: self.bot,
+                                              rate=global_settings.bridge.lobby_rate,
+                                              burst=global_settings.bridge.lobby_burst,
+                                              loop=loop)
+        # the lobby client, with every command queued at one priority
+        self.chat = self.commands.view(CHAT)
+        self.membership = self.commands.view(MEMBERSHIP)
+        self.bulk = self.commands.view(BULK)
+
+    async def start(self, on_connected: Optional[Callable[['LobbyConnection'], None]] = None) -> None:
+        """
+        Connect and queue the channels of this connection. ``on_connected`` runs before any line
+        from the server is read, so it can register event handlers on :attr:`bot`.
+        """
+        self.log.info(f"Connecting to {self.settings.address}:{self.settings.port} as {self.settings.bot_username}")
+
+        self.bot = await self.connect(server=self.settings.address,
+                                      port=self.settings.port,
+                                      use_ssl=self.settings.ssl,
+                                      name=self.client_name,
+                                      flags=self.settings.client_flags)
+        if on_connected is not None:
+            on_connected(self)
+
+        asignal("connection-lost").connect(self.connection_lost)
+
+        self.register_channels(self.bot)
+
+    def register_channels(self, client):
+        """
+        Make sure every enabled channel of this connection is queued for joining exactly once on
+        ``client``.
+
+        Safe to call on every (re)connect and every ``ACCEPTED``.
+        """
+        self.log.debug("### Channels to join ###")
+        for room in self.rooms.on_connection(self.name):
+            if not room.enabled:
+                self.log.debug(f"Not join {room.channel}")
+            elif room.channel not in client.channels_to_join:
+                self.log.debug(f"Join {room.channel}")
+                client.channels_to_join.append(room.channel)
+
+    def logged_in(self) -> None:
+        # logged in again, the next disconnect starts over with a fast retry
+        self.backoff.reset()
+        self.register_channels(self.bot)
+
+    def _create_protocol(self):
+        """
+        A protocol carrying the full login identity, used for the first connection and every
+        reconnection.
+        """
+        return LobbyProtocol(self.settings.bot_username, self.settings.bot_password, self.client_name,
+                             self.settings.client_flags)
+
+    async def _open_connection(self, server, port, use_ssl):
+        """
+        Connect, retrying with jittered exponential backoff on refused, reset, unreachable and
+        timed out connections until it succeeds.
+        """
+        while True:
+            try:
+                transport, protocol = await asyncio.wait_for(
+                    self.loop.create_connection(self._create_protocol, host=server, port=port, ssl=use_ssl),
+                    timeout=self.connect_timeout)
+                return protocol
+            except (OSError, asyncio.TimeoutError) as conn_error:
+                delay = self.backoff.next()
+                self.log.info(f"HOST DOWN! retry in {delay:.1f} secs {conn_error!r}")
+                await asyncio.sleep(delay)
+
+    def _register_protocol(self, protocol, wrapper, server, port, use_ssl, name=None, flags=None):
+        protocol.wrapper = wrapper
+        protocol.server_info = {"host": server, "port": port, "ssl": use_ssl}
+        protocol.netid = f"{id(protocol)}:{server}:{port}{'+' if use_ssl else '-'}"
+
+        if name is not None:
+            protocol.name = name
+
+        if flags is not None:
+            protocol.flags = flags
+
+        # every command written during one loop iteration leaves in a single socket write
+        transport = getattr(protocol, "transport", None)
+        if transport is not None and not isinstance(transport, CoalescingTransport):
+            if self._transport is not None:
+                self._lines += self._transport.writes
+                self._writes += self._transport.flushes
+            self._transport = protocol.transport = CoalescingTransport(transport, self.loop)
+
+        asignal("netid-available").send(protocol)
+
+        connections[protocol.netid] = wrapper
+
+    async def connect(self, server, port=8200, use_ssl=False, name=None, flags=None):
+        """
+        Connect to an SpringRTS Lobby server. Returns a proxy to an LobbyProtocol object.
+        """
+        protocol = await self._open_connection(server, port, use_ssl)
+
+        self.log.info("connected")
+        self._register_protocol(protocol, LobbyProtocolWrapper(protocol), server, port, use_ssl, name, flags)
+
+        return protocol.wrapper
+
+    def connection_lost(self, client_wrapper):
+        if self._closing or client_wrapper is not self.bot:
+            return
+        self.accepted = False
+        self.session += 1
+        if self._reconnect_task is not None and not self._reconnect_task.done():
+            return
+        self._reconnect_task = self.loop.create_task(self.reconnect(client_wrapper))
+
+    async def reconnect(self, client_wrapper):
+        """
+        Replace the protocol behind ``client_wrapper`` with a new connection that logs in with the
+        same identity. Event handlers stay registered on the wrapper; channels are queued again and
+        bridged clients are re-announced by the member sync once the server sends
+        ``ACCEPTED``.
+        """
+        old_protocol = client_wrapper.protocol
+        server_info = old_protocol.server_info
+
+        self.log.info("reconnecting")
+        LOBBY_RECONNECTS.inc(self.name)
+
+        await asyncio.sleep(self.backoff.next())
+        protocol = await self._open_connection(server_info["host"], server_info["port"], server_info["ssl"])
+
+        connections.pop(getattr(old_protocol, "netid", None), None)
+        client_wrapper.protocol = protocol
+        self._register_protocol(protocol, client_wrapper, server_info["host"], server_info["port"],
+                                server_info["ssl"], getattr(old_protocol, "name", self.client_name),
+                                getattr(old_protocol, "flags", self.settings.client_flags))
+        self.register_channels(client_wrapper)
+
+        self.log.info("reconnected")
+        asignal("reconnected").send()
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.commands.stats()
+        stats["reconnects"] = int(LOBBY_RECONNECTS.get(self.name))
+        stats["lines_written"] = self._lines + (self._transport.writes if self._transport else 0)
+        stats["socket_writes"] = self._writes + (self._transport.flushes if self._transport else 0)
+        return stats
+
+    async def stop(self) -> None:
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        await self.commands.stop()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+# Priority classes, most urgent first
+CHAT = 0
+MEMBERSHIP = 1
+BULK = 2
+
+PRIORITY_NAMES = ("chat", "membership", "bulk")
+
+Command = Tuple[str, Tuple[Any, ...]]
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` operations per second on average and bursts of up to ``burst``. A rate of 0
+    never limits.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def consume(self) -> bool:
+        if self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self) -> float:
+        """
+        Seconds until the next token is available.
+        """
+        if self.rate <= 0:
+            return 0
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class _PriorityView(object):
+    """
+    Looks like the lobby client wrapper, but every command is queued at one priority.
+    """
+
+    __slots__ = ("_scheduler", "_priority")
+
+    def __init__(self, scheduler: 'LobbyCommandScheduler', priority: int) -> None:
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def __getattr__(self, name: str) -> Callable[..., None]:
+        def submit(*args: Any) -> None:
+            self._scheduler.submit(self._priority, name, *args)
+        return submit
+
+
+class LobbyCommandScheduler(object):
+    """
+    Rate limits the commands the bridge writes to the lobby and sends the most urgent first.
+
+    Commands are names of lobby client methods (``say_from``, ``join_from``, ...) queued in one
+    FIFO per priority class: chat before joins and leaves before the bulk member sync. A token
+    bucket keeps the bridge under the server's flood limit. While tokens are available and nothing
+    is queued, a command is written immediately without a trip through the queue.
+
+    ``client`` returns the current lobby client wrapper, so queued commands survive reconnects.
+    Commands written before the first connection are dropped.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, client: Callable[[], Any], rate: float = 20, burst: float = 40,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("lobby.commands")
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.errors = 0
+        self.dropped = 0
+        self.peak_depth = 0
+
+        self._queues: Tuple[Deque[Command], ...] = tuple(deque() for _ in PRIORITY_NAMES)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def view(self, priority: int) -> _PriorityView:
+        return _PriorityView(self, priority)
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def submit(self, priority: int, command: str, *args: Any) -> None:
+        if not self.depth and self.bucket.consume():
+            self._write(priority, command, args)
+            return
+
+        self._queues[priority].append((command, args))
+        depth = self.depth
+        if depth > self.peak_depth:
+            self.peak_depth = depth
+
+        self._wakeup.set()
+        if self._task is None:
+            self._task = self.loop.create_task(self._worker())
+
+    def call_after(self, priority: int, callback: Callable[[], None]) -> None:
+        """
+        Run ``callback`` once every command queued at ``priority`` so far has been written.
+        """
+        queue = self._queues[priority]
+        if not queue:
+            callback()
+            return
+        queue.append((None, (callback,)))
+
+    def _run_callbacks(self) -> None:
+        for queue in self._queues:
+            while queue and queue[0][0] is None:
+                _, (callback,) = queue.popleft()
+                try:
+                    callback()
+                except Exception:
+                    self.log.exception("Failed to run a queued callback")
+
+    def _write(self, priority: int, command: str, args: Tuple[Any, ...]) -> None:
+        client = self.client()
+        if client is None:
+            self.dropped += 1
+            return
+        try:
+            getattr(client, command)(*args)
+            self.sent[priority] += 1
+        except Exception:
+            self.errors += 1
+            self.log.exception(f"Failed to send {command} to the lobby")
+
+    def _next(self) -> Optional[Tuple[int, Command]]:
+        for priority, queue in enumerate(self._queues):
+            if queue:
+                return priority, queue.popleft()
+        return None
+
+    async def _worker(self) -> None:
+        while True:
+            self._run_callbacks()
+            if not self.depth:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if not self.bucket.consume():
+                await asyncio.sleep(self.bucket.delay())
+                continue
+
+            priority, (command, args) = self._next()
+            self._write(priority, command, args)
+
+    def stats(self) -> Dict[str, int]:
+        stats = {f"{name}_depth": len(queue) for name, queue in zip(PRIORITY_NAMES, self._queues)}
+        stats.update({f"{name}_sent": sent for name, sent in zip(PRIORITY_NAMES, self.sent)})
+        stats["peak_depth"] = self.peak_depth
+        stats["errors"] = self.errors
+        stats["dropped"] = self.dropped
+        return stats
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
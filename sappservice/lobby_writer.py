@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+from typing import List, Optional
+
+# Longest command line the lobby server accepts, in bytes, without the line terminator
+MAX_LINE_BYTES = 1024
+
+
+def split_message(body: str, limit: int) -> List[str]:
+    """
+    Split ``body`` into lines of at most ``limit`` UTF-8 bytes. Embedded newlines start a new
+    line and blank lines are dropped; indentation is kept. Long lines break at the last space
+    that fits, or mid-word when there is none, never inside a character. A character longer
+    than ``limit`` gets a line of its own.
+    """
+    limit = max(1, limit)
+    lines = list()
+    for line in body.splitlines():
+        line = line.rstrip()
+        while len(line.encode("utf-8")) > limit:
+            cut = max(len(line.encode("utf-8")[:limit].decode("utf-8", errors="ignore")), 1)
+            # a break inside the indentation would lose it
+            indent = len(line) - len(line.lstrip())
+            space = line.rfind(" ", indent, cut + 1)
+            if space > indent:
+                cut = space
+            chunk = line[:cut].rstrip()
+            if chunk:
+                lines.append(chunk)
+            line = line[cut:].lstrip()
+        if line:
+            lines.append(line)
+    return lines
+
+
+class CoalescingTransport(object):
+    """
+    Wraps a transport so that everything written during one event loop iteration leaves in a
+    single ``transport.write`` at the end of it. Everything else is passed through; closing
+    flushes first.
+    """
+
+    def __init__(self, transport: asyncio.Transport, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.transport = transport
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.writes = 0
+        self.flushes = 0
+
+        self._buffer: List[bytes] = list()
+        self._scheduled = False
+
+    def __getattr__(self, name: str):
+        return getattr(self.transport, name)
+
+    def write(self, data: bytes) -> None:
+        self.writes += 1
+        self._buffer.append(data)
+        if not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def writelines(self, lines) -> None:
+        for data in lines:
+            self.write(data)
+
+    def flush(self) -> None:
+        self._scheduled = False
+        if not self._buffer:
+            return
+        data, self._buffer = b"".join(self._buffer), list()
+        if not self.transport.is_closing():
+            self.flushes += 1
+            self.transport.write(data)
+
+    def close(self) -> None:
+        self.flush()
+        self.transport.close()
+
+    def write_eof(self) -> None:
+        self.flush()
+        self.transport.write_eof()
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from urllib.parse import urlparse
+
+import aiohttp
+
+from aiohttp import web
+
+from sappservice.bridge_state import BridgeStateStore
+
+CHUNK_SIZE = 64 * 1024
+
+# newest first; older homeservers only have the unauthenticated media API
+DOWNLOAD_PATHS = ("/_matrix/client/v1/media/{kind}/{server}/{media_id}",
+                  "/_matrix/media/r0/{kind}/{server}/{media_id}")
+
+
+def short_id(mxc: str) -> str:
+    """
+    Stable 12 character id of an ``mxc://`` URL; the same media always gets the same link.
+    """
+    return base64.urlsafe_b64encode(hashlib.sha256(mxc.encode("utf-8")).digest()[:9]).decode("ascii")
+
+
+def parse_mxc(mxc: str) -> Optional[Tuple[str, str]]:
+    url = urlparse(mxc)
+    if url.scheme != "mxc" or not url.netloc or not url.path.strip("/"):
+        return None
+    return url.netloc, url.path.strip("/")
+
+
+class _CachedMedia(object):
+    __slots__ = ("size", "content_type")
+
+    def __init__(self, size: int, content_type: str) -> None:
+        self.size = size
+        self.content_type = content_type
+
+
+class _CachedFileResponse(web.FileResponse):
+    """
+    Calls ``release`` once the file has been sent, or could not be.
+    """
+
+    def __init__(self, path: str, release: Callable[[], None], **kwargs) -> None:
+        super().__init__(path, **kwargs)
+        self._release: Optional[Callable[[], None]] = release
+
+    async def prepare(self, request: web.BaseRequest):
+        try:
+            return await super().prepare(request)
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class MediaProxy(object):
+    """
+    Short links for Matrix media posted to the lobby, served from the appservice web server.
+
+    ``/m/<id>`` is fetched from the homeserver once, with the appservice token, streamed into
+    ``cache_dir`` and served from there with ``ETag`` and ``Range`` support. Concurrent requests
+    for media that is still downloading wait for the one download. The cache holds at most
+    ``max_size`` bytes and evicts the least recently served file first. With ``thumbnails``,
+    ``/m/<id>/thumbnail`` serves a copy downscaled by the homeserver to ``thumbnail_size``.
+
+    Only media the bridge has linked can be fetched, so the endpoint is not an open proxy.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, appserv, store: BridgeStateStore, homeserver: str, public_url: str, cache_dir: str,
+                 max_size: int, thumbnails: bool = False, thumbnail_size: int = 320,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("media")
+        # the HTTP session only exists once the appservice has started
+        self.appserv = appserv
+        self.store = store
+        self.homeserver = homeserver.rstrip("/")
+        self.public_url = public_url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.thumbnails = thumbnails
+        self.thumbnail_size = thumbnail_size
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self._links: Dict[str, str] = dict()
+        self._cache: 'OrderedDict[str, _CachedMedia]' = OrderedDict()
+        self._size = 0
+        self._downloads: Dict[str, asyncio.Future] = dict()
+        # key -> requests serving it; eviction leaves these files alone
+        self._serving: Dict[str, int] = dict()
+
+    def install(self, app: web.Application) -> None:
+        app.router.add_route("GET", "/m/{media_id}", self._serve)
+        if self.thumbnails:
+            app.router.add_route("GET", "/m/{media_id}/thumbnail", self._serve)
+
+    def start(self) -> None:
+        """
+        Index the files a previous run left in the cache, oldest first.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        files = list()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".meta"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with open(f"{path}.meta") as stream:
+                    content_type = json.load(stream)["content_type"]
+                stat = os.stat(path)
+            except (OSError, ValueError, KeyError):
+                self._remove(name)
+                continue
+            files.append((stat.st_mtime, name, _CachedMedia(stat.st_size, content_type)))
+
+        for _, name, entry in sorted(files):
+            self._cache[name] = entry
+            self._size += entry.size
+        self._evict()
+        self.log.info(f"Media cache has {len(self._cache)} files, {self._size} bytes")
+
+    async def link(self, mxc: str) -> Optional[str]:
+        """
+        Short public URL of ``mxc``, or ``None`` if it is not a media URL.
+        """
+        if parse_mxc(mxc) is None:
+            return None
+
+        media_id = short_id(mxc)
+        if media_id not in self._links:
+            self._links[media_id] = mxc
+            await self.store.save_media_link(media_id, mxc)
+        return f"{self.public_url}/m/{media_id}"
+
+    # cache
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _remove(self, key: str) -> None:
+        for path in (self._path(key), f"{self._path(key)}.meta", f"{self._path(key)}.part"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _pin(self, key: str) -> None:
+        self._serving[key] = self._serving.get(key, 0) + 1
+
+    def _unpin(self, key: str) -> None:
+        serving = self._serving.pop(key) - 1
+        if serving:
+            self._serving[key] = serving
+        self._evict()
+
+    def _evict(self) -> None:
+        for key in list(self._cache):
+            if self._size <= self.max_size:
+                break
+            if key in self._serving:
+                continue
+            entry = self._cache.pop(key)
+            self._size -= entry.size
+            self._remove(key)
+
+    async def _mxc(self, media_id: str) -> Optional[str]:
+        mxc = self._links.get(media_id)
+        if mxc is None:
+            mxc = await self.store.media_link(media_id)
+            if mxc is not None:
+                self._links[media_id] = mxc
+        return mxc
+
+    async def _fetch(self, key: str, mxc: str, thumbnail: bool) -> _CachedMedia:
+        server, media_id = parse_mxc(mxc)
+        kind = "thumbnail" if thumbnail else "download"
+        params = ({"width": self.thumbnail_size, "height": self.thumbnail_size, "method": "scale"}
+                  if thumbnail else {})
+        headers = {"Authorization": f"Bearer {self.appserv.as_token}"}
+
+        for template in DOWNLOAD_PATHS:
+            url = self.homeserver + template.format(kind=kind, server=server, media_id=media_id)
+            async with self.appserv.http_session.get(url, params=params, headers=headers) as response:
+                # 404 with M_UNRECOGNIZED, or 400/405, from homeservers without the endpoint
+                if response.status in (400, 404, 405) and template is not DOWNLOAD_PATHS[-1]:
+                    continue
+                response.raise_for_status()
+
+                partial = f"{self._path(key)}.part"
+                size = 0
+                with open(partial, "wb") as stream:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        stream.write(chunk)
+                        size += len(chunk)
+                entry = _CachedMedia(size, response.content_type or "application/octet-stream")
+
+            with open(f"{self._path(key)}.meta", "w") as stream:
+                json.dump({"mxc": mxc, "content_type": entry.content_type}, stream)
+            os.replace(partial, self._path(key))
+            return entry
+
+    async def _get(self, key: str, mxc: str, thumbnail: bool) -> _CachedMedia:
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry
+
+        download = self._downloads.get(key)
+        if download is not None:
+            self.hits += 1
+            return await asyncio.shield(download)
+
+        self.misses += 1
+        download = self._downloads[key] = self.loop.create_future()
+        try:
+            entry = await self._fetch(key, mxc, thumbnail)
+        except Exception as e:
+            self._remove(key)
+            download.set_exception(e)
+            # retrieved here so waiting is optional
+            download.exception()
+            raise
+        finally:
+            del self._downloads[key]
+
+        self._cache[key] = entry
+        self._size += entry.size
+        download.set_result(entry)
+        return entry
+
+    async def _serve(self, request: web.Request) -> web.StreamResponse:
+        media_id = request.match_info["media_id"]
+        thumbnail = request.path.endswith("/thumbnail")
+
+        mxc = await self._mxc(media_id)
+        if mxc is None:
+            raise web.HTTPNotFound()
+
+        key = f"{media_id}.thumbnail" if thumbnail else media_id
+
+        # a file is not evicted until it is sent, so one larger than the whole cache is still served
+        self._pin(key)
+        try:
+            entry = await self._get(key, mxc, thumbnail)
+        except aiohttp.ClientResponseError as e:
+            self._unpin(key)
+            self.errors += 1
+            self.log.warning(f"Failed to fetch {mxc}: {e.status} {e.message}")
+            raise web.HTTPNotFound() if e.status == 404 else web.HTTPBadGateway()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self._unpin(key)
+            self.errors += 1
+            self.log.warning(f"Failed to fetch {mxc}: {e!r}")
+            raise web.HTTPBadGateway()
+        except BaseException:
+            self._unpin(key)
+            raise
+
+        # the content of an mxc URL never changes. FileResponse streams the file and handles
+        # ETag, If-None-Match and Range.
+        return _CachedFileResponse(self._path(key), lambda: self._unpin(key), chunk_size=CHUNK_SIZE,
+                                   headers={"Content-Type": entry.content_type,
+                                            "Cache-Control": "public, max-age=31536000, immutable"})
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "files": len(self._cache),
+            "bytes": self._size,
+            "downloading": len(self._downloads),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import sys
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from mautrix.types import RoomID, UserID
+
+from sappservice.rooms import DEFAULT_CONNECTION
+
+
+class _MatrixUser(object):
+    __slots__ = ("rooms", "bridged")
+
+    def __init__(self) -> None:
+        self.rooms: Tuple[RoomID, ...] = ()
+        # (lobby connection, display name the user was announced with) for every connection the
+        # user is bridged to
+        self.bridged: Tuple[Tuple[str, str], ...] = ()
+
+    def bridged_as(self, connection: str) -> Optional[str]:
+        for name, displayname in self.bridged:
+            if name == connection:
+                return displayname
+        return None
+
+
+class _LobbyUser(object):
+    __slots__ = ("channels",)
+
+    def __init__(self) -> None:
+        self.channels: Tuple[str, ...] = ()
+
+
+class MembershipMirror(object):
+    """
+    In-memory view of who is where on both sides of the bridge.
+
+    The Matrix side is kept current from ``m.room.member`` events of every user, puppets
+    included, and records which lobby identity each Matrix user was bridged as. The lobby side is
+    kept current from ``CLIENTS``, ``JOINED`` and ``LEFT``. A user costs one slotted record holding
+    a tuple of interned room ids or channel names. Users are in a handful of bridged rooms at
+    most, so a check is a dict lookup plus a scan of a few pointers, and a tuple takes a fraction
+    of the memory of a set; 50k users with one room each fit in about 20 MB.
+
+    Every update returns whether it changed anything, so callers only act on real transitions.
+    """
+
+    log: logging.Logger
+
+    def __init__(self) -> None:
+        self.log = logging.getLogger("membership")
+        self._matrix: Dict[UserID, _MatrixUser] = dict()
+        self._lobby: Dict[str, _LobbyUser] = dict()
+
+    # Matrix side
+
+    def in_room(self, room_id: RoomID, user_id: UserID) -> bool:
+        user = self._matrix.get(user_id)
+        return user is not None and room_id in user.rooms
+
+    def joined_any(self, user_id: UserID) -> bool:
+        user = self._matrix.get(user_id)
+        return user is not None and bool(user.rooms)
+
+    def rooms_of(self, user_id: UserID) -> Set[RoomID]:
+        user = self._matrix.get(user_id)
+        return set(user.rooms) if user is not None else set()
+
+    def matrix_joined(self, room_id: RoomID, user_id: UserID) -> bool:
+        user = self._matrix.get(user_id)
+        if user is None:
+            user = self._matrix[user_id] = _MatrixUser()
+        elif room_id in user.rooms:
+            return False
+        user.rooms += (sys.intern(room_id),)
+        return True
+
+    def matrix_left(self, room_id: RoomID, user_id: UserID) -> bool:
+        user = self._matrix.get(user_id)
+        if user is None or room_id not in user.rooms:
+            return False
+        user.rooms = tuple(room for room in user.rooms if room != room_id)
+        if not user.rooms and not user.bridged:
+            del self._matrix[user_id]
+        return True
+
+    def bridge(self, user_id: UserID, displayname: str, connection: str = DEFAULT_CONNECTION) -> bool:
+        """
+        Record that ``user_id`` is announced to the lobby behind ``connection`` as
+        ``displayname``. Returns ``False`` when it already was, with the same name.
+        """
+        user = self._matrix.get(user_id)
+        if user is None:
+            user = self._matrix[user_id] = _MatrixUser()
+        elif user.bridged_as(connection) == displayname:
+            return False
+        user.bridged = tuple(entry for entry in user.bridged if entry[0] != connection) + ((connection, displayname),)
+        return True
+
+    def bridged_as(self, user_id: UserID, connection: str = DEFAULT_CONNECTION) -> Optional[str]:
+        user = self._matrix.get(user_id)
+        return user.bridged_as(connection) if user is not None else None
+
+    def unbridge(self, connection: str = DEFAULT_CONNECTION) -> None:
+        """
+        Forget every name bridged to ``connection``; a new lobby session knows no bridged clients.
+        """
+        for user_id in list(self._matrix):
+            user = self._matrix[user_id]
+            if user.bridged_as(connection) is None:
+                continue
+            user.bridged = tuple(entry for entry in user.bridged if entry[0] != connection)
+            if not user.rooms and not user.bridged:
+                del self._matrix[user_id]
+
+    def load(self, members: Dict[RoomID, Iterable[UserID]], bridged: Dict[UserID, str],
+             connection: str = DEFAULT_CONNECTION) -> None:
+        """
+        Replace the Matrix side of the rooms in ``members`` and the names ``bridged`` to
+        ``connection``, as read from the state store at startup or after a member sync.
+        """
+        for user in self._matrix.values():
+            user.rooms = tuple(room for room in user.rooms if room not in members)
+
+        for room_id, user_ids in members.items():
+            for user_id in user_ids:
+                self.matrix_joined(room_id, user_id)
+
+        for user_id, displayname in bridged.items():
+            self.bridge(user_id, displayname, connection)
+
+        for user_id in [user_id for user_id, user in self._matrix.items()
+                        if not user.rooms and not user.bridged]:
+            del self._matrix[user_id]
+
+    # lobby side
+
+    def in_channel(self, channel: str, username: str) -> bool:
+        user = self._lobby.get(username)
+        return user is not None and channel in user.channels
+
+    def lobby_joined(self, channel: str, usernames: Iterable[str]) -> List[str]:
+        """
+        Add ``usernames`` to ``channel`` and return the ones that were not there yet.
+        """
+        channel = sys.intern(channel)
+        added = list()
+        for username in usernames:
+            user = self._lobby.get(username)
+            if user is None:
+                user = self._lobby[username] = _LobbyUser()
+            elif channel in user.channels:
+                continue
+            user.channels += (channel,)
+            added.append(username)
+        return added
+
+    def lobby_left(self, channel: str, username: str) -> bool:
+        user = self._lobby.get(username)
+        if user is None or channel not in user.channels:
+            return False
+        user.channels = tuple(name for name in user.channels if name != channel)
+        if not user.channels:
+            del self._lobby[username]
+        return True
+
+    def lobby_reset(self, channels: Optional[Iterable[str]] = None) -> None:
+        """
+        Forget the lobby side of ``channels``, or all of it; a new lobby session sends
+        ``CLIENTS`` for every channel again.
+        """
+        if channels is None:
+            self._lobby.clear()
+            return
+
+        channels = set(channels)
+        for username in list(self._lobby):
+            user = self._lobby[username]
+            user.channels = tuple(channel for channel in user.channels if channel not in channels)
+            if not user.channels:
+                del self._lobby[username]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "matrix_users": len(self._matrix),
+            "matrix_memberships": sum(len(user.rooms) for user in self._matrix.values()),
+            "bridged": sum(1 for user in self._matrix.values() if user.bridged),
+            "lobby_users": len(self._lobby),
+            "lobby_memberships": sum(len(user.channels) for user in self._lobby.values()),
+        }
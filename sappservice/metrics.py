@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process metrics, served in the Prometheus text format on ``/metrics``.
+
+Recording is a dict update (counters) or a bisect plus two adds (histograms); all formatting
+happens when the endpoint is scraped.
+"""
+
+import asyncio
+import time
+
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Union
+
+from aiohttp import web, ClientSession, TraceConfig
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter(object):
+    __slots__ = ("name", "help", "labels", "_values")
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = dict()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        values = self._values
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram(object):
+    __slots__ = ("name", "help", "labels", "buckets", "_values")
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = dict()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        data = self._values.get(label_values)
+        if data is None:
+            data = self._values[label_values] = [0] * (len(self.buckets) + 2)
+        data[bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, data in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            cumulative += data[-2]
+            labels = _format_labels(self.labels, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {data[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+class Gauge(object):
+    """
+    A value read from ``callback`` at scrape time. The callback returns a number, or a dict of
+    label values to numbers for a labelled gauge.
+    """
+
+    __slots__ = ("name", "help", "labels", "callback")
+
+    def __init__(self, name: str, help: str, callback: Callable[[], GaugeValue],
+                 labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.callback()
+        if isinstance(value, dict):
+            for label_values, item in value.items():
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {item}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Union[Counter, Histogram, Gauge]] = dict()
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = self._metrics[name] = Counter(name, help, labels)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = self._metrics[name] = Histogram(name, help, labels, buckets)
+        return metric
+
+    def gauge(self, name: str, help: str, callback: Callable[[], GaugeValue],
+              labels: Sequence[str] = ()) -> Gauge:
+        metric = self._metrics[name] = Gauge(name, help, callback, labels)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+TRANSACTIONS = REGISTRY.counter("sappservice_transactions_total",
+                                "Appservice transactions received from the homeserver")
+MATRIX_EVENTS = REGISTRY.counter("sappservice_matrix_events_total",
+                                 "Matrix events handled, by event type", ("type",))
+MATRIX_EVENTS_REJECTED = REGISTRY.counter("sappservice_matrix_events_rejected_total",
+                                          "Matrix events dropped before handling, by reason", ("reason",))
+MATRIX_EVENT_SECONDS = REGISTRY.histogram("sappservice_matrix_event_seconds",
+                                          "Time spent in Matrix.handle_event, by event type", ("type",))
+LOBBY_COMMANDS = REGISTRY.counter("sappservice_lobby_commands_total",
+                                  "Commands sent to the lobby server", ("command",))
+LOBBY_EVENTS = REGISTRY.counter("sappservice_lobby_events_total",
+                                "Events received from the lobby server", ("event",))
+LOBBY_RECONNECTS = REGISTRY.counter("sappservice_lobby_reconnects_total",
+                                    "Reconnections to the lobby server", ("connection",))
+HOMESERVER_SECONDS = REGISTRY.histogram("sappservice_homeserver_request_seconds",
+                                        "Homeserver request latency", ("method", "endpoint"))
+HOMESERVER_ERRORS = REGISTRY.counter("sappservice_homeserver_errors_total",
+                                     "Failed homeserver requests", ("endpoint", "status"))
+HOMESERVER_RATE_LIMITED = REGISTRY.counter("sappservice_homeserver_rate_limited_total",
+                                          "Homeserver requests answered with M_LIMIT_EXCEEDED", ("endpoint",))
+HOMESERVER_RETRIES = REGISTRY.counter("sappservice_homeserver_retries_total",
+                                      "Homeserver requests retried by the scheduler", ("endpoint",))
+DUPLICATES = REGISTRY.counter("sappservice_duplicates_dropped_total",
+                              "Redelivered transactions and events dropped before handling", ("kind",))
+
+
+def _outstanding_tasks() -> int:
+    if hasattr(asyncio, "all_tasks"):
+        return len(asyncio.all_tasks())
+    return len(asyncio.Task.all_tasks())
+
+
+REGISTRY.gauge("sappservice_asyncio_tasks", "Outstanding asyncio tasks", _outstanding_tasks)
+
+_ENDPOINT_CLASSES = (
+    ("/send/", "send"),
+    ("/receipt/", "receipt"),
+    ("/read_markers", "receipt"),
+    ("/joined_members", "members"),
+    ("/members", "members"),
+    ("/join", "join"),
+    ("/leave", "leave"),
+    ("/invite", "join"),
+    ("/profile/", "profile"),
+    ("/presence/", "presence"),
+    ("/register", "register"),
+    ("/state/", "state"),
+    ("/media/", "media"),
+)
+
+
+def endpoint_class(path: str) -> str:
+    """
+    Coarse, low-cardinality name for a Client-Server API path.
+    """
+    for fragment, name in _ENDPOINT_CLASSES:
+        if fragment in path:
+            return name
+    return "other"
+
+
+@web.middleware
+async def _count_transactions(request: web.Request, handler):
+    if request.method == "PUT" and "/transactions/" in request.path:
+        TRANSACTIONS.inc()
+    return await handler(request)
+
+
+async def _metrics_handler(_: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain")
+
+
+def install_routes(app: web.Application) -> None:
+    """
+    Serve ``/metrics`` and count transactions on the appservice web app. Call before it starts.
+    """
+    app.middlewares.append(_count_transactions)
+    app.router.add_route("GET", "/metrics", _metrics_handler)
+
+
+async def _on_request_start(_: ClientSession, ctx, params) -> None:
+    ctx.start = time.monotonic()
+    ctx.endpoint = endpoint_class(params.url.path)
+
+
+async def _on_request_end(_: ClientSession, ctx, params) -> None:
+    HOMESERVER_SECONDS.observe(time.monotonic() - ctx.start, params.method, ctx.endpoint)
+    if params.response.status >= 400:
+        HOMESERVER_ERRORS.inc(ctx.endpoint, str(params.response.status))
+
+
+async def _on_request_exception(_: ClientSession, ctx, params) -> None:
+    HOMESERVER_SECONDS.observe(time.monotonic() - ctx.start, params.method, ctx.endpoint)
+    HOMESERVER_ERRORS.inc(ctx.endpoint, type(params.exception).__name__)
+
+
+def client_trace_config() -> TraceConfig:
+    """
+    Times every request of the session it is passed to in ``trace_configs``.
+    """
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    return trace_config
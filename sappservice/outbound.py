@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from mautrix.types import RoomID
+
+from sappservice.homeserver_scheduler import HomeserverScheduler
+from sappservice.identity import IdentityMapper
+
+
+class OutboundMessage(object):
+    __slots__ = ("username", "text", "emote")
+
+    def __init__(self, username: str, text: str, emote: bool = False) -> None:
+        self.username = username
+        self.text = text
+        self.emote = emote
+
+
+class _RoomQueue(object):
+    __slots__ = ("room_id", "messages", "wakeup", "task")
+
+    def __init__(self, room_id: RoomID) -> None:
+        self.room_id = room_id
+        self.messages: Deque[OutboundMessage] = deque()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+
+class OutboundScheduler(object):
+    """
+    Delivers lobby chat to Matrix through one ordered queue per room.
+
+    Every room has its own worker, so a slow homeserver response only delays the room it belongs
+    to. A full queue drops the new message and counts it. With ``merge_window`` set, consecutive
+    lines from the same lobby user that arrive within that many seconds are sent as one
+    multi-line event. Sends go through ``requests`` when given, so rate limited messages are
+    retried rather than lost.
+    """
+
+    log: logging.Logger
+    identities: IdentityMapper
+    requests: Optional[HomeserverScheduler]
+
+    def __init__(self, identities: IdentityMapper, max_depth: int = 100, merge_window: float = 0,
+                 requests: Optional[HomeserverScheduler] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("lobby.outbound")
+        self.identities = identities
+        self.requests = requests
+        self.max_depth = max(1, max_depth)
+        self.merge_window = merge_window
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.errors = 0
+        self.peak_depth = 0
+
+        self._queues: Dict[RoomID, _RoomQueue] = dict()
+
+    def send(self, room_id: RoomID, username: str, text: str, emote: bool = False) -> bool:
+        """
+        Queue a message from ``username`` for ``room_id``. Returns ``False`` if it was dropped.
+        """
+        queue = self._queues.get(room_id)
+        if queue is None:
+            queue = self._queues[room_id] = _RoomQueue(room_id)
+
+        if len(queue.messages) >= self.max_depth:
+            self.dropped += 1
+            self.log.warning(f"Outbound queue for {room_id} is full, dropping message from {username}")
+            return False
+
+        queue.messages.append(OutboundMessage(username, text, emote))
+        if len(queue.messages) > self.peak_depth:
+            self.peak_depth = len(queue.messages)
+
+        queue.wakeup.set()
+        if queue.task is None:
+            queue.task = self.loop.create_task(self._worker(queue))
+        return True
+
+    async def _collect(self, queue: _RoomQueue, first: OutboundMessage) -> List[str]:
+        lines = [first.text]
+        deadline = self.loop.time() + self.merge_window
+
+        while True:
+            messages = queue.messages
+            while messages and messages[0].username == first.username and not messages[0].emote:
+                lines.append(messages.popleft().text)
+
+            remaining = deadline - self.loop.time()
+            if messages or remaining <= 0:
+                break
+
+            queue.wakeup.clear()
+            try:
+                await asyncio.wait_for(queue.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+        return lines
+
+    async def _deliver(self, room_id: RoomID, message: OutboundMessage) -> None:
+        intent = self.identities.puppet(message.username)
+        if message.emote:
+            send = lambda: intent.send_emote(room_id, message.text)
+        else:
+            send = lambda: intent.send_text(room_id, message.text)
+
+        if self.requests is None:
+            await send()
+        else:
+            # every attempt gets a new transaction ID, so only rate limited sends are retried
+            await self.requests.run("send", intent.mxid, send, idempotent=False)
+
+    async def _worker(self, queue: _RoomQueue) -> None:
+        while True:
+            if not queue.messages:
+                queue.wakeup.clear()
+                await queue.wakeup.wait()
+                continue
+
+            message = queue.messages.popleft()
+
+            if self.merge_window > 0 and not message.emote:
+                lines = await self._collect(queue, message)
+                if len(lines) > 1:
+                    self.merged += len(lines) - 1
+                    message = OutboundMessage(message.username, "\n".join(lines))
+
+            try:
+                await self._deliver(queue.room_id, message)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                self.log.exception(f"Failed to send message from {message.username} to {queue.room_id}")
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue.messages) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rooms": len(self._queues),
+            "depth": self.depth,
+            "peak_depth": self.peak_depth,
+            "sent": self.sent,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    async def stop(self) -> None:
+        tasks = [queue.task for queue in self._queues.values() if queue.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for queue in self._queues.values():
+            queue.task = None
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, NamedTuple, Optional
+
+
+class OutboxEntry(NamedTuple):
+    connection: str
+    channel: str
+    domain: str
+    username: str
+    body: str
+    queued_at: float
+
+
+class LobbyOutbox(object):
+    """
+    Holds Matrix chat for lobby connections that are not logged in and hands it back, in order,
+    once their session is accepted again.
+
+    Each connection keeps at most ``max_size`` lines, dropping the oldest first, and lines older
+    than ``max_age`` seconds are dropped when replayed. With a ``store``, new lines are written to
+    the database every ``interval`` seconds, loaded again on start and deleted once replayed.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, max_size: int = 1000, max_age: float = 300, store=None, interval: float = 1,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("lobby.outbox")
+        self.max_size = max_size
+        self.max_age = max_age
+        self.store = store
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.queued = 0
+        self.replayed = 0
+        self.dropped_full = 0
+        self.dropped_stale = 0
+
+        self._queues: Dict[str, Deque[OutboxEntry]] = dict()
+        self._pending: List[OutboxEntry] = list()
+        # database writes and deletes run one at a time, in the order they were issued
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _queue(self, connection: str) -> Deque[OutboxEntry]:
+        try:
+            return self._queues[connection]
+        except KeyError:
+            queue = self._queues[connection] = deque(maxlen=self.max_size)
+            return queue
+
+    def _append(self, entry: OutboxEntry) -> None:
+        queue = self._queue(entry.connection)
+        if len(queue) == queue.maxlen:
+            self.dropped_full += 1
+        queue.append(entry)
+
+    def add(self, connection: str, channel: str, domain: str, username: str, body: str) -> None:
+        entry = OutboxEntry(connection, channel, domain, username, body, time.time())
+        self._append(entry)
+        self.queued += 1
+        if self.store is not None:
+            self._pending.append(entry)
+
+    def replay(self, connection: str, send: Callable[[OutboxEntry], None]) -> int:
+        """
+        Pass every fresh line held for ``connection`` to ``send``, oldest first, and forget them.
+        """
+        queue = self._queues.pop(connection, None)
+        if not queue:
+            return 0
+
+        oldest = time.time() - self.max_age
+        sent = 0
+        for entry in queue:
+            if entry.queued_at < oldest:
+                self.dropped_stale += 1
+                continue
+            send(entry)
+            sent += 1
+        self.replayed += sent
+
+        if self.store is not None:
+            self._pending = [entry for entry in self._pending if entry.connection != connection]
+            self.loop.create_task(self._clear(connection))
+
+        dropped = len(queue) - sent
+        self.log.info(f"Replayed {sent} lines to {connection}" + (f", {dropped} too old" if dropped else ""))
+        return sent
+
+    async def start(self, connections: Iterable[str]) -> None:
+        """
+        Load the lines held for ``connections``; the others belong to other workers.
+        """
+        if self.store is None:
+            return
+
+        await self.store.prune_outbox(time.time() - self.max_age)
+        entries = await self.store.outbox(list(connections))
+        for entry in entries:
+            self._append(entry)
+        if entries:
+            self.log.info(f"Loaded {len(entries)} lines waiting for the lobby")
+        self._task = self.loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, list()
+            try:
+                await self.store.save_outbox(pending)
+            except Exception:
+                self.log.exception(f"Failed to persist {len(pending)} lobby lines")
+
+    async def _clear(self, connection: str) -> None:
+        async with self._lock:
+            try:
+                await self.store.clear_outbox(connection)
+            except Exception:
+                self.log.exception(f"Failed to delete replayed lobby lines of {connection}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": len(self),
+            "queued": self.queued,
+            "replayed": self.replayed,
+            "dropped_full": self.dropped_full,
+            "dropped_stale": self.dropped_stale,
+        }
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.store is not None:
+            await self.flush()
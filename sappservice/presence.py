@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from mautrix.types import PresenceState
+
+from sappservice.identity import IdentityMapper
+from sappservice.membership import MembershipMirror
+
+# CLIENTSTATUS bits
+STATUS_INGAME = 1
+STATUS_AWAY = 2
+
+IN_GAME = "In game"
+
+Presence = Tuple[PresenceState, Optional[str]]
+
+ONLINE: Presence = (PresenceState.ONLINE, None)
+OFFLINE: Presence = (PresenceState.OFFLINE, None)
+
+
+def lobby_presence(status: int) -> Presence:
+    """
+    Matrix presence and status message for a lobby ``CLIENTSTATUS`` bit field.
+    """
+    presence = PresenceState.UNAVAILABLE if status & STATUS_AWAY else PresenceState.ONLINE
+    return presence, IN_GAME if status & STATUS_INGAME else None
+
+
+class _PuppetPresence(object):
+    __slots__ = ("wanted", "sent", "sent_at", "slot")
+
+    def __init__(self) -> None:
+        self.wanted: Presence = OFFLINE
+        self.sent: Optional[Presence] = None
+        self.sent_at = 0.0
+        # wheel slot while online, -1 otherwise
+        self.slot = -1
+
+
+class PresenceEngine(object):
+    """
+    Mirrors lobby users' status to the presence of their Matrix puppets.
+
+    ``ADDUSER``, ``REMOVEUSER`` and ``CLIENTSTATUS`` only record the wanted presence. A change is
+    sent once it has been stable for ``flap_window`` seconds, so a user toggling away or
+    reconnecting costs at most one request, and none if they end where they started.
+
+    Matrix forgets presence that is not refreshed, so every online puppet is sent again once per
+    ``interval``. Online users are spread round-robin over ``slots`` buckets of one timer wheel,
+    and each tick refreshes a single bucket: the refreshes are spread evenly over the interval
+    instead of one timer and one burst per user.
+
+    Only lobby users whose puppet is in a bridged room are tracked; the others are picked up by
+    :meth:`joined` once their puppet joins one. ``REMOVEUSER`` forgets a user as soon as their
+    offline presence is sent, or right away if nothing was ever sent for them.
+    """
+
+    log: logging.Logger
+    identities: IdentityMapper
+    mirror: MembershipMirror
+
+    def __init__(self, identities: IdentityMapper, mirror: MembershipMirror, requests=None,
+                 interval: float = 30, flap_window: float = 2, slots: int = 30,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("presence")
+        self.identities = identities
+        self.mirror = mirror
+        self.requests = requests
+        self.interval = interval
+        self.flap_window = flap_window
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.sent = 0
+        self.refreshed = 0
+        self.coalesced = 0
+        self.failed = 0
+
+        self._users: Dict[str, _PuppetPresence] = dict()
+        # username -> loop time of the last change that is not sent yet
+        self._dirty: Dict[str, float] = dict()
+        self._wheel: List[Set[str]] = [set() for _ in range(max(1, slots))]
+        self._cursor = 0
+        self._next_slot = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def online(self, username: str) -> None:
+        self._set(username, ONLINE)
+
+    def offline(self, username: str) -> None:
+        entry = self._users.get(username)
+        if entry is not None and entry.sent in (None, OFFLINE):
+            # Matrix was never told otherwise
+            self._forget(username)
+        else:
+            self._set(username, OFFLINE)
+
+    def joined(self, username: str) -> None:
+        """
+        The puppet of ``username`` is in a bridged room; start tracking them if they were not.
+        """
+        if username not in self._users:
+            self._set(username, ONLINE)
+
+    def status(self, username: str, status: int) -> None:
+        self._set(username, lobby_presence(status))
+
+    def _set(self, username: str, wanted: Presence) -> None:
+        entry = self._users.get(username)
+        if entry is None:
+            if wanted == OFFLINE or not self.mirror.joined_any(self.identities.puppet_id(username)):
+                return
+            entry = self._users[username] = _PuppetPresence()
+        elif entry.wanted == wanted:
+            return
+
+        if username in self._dirty:
+            self.coalesced += 1
+        entry.wanted = wanted
+        self._dirty[username] = self.loop.time()
+
+        if wanted == OFFLINE:
+            if entry.slot >= 0:
+                self._wheel[entry.slot].discard(username)
+                entry.slot = -1
+        elif entry.slot < 0:
+            entry.slot = self._next_slot
+            self._wheel[entry.slot].add(username)
+            self._next_slot = (self._next_slot + 1) % len(self._wheel)
+
+    def _forget(self, username: str) -> None:
+        entry = self._users.pop(username, None)
+        self._dirty.pop(username, None)
+        if entry is not None and entry.slot >= 0:
+            self._wheel[entry.slot].discard(username)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        tick = self.interval / len(self._wheel)
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                await self.tick()
+            except Exception:
+                self.log.exception("Presence tick failed")
+
+    async def tick(self) -> None:
+        now = self.loop.time()
+
+        due = [username for username, changed in self._dirty.items() if now - changed >= self.flap_window]
+        for username in due:
+            del self._dirty[username]
+        changes = [username for username in due if self._users[username].wanted != self._users[username].sent]
+        self.coalesced += len(due) - len(changes)
+
+        bucket = self._wheel[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self._wheel)
+        # a puppet whose state was sent less than half an interval ago waits for its next turn
+        stale = now - self.interval / 2
+        refresh = [username for username in bucket
+                   if username not in self._dirty and username not in due and self._users[username].sent_at < stale]
+
+        if changes or refresh:
+            await asyncio.gather(*(self._send(username, False) for username in changes),
+                                 *(self._send(username, True) for username in refresh))
+
+    async def _send(self, username: str, refresh: bool) -> None:
+        entry = self._users.get(username)
+        if entry is None:
+            return
+
+        wanted = entry.wanted
+        puppet = self.identities.puppet(username)
+
+        if entry.sent is None and not self.mirror.joined_any(puppet.mxid):
+            if wanted == OFFLINE:
+                del self._users[username]
+            return
+
+        presence, status = wanted
+        try:
+            set_presence = lambda: puppet.set_presence(presence, status, ignore_cache=True)
+            if self.requests is None:
+                await set_presence()
+            else:
+                await self.requests.run("presence", puppet.mxid, set_presence)
+        except Exception as e:
+            self.failed += 1
+            self.log.warning(f"Failed to set presence of {puppet.mxid}: {e}")
+            # presence that is not refreshed expires on Matrix anyway
+            if wanted == OFFLINE and username not in self._dirty:
+                self._users.pop(username, None)
+            return
+
+        entry.sent = wanted
+        entry.sent_at = self.loop.time()
+        if refresh:
+            self.refreshed += 1
+        else:
+            self.sent += 1
+
+        # forget users who went offline, unless they came back while the request was in flight
+        if entry.wanted == OFFLINE and username not in self._dirty:
+            self._users.pop(username, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "online": sum(len(bucket) for bucket in self._wheel),
+            "pending": len(self._dirty),
+            "sent": self.sent,
+            "refreshed": self.refreshed,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+        }
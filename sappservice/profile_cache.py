@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from mautrix.types import UserID
+
+_MISSING = object()
+
+
+class ProfileCache(object):
+    """
+    Size-bounded LRU cache of Matrix display names with a time to live.
+
+    Entries are fed from ``m.room.member`` events and member syncs; the homeserver is only asked
+    about users the bridge has not seen within ``ttl`` seconds.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600) -> None:
+        self.log = logging.getLogger("profile_cache")
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: 'OrderedDict[UserID, Tuple[float, Optional[str]]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, user_id: UserID):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+
+        expires, displayname = entry
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return _MISSING
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return displayname
+
+    def get(self, user_id: UserID, default: Optional[str] = None) -> Optional[str]:
+        displayname = self._lookup(user_id)
+        return default if displayname is _MISSING else displayname
+
+    def set(self, user_id: UserID, displayname: Optional[str]) -> None:
+        self._entries[user_id] = (time.monotonic() + self.ttl, displayname)
+        self._entries.move_to_end(user_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: UserID) -> None:
+        self._entries.pop(user_id, None)
+
+    async def get_displayname(self, intent, user_id: UserID) -> Optional[str]:
+        """
+        Return the cached display name of ``user_id``, asking the homeserver through ``intent``
+        on a miss.
+        """
+        displayname = self._lookup(user_id)
+        if displayname is _MISSING:
+            displayname = await intent.get_displayname(user_id)
+            self.set(user_id, displayname)
+        return displayname
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
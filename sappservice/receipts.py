@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from typing import Dict, Optional
+
+from mautrix.types import EventID, RoomID
+
+
+class ReceiptCoalescer(object):
+    """
+    Sends the appservice bot's read receipts in batches.
+
+    Only the latest event of each room is remembered; receipts for events it replaces are never
+    sent. Pending receipts are flushed every ``interval`` seconds and on :meth:`stop`.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, appserv, interval: float = 2, requests=None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.log = logging.getLogger("receipts")
+        # the bot intent only exists once the appservice has started
+        self.appserv = appserv
+        self.requests = requests
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.sent = 0
+        self.coalesced = 0
+
+        self._pending: Dict[RoomID, EventID] = dict()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark(self, room_id: RoomID, event_id: EventID) -> None:
+        if room_id in self._pending:
+            self.coalesced += 1
+        self._pending[room_id] = event_id
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, dict()
+        for room_id, event_id in pending.items():
+            try:
+                mark_read = lambda: self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+                if self.requests is None:
+                    await mark_read()
+                else:
+                    await self.requests.run("receipt", None, mark_read)
+                self.sent += 1
+            except Exception:
+                self.log.exception(f"Failed to mark {event_id} as read in {room_id}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from mautrix.types import RoomID
+
+# lobby connection of rooms that do not name one, built from the top level ``spring`` settings
+DEFAULT_CONNECTION = "default"
+
+
+class BridgedRoom(NamedTuple):
+    room_id: RoomID
+    channel: str
+    enabled: bool
+    connection: str = DEFAULT_CONNECTION
+
+
+def to_bool(value: Any) -> bool:
+    """
+    Config flags may be YAML booleans or strings such as ``'True'``.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+class RoomRegistry(object):
+    """
+    Bidirectional room_id <-> lobby channel index built once from ``bridge.rooms``.
+
+    Lookups are plain dict hits; an unknown room or channel returns ``None``.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, rooms: Optional[Dict[str, Dict[str, Any]]]) -> None:
+        self.log = logging.getLogger("rooms")
+
+        self._by_room_id: Dict[RoomID, BridgedRoom] = dict()
+        self._by_channel: Dict[str, BridgedRoom] = dict()
+
+        for channel, room_data in (rooms or {}).items():
+            room_id = room_data.get("room_id")
+            if not room_id:
+                self.log.warning(f"Room {channel} has no room_id, skipping")
+                continue
+
+            room = BridgedRoom(room_id=RoomID(room_id),
+                               channel=str(channel),
+                               enabled=to_bool(room_data.get("enabled")),
+                               connection=str(room_data.get("connection") or DEFAULT_CONNECTION))
+
+            self._by_room_id[room.room_id] = room
+            self._by_channel[room.channel] = room
+
+        self._enabled: List[BridgedRoom] = [room for room in self._by_room_id.values() if room.enabled]
+
+    def __len__(self) -> int:
+        return len(self._by_room_id)
+
+    def __iter__(self) -> Iterator[BridgedRoom]:
+        return iter(self._by_room_id.values())
+
+    def __contains__(self, room_id: RoomID) -> bool:
+        return room_id in self._by_room_id
+
+    @property
+    def enabled(self) -> List[BridgedRoom]:
+        return self._enabled
+
+    def by_room_id(self, room_id: RoomID) -> Optional[BridgedRoom]:
+        return self._by_room_id.get(room_id)
+
+    def by_channel(self, channel: str) -> Optional[BridgedRoom]:
+        return self._by_channel.get(channel)
+
+    def connection_of(self, channel: str) -> str:
+        """
+        Name of the lobby connection a channel is bridged through. Channels that are not
+        configured belong to the default connection.
+        """
+        room = self._by_channel.get(channel)
+        return room.connection if room is not None else DEFAULT_CONNECTION
+
+    def on_connection(self, connection: str) -> List[BridgedRoom]:
+        return [room for room in self._by_room_id.values() if room.connection == connection]
+
+    def channel_for(self, room_id: RoomID) -> Optional[str]:
+        """
+        Lobby channel of an enabled bridged room, or ``None``.
+        """
+        room = self._by_room_id.get(room_id)
+        if room is None or not room.enabled:
+            return None
+        return room.channel
+
+    def room_id_for(self, channel: str) -> Optional[RoomID]:
+        """
+        Matrix room of an enabled bridged channel, or ``None``.
+        """
+        room = self._by_channel.get(channel)
+        if room is None or not room.enabled:
+            return None
+        return room.room_id
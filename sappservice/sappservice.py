@@ -19,114 +19,174 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys
-import argparse
 import asyncio
 import logging.config
 import signal
-import traceback
+import time
 
-from typing import Optional, Dict
+from typing import Awaitable, Callable, Dict, Optional
 from urllib.parse import urlparse
 
 import copy
 
 from mautrix.appservice.state_store.asyncpg import PgASStateStore
-from mautrix.bridge import BaseBridgeConfig
 from mautrix.errors import MForbidden
 from mautrix.types import (EventID, RoomID, UserID, Event, EventType, MessageEvent, MessageType,
                            MessageEventContent, StateEvent, Membership, MemberStateEventContent, PresenceState)
 from mautrix.appservice import AppService
 from mautrix.util.async_db import Database
 
-from sappservice.config import Config
+from sappservice import bridge_state, metrics
+from sappservice.appservice import TracedAppService
+from sappservice.config import Config, Settings
+from sappservice.dedupe import Deduplicator
+from sappservice.identity import IdentityMapper
+from sappservice.media import MediaProxy
+from sappservice.profile_cache import ProfileCache
+from sappservice.rooms import RoomRegistry
+from sappservice.sharding import worker_settings
 
 from sappservice.spring_lobby_client import SpringLobbyClient
+from sappservice.util.backoff import Backoff
+from sappservice.util.event_log import SampledLogger
+from sappservice.util.startup import PhaseTimer
 
 
 class Matrix:
     az: AppService
     sl: SpringLobbyClient
-    config: BaseBridgeConfig
+    settings: Settings
+    rooms: RoomRegistry
+    profiles: ProfileCache
+    dedupe: Deduplicator
 
     user_id_prefix: str
     user_id_suffix: str
 
-    def __init__(self, az, sl, config):
+    def __init__(self, az, sl, settings, rooms, profiles, dedupe, media=None):
         self.log = logging.getLogger("matrix.events")
+        self.event_log = SampledLogger(self.log, settings.bridge.debug_sample_rate)
         self.az = az
         self.sl = sl
-        self.config = config
+        self.settings = settings
+        self.rooms = rooms
+        self.profiles = profiles
+        self.dedupe = dedupe
+        self.media = media
+
+        # event type -> handler; events of any other type are dropped unread
+        self.handlers: Dict[str, Callable[[Event], Awaitable[None]]] = dict()
+        self.register(EventType.ROOM_MEMBER, self.handle_member)
+        self.register(EventType.ROOM_MESSAGE, self.handle_message_event)
+        self.register(EventType.STICKER, self.handle_message_event)
+
+    def register(self, event_type: EventType, handler: Callable[[Event], Awaitable[None]]) -> None:
+        self.handlers[event_type.t] = handler
 
     async def handle_message(self, room_id: RoomID, user_id: UserID, message: MessageEventContent,
                              event_id: EventID) -> None:
 
-        self.log.debug(f"message \"{message}\" from {user_id} to {room_id}:")
-
         if message.msgtype == MessageType.TEXT:
             await self.sl.say_from_matrix(user_id, room_id, event_id, message.body)
         elif message.msgtype == MessageType.EMOTE:
             await self.sl.say_from_matrix(user_id, room_id, event_id, message.body, emote=True)
-        elif message.msgtype == MessageType.IMAGE:
-            mxc_url = message.url
-            o = urlparse(mxc_url)
-            domain = o.netloc
-            pic_code = o.path
-            url = f"https://{domain}/_matrix/media/v1/download/{domain}{pic_code}"
-            await self.sl.say_from_matrix(user_id, room_id, event_id, url)
-
-        elif message.msgtype == MessageType.STICKER:
-            mxc_url = message.url
-            o = urlparse(mxc_url)
-            domain = o.netloc
-            pic_code = o.path
-            url = f"https://{domain}/_matrix/media/v1/download/{domain}{pic_code}"
+        elif message.msgtype in (MessageType.IMAGE, MessageType.STICKER):
+            url = await self.media_url(message.url)
             await self.sl.say_from_matrix(user_id, room_id, event_id, url)
 
         else:
-            self.log.debug(f"Unhandled message type {message.msgtype}")
+            self.log.debug("Unhandled message type %s", message.msgtype)
+
+    async def media_url(self, mxc_url) -> str:
+        if self.media is not None:
+            url = await self.media.link(mxc_url)
+            if url is not None:
+                return url
+
+        o = urlparse(mxc_url)
+        domain = o.netloc
+        pic_code = o.path
+        return f"https://{domain}/_matrix/media/v1/download/{domain}{pic_code}"
+
+    def reject(self, event: Event) -> Optional[str]:
+        """
+        Why ``event`` needs no handling, or ``None`` if it does. Only reads the room, type and
+        sender, so dropped events cost a few lookups.
+        """
+        if event.room_id not in self.rooms:
+            return "unbridged_room"
+        if event.type.t not in self.handlers:
+            return "ignored_type"
+        # our puppets' member events still keep the membership mirror current
+        if event.type.t != EventType.ROOM_MEMBER.t and self.sl.identities.is_own(event.sender):
+            return "own_puppet"
+        return None
 
     async def handle_event(self, event: Event) -> None:
 
-        self.log.debug("Handle event")
-
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-
-        event_type: str = event.get("type", "m.unknown")
-        room_id: Optional[RoomID] = event.get("room_id", None)
-        event_id: Optional[EventID] = event.get("event_id", None)
-        sender: Optional[UserID] = event.get("sender", None)
-        content: Dict = event.get("content", {})
+        reason = self.reject(event)
+        if reason is not None:
+            metrics.MATRIX_EVENTS_REJECTED.inc(reason)
+            return
 
-        self.log.debug(f"Event {event}")
+        if self.dedupe.duplicate_event(event.event_id):
+            return
 
-        self.log.debug(f"Event type: {event.type}")
-        self.log.debug(f"Event room_id: {room_id}")
-        self.log.debug(f"Event sender: {sender}")
-        self.log.debug(f"Event content: {content}")
+        sampled = self.event_log.sample()
+        start = time.monotonic()
+        succeeded = False
+
+        try:
+            await self.handlers[event.type.t](event)
+            succeeded = True
+        finally:
+            self.dedupe.event_handled(event.event_id, succeeded)
+            elapsed = time.monotonic() - start
+            event_type = str(event.type)
+            metrics.MATRIX_EVENTS.inc(event_type)
+            metrics.MATRIX_EVENT_SECONDS.observe(elapsed, event_type)
+
+            if sampled:
+                self.event_log.log("Handled event %s", event.event_id,
+                                   room=event.room_id,
+                                   sender=event.sender,
+                                   type=event_type,
+                                   latency_ms=round(elapsed * 1000, 2),
+                                   content=event.content)
+
+    async def handle_member(self, event: StateEvent) -> None:
+        prev_content = event.unsigned.prev_content or MemberStateEventContent()
+        prev_membership = prev_content.membership if prev_content else Membership.JOIN
+
+        user_id = UserID(event.state_key)
+
+        # the mirror follows every membership change, puppets and kicks included; the lobby
+        # only hears about real transitions of users joining or leaving by themselves
+        if event.content.membership == Membership.JOIN:
+            self.profiles.set(user_id, event.content.displayname)
+            changed = self.sl.mirror.matrix_joined(event.room_id, user_id)
+        else:
+            changed = self.sl.mirror.matrix_left(event.room_id, user_id)
 
-        if event.type == EventType.ROOM_MEMBER:
-            event: StateEvent
-            prev_content = event.unsigned.prev_content or MemberStateEventContent()
-            prev_membership = prev_content.membership if prev_content else Membership.JOIN
+        if not changed:
+            return
 
-            if event.content.membership == Membership.LEAVE:
-                if event.sender == event.state_key:
-                    await self.sl.matrix_user_left(UserID(event.state_key), event.room_id, event.event_id)
-            elif event.content.membership == Membership.JOIN:
-                if prev_membership != Membership.JOIN:
-                    await self.sl.matrix_user_joined(UserID(event.state_key), event.room_id, event.event_id)
+        if event.content.membership == Membership.LEAVE:
+            if event.sender == event.state_key:
+                await self.sl.matrix_user_left(user_id, event.room_id, event.event_id)
+        elif event.content.membership == Membership.JOIN:
+            if prev_membership != Membership.JOIN:
+                await self.sl.matrix_user_joined(user_id, event.room_id, event.event_id)
 
-        elif event.type in (EventType.ROOM_MESSAGE, EventType.STICKER):
-            event: MessageEvent
-            if event.type != EventType.ROOM_MESSAGE:
-                event.content.msgtype = MessageType(str(event.type))
-            await self.handle_message(event.room_id, event.sender, event.content, event.event_id)
+    async def handle_message_event(self, event: MessageEvent) -> None:
+        if event.type != EventType.ROOM_MESSAGE:
+            event.content.msgtype = MessageType(str(event.type))
+        await self.handle_message(event.room_id, event.sender, event.content, event.event_id)
 
     async def wait_for_connection(self) -> None:
         self.log.info("Ensuring connectivity to homeserver")
         errors = 0
+        backoff = Backoff(initial=0.5, maximum=10)
         while True:
             try:
                 await self.az.intent.whoami()
@@ -135,15 +195,16 @@ class Matrix:
                 raise
             except Exception:
                 errors += 1
-                if errors <= 6:
-                    self.log.exception("Connection to homeserver failed, retrying in 10 seconds")
-                    await asyncio.sleep(10)
+                if errors <= 10:
+                    delay = backoff.next()
+                    self.log.exception(f"Connection to homeserver failed, retrying in {delay:.1f} seconds")
+                    await asyncio.sleep(delay)
                 else:
                     raise
 
     async def init_as_bot(self) -> None:
         self.log.debug("Initializing appservice bot")
-        displayname = self.config["appservice.bot_displayname"]
+        displayname = self.settings.appservice.bot_displayname
         if displayname:
             try:
                 await self.az.intent.set_displayname(
@@ -151,7 +212,7 @@ class Matrix:
             except Exception:
                 self.log.exception("Failed to set bot displayname")
 
-        avatar = self.config["appservice.bot_avatar"]
+        avatar = self.settings.appservice.bot_avatar
         if avatar:
             try:
                 await self.az.intent.set_avatar_url(avatar if avatar != "remove" else "")
@@ -159,7 +220,7 @@ class Matrix:
                 self.log.exception("Failed to set bot avatar")
 
 
-async def sappservice(config_filename, loop):
+async def sappservice(config_filename, loop, worker: Optional[int] = None):
     config = Config(config_filename, None, None)
     config.load()
 
@@ -170,6 +231,14 @@ async def sappservice(config_filename, loop):
     log.info("Initializing matrix spring lobby appservice")
     log.info(f"Config file: {config_filename}")
 
+    startup = PhaseTimer(log)
+
+    settings = config.snapshot()
+    if worker is not None:
+        settings = worker_settings(settings, worker)
+        log.info(f"Running as worker {worker} for lobby connections "
+                 f"{', '.join(connection.name for connection in settings.spring.connections)}")
+
     # def exception_hook(etype, value, trace):
     #     log.debug(traceback.format_exception(etype, value, trace))
     #
@@ -183,149 +252,290 @@ async def sappservice(config_filename, loop):
 
     mebibyte = 1024 ** 2
 
-    server = config["homeserver.address"]
-    domain = config["homeserver.domain"]
-    verify_ssl = config["homeserver.verify_ssl"]
-
-    as_token = config["appservice.as_token"]
-    hs_token = config["appservice.hs_token"]
+    server = settings.homeserver.address
+    domain = settings.homeserver.domain
+    verify_ssl = settings.homeserver.verify_ssl
 
-    bot_localpart = config["appservice.bot_username"]
-    max_body_size = config["appservice.max_body_size"]
+    as_token = settings.appservice.as_token
+    hs_token = settings.appservice.hs_token
 
-    hostname = config["appservice.hostname"]
-    port = config["appservice.port"]
-    client_name = config["spring.client_name"]
-    rooms = config["bridge.rooms"]
+    bot_localpart = settings.appservice.bot_username
+    max_body_size = settings.appservice.max_body_size
 
-    db = Database(config["appservice.database"])
-    await db.start()
+    hostname = settings.appservice.hostname
+    port = settings.appservice.port
+    lobby_log = SampledLogger(logging.getLogger("lobby.events"), settings.bridge.debug_sample_rate)
+    rooms = RoomRegistry(settings.bridge.rooms)
+    profiles = ProfileCache(max_size=settings.bridge.profile_cache_size,
+                            ttl=settings.bridge.profile_cache_ttl)
 
+    db = Database(settings.appservice.database)
     state_store_db = PgASStateStore(db=db)
-    await state_store_db.upgrade_table.upgrade(db.pool)
-
-    appserv = AppService(server=server,
-                         domain=domain,
-                         verify_ssl=verify_ssl,
-
-                         as_token=as_token,
-                         hs_token=hs_token,
-
-                         bot_localpart=bot_localpart,
-                         loop=loop,
-                         id='appservice',
-
-                         real_user_content_key="org.jauriarts.appservice.puppet",
-                         state_store=state_store_db,
-                         aiohttp_params={"client_max_size": max_body_size * mebibyte})
+    bridge_state_store = bridge_state.BridgeStateStore(db)
+
+    appserv = TracedAppService(server=server,
+                               domain=domain,
+                               verify_ssl=verify_ssl,
+
+                               as_token=as_token,
+                               hs_token=hs_token,
+
+                               bot_localpart=bot_localpart,
+                               loop=loop,
+                               id='appservice',
+
+                               real_user_content_key="org.jauriarts.appservice.puppet",
+                               state_store=state_store_db,
+                               aiohttp_params={"client_max_size": max_body_size * mebibyte},
+                               trace_configs=[metrics.client_trace_config()])
+
+    dedupe = Deduplicator(max_transactions=settings.bridge.dedupe_max_transactions,
+                          max_events=settings.bridge.dedupe_max_events,
+                          ttl=settings.bridge.dedupe_ttl,
+                          store=bridge_state_store if settings.bridge.dedupe_persist else None,
+                          loop=loop)
+    dedupe.install(appserv)
+
+    metrics.install_routes(appserv.app)
+
+    identities = IdentityMapper.from_settings(appserv, settings)
+
+    spring_lobby_client = SpringLobbyClient(appserv, settings, rooms, profiles, identities, bridge_state_store,
+                                            loop=loop)
+
+    metrics.REGISTRY.gauge("sappservice_profile_cache", "Display name cache counters",
+                           lambda: {(key,): value for key, value in profiles.stats().items()}, ("stat",))
+    metrics.REGISTRY.gauge("sappservice_outbound_queue", "Lobby to Matrix send queue counters",
+                           lambda: {(key,): value for key, value in spring_lobby_client.outbound.stats().items()},
+                           ("stat",))
+    metrics.REGISTRY.gauge("sappservice_homeserver_scheduler", "Homeserver request scheduler state",
+                           lambda: {(key,): value for key, value in spring_lobby_client.requests.stats().items()},
+                           ("stat",))
+    metrics.REGISTRY.gauge("sappservice_membership", "Membership mirror sizes",
+                           lambda: {(key,): value for key, value in spring_lobby_client.mirror.stats().items()},
+                           ("stat",))
+    metrics.REGISTRY.gauge("sappservice_presence", "Puppet presence engine counters",
+                           lambda: {(key,): value for key, value in spring_lobby_client.presence.stats().items()},
+                           ("stat",))
+    metrics.REGISTRY.gauge("sappservice_lobby_outbox", "Matrix chat held while a lobby connection is logged out",
+                           lambda: {(key,): value for key, value in spring_lobby_client.outbox.stats().items()},
+                           ("stat",))
+    metrics.REGISTRY.gauge("sappservice_lobby_command_queue", "Lobby command scheduler counters per connection",
+                           lambda: {(name, key): value for name, connection in spring_lobby_client.connections.items()
+                                    for key, value in connection.stats().items()},
+                           ("connection", "stat"))
+
+    media = None
+    if settings.bridge.media_public_url:
+        media = MediaProxy(appserv, bridge_state_store,
+                           homeserver=server,
+                           public_url=settings.bridge.media_public_url,
+                           cache_dir=settings.bridge.media_cache_dir,
+                           max_size=settings.bridge.media_max_size,
+                           thumbnails=settings.bridge.media_thumbnails,
+                           thumbnail_size=settings.bridge.media_thumbnail_size,
+                           loop=loop)
+        media.install(appserv.app)
+        metrics.REGISTRY.gauge("sappservice_media_cache", "Media proxy cache counters",
+                               lambda: {(key,): value for key, value in media.stats().items()}, ("stat",))
+
+    matrix = Matrix(appserv, spring_lobby_client, settings, rooms, profiles, dedupe, media)
 
-    spring_lobby_client = SpringLobbyClient(appserv, config, loop=loop)
+    appserv.matrix_event_handler(matrix.handle_event)
 
-    await db.start()
-    await appserv.start(hostname, port)
-    await spring_lobby_client.start()
+    # set once the homeserver is reachable; the lobby login waits for it
+    matrix_ready = asyncio.Event()
 
     ################
     #
-    # Lobby events
+    # Startup
     #
     ################
 
-    @spring_lobby_client.bot.on("tasserver")
-    async def on_lobby_tasserver(message):
-        log.debug(f"on_lobby_tasserver {message}")
-        if message.client.name == client_name:
-            message.client._login()
-
-    @spring_lobby_client.bot.on("clients")
-    async def on_lobby_clients(message):
-        log.debug(f"on_lobby_clients {message}")
-        if message.client.name != client_name:
-            channel = message.params[0]
-            clients = message.params[1:]
-            await spring_lobby_client.join_matrix_room(channel, clients)
-
-    @spring_lobby_client.bot.on("joined")
-    async def on_lobby_joined(message, user, channel):
-        log.debug(f"LOBBY JOINED user: {user.username} room: {channel}")
-        if user.username != "appservice":
-            await spring_lobby_client.join_matrix_room(channel, [user.username])
-
-    @spring_lobby_client.bot.on("left")
-    async def on_lobby_left(message, user, channel):
-        log.debug(f"LOBBY LEFT user: {user.username} room: {channel}")
-
-        if channel.startswith("__battle__"):
-            return
+    async def start_database():
+        await db.start()
+        await asyncio.gather(state_store_db.upgrade_table.upgrade(db.pool),
+                             bridge_state.upgrade_table.upgrade(db.pool))
+        await dedupe.start()
+        await spring_lobby_client.load_membership()
+        await spring_lobby_client.outbox.start(spring_lobby_client.connections)
+        if media is not None:
+            media.start()
 
-        if user.username == "appservice":
-            return
+    async def start_lobby():
+        # handlers are in place on each connection before its first line is read
+        await spring_lobby_client.start(register_lobby_handlers)
 
-        await spring_lobby_client.leave_matrix_room(channel, [user.username])
-
-    @spring_lobby_client.bot.on("said")
-    async def on_lobby_said(message, user, target, text):
-        if message.client.name == client_name:
-            await spring_lobby_client.said(user, target, text)
-
-    @spring_lobby_client.bot.on("saidex")
-    async def on_lobby_saidex(message, user, target, text):
-        if message.client.name == client_name:
-            await spring_lobby_client.saidex(user, target, text)
-
-    # @spring_lobby_client.bot.on("denied")
-    # async def on_lobby_denied(message):
-    #     return
-    #     # if message.client.name != client_name:
-    #     #    user = message.client.name
-    #     #    await spring_appservice.register(user)
-
-    # @spring_lobby_client.bot.on("adduser")
-    # async def on_lobby_adduser(message):
-    #     if message.client.name != client_name:
-    #         username = message.params[0]
-    #
-    #         if username == "ChanServ":
-    #             return
-    #         if username == "appservice":
-    #             return
-    #
-    #         await spring_lobby_client.login_matrix_account(username)
+    async def start_bot_profile():
+        await asyncio.gather(matrix.init_as_bot(), appserv.intent.set_presence(PresenceState.ONLINE))
 
-    # @spring_lobby_client.bot.on("removeuser")
-    # async def on_lobby_removeuser(message):
-    #     if message.client.name != client_name:
-    #         username = message.params[0]
+    ################
     #
-    #         if username == "ChanServ":
-    #             return
-    #         if username == "appservice":
-    #             return
+    # Lobby events
     #
-    #         await spring_lobby_client.logout_matrix_account(username)
-
-    @spring_lobby_client.bot.on("accepted")
-    async def on_lobby_accepted(message):
-        log.debug(f"message Accepted {message}")
-        await spring_lobby_client.config_rooms()
-        await spring_lobby_client.sync_matrix_users()
-
-    @spring_lobby_client.bot.on("failed")
-    async def on_lobby_failed(message):
-        log.debug(f"message FAILED {message}")
-
-
-    matrix = Matrix(appserv, spring_lobby_client, config)
-
-    appserv.matrix_event_handler(matrix.handle_event)
+    ################
 
-    await matrix.wait_for_connection()
-    await matrix.init_as_bot()
+    # connections that have not logged in yet; startup is reported once all of them have
+    first_login = set(spring_lobby_client.connections)
+
+    def register_lobby_handlers(connection):
+        bot = connection.bot
+        client_name = connection.client_name
+
+        def ours(message) -> bool:
+            # asyncspring signals are process global, so every connection's handlers see every
+            # message; a reconnection swaps the protocol but keeps connection.bot, its wrapper
+            return getattr(message.client, "wrapper", message.client) is connection.bot
+
+        @bot.on("tasserver")
+        async def on_lobby_tasserver(message):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("tasserver")
+            log.debug(f"on_lobby_tasserver {message}")
+            if message.client.name == client_name:
+                await matrix_ready.wait()
+                message.client._login()
+
+        @bot.on("clients")
+        async def on_lobby_clients(message):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("clients")
+            if lobby_log.sample():
+                lobby_log.log("on_lobby_clients", channel=message.params[0], clients=len(message.params) - 1)
+            if message.client.name != client_name:
+                channel = message.params[0]
+                clients = message.params[1:]
+                await spring_lobby_client.join_matrix_room(channel, clients)
+
+        @bot.on("joined")
+        async def on_lobby_joined(message, user, channel):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("joined")
+            if lobby_log.sample():
+                lobby_log.log("LOBBY JOINED", user=user.username, channel=channel)
+            if user.username != "appservice":
+                await spring_lobby_client.join_matrix_room(channel, [user.username])
+
+        @bot.on("left")
+        async def on_lobby_left(message, user, channel):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("left")
+            if lobby_log.sample():
+                lobby_log.log("LOBBY LEFT", user=user.username, channel=channel)
+
+            if channel.startswith("__battle__"):
+                return
+
+            if user.username == "appservice":
+                return
+
+            await spring_lobby_client.leave_matrix_room(channel, [user.username])
+
+        @bot.on("said")
+        async def on_lobby_said(message, user, target, text):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("said")
+            if lobby_log.sample():
+                lobby_log.log("LOBBY SAID", user=user, channel=target, length=len(text))
+            if message.client.name == client_name:
+                await spring_lobby_client.said(user, target, text)
+
+        @bot.on("saidex")
+        async def on_lobby_saidex(message, user, target, text):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("saidex")
+            if lobby_log.sample():
+                lobby_log.log("LOBBY SAIDEX", user=user, channel=target, length=len(text))
+            if message.client.name == client_name:
+                await spring_lobby_client.saidex(user, target, text)
+
+        # @bot.on("denied")
+        # async def on_lobby_denied(message):
+        #     return
+        #     # if message.client.name != client_name:
+        #     #    user = message.client.name
+        #     #    await spring_appservice.register(user)
+
+        @bot.on("adduser")
+        async def on_lobby_adduser(message, *args):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("adduser")
+            username = message.params[0]
+            if username not in ("ChanServ", bot_localpart, connection.settings.bot_username):
+                spring_lobby_client.presence.online(username)
+
+        @bot.on("removeuser")
+        async def on_lobby_removeuser(message, *args):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("removeuser")
+            username = message.params[0]
+            if username not in ("ChanServ", bot_localpart, connection.settings.bot_username):
+                spring_lobby_client.presence.offline(username)
+
+        @bot.on("clientstatus")
+        async def on_lobby_clientstatus(message, *args):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("clientstatus")
+            if len(message.params) >= 2 and message.params[1].isdigit():
+                spring_lobby_client.presence.status(message.params[0], int(message.params[1]))
+
+        @bot.on("accepted")
+        async def on_lobby_accepted(message):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("accepted")
+            log.debug(f"message Accepted {message}")
+            session = connection.session
+            try:
+                if connection.name not in first_login:
+                    await spring_lobby_client.config_rooms(connection)
+                    await spring_lobby_client.sync_matrix_users(connection)
+                else:
+                    suffix = f"[{connection.name}]" if len(spring_lobby_client.connections) > 1 else ""
+                    await startup.run(f"room_joins{suffix}", spring_lobby_client.config_rooms(connection))
+                    await startup.run(f"member_sync{suffix}", spring_lobby_client.sync_matrix_users(connection))
+                    first_login.discard(connection.name)
+                    if not first_login:
+                        startup.report()
+            finally:
+                # chat held while logged out goes behind the member sync, unless the connection
+                # was lost again meanwhile
+                if connection.session == session:
+                    spring_lobby_client.resume(connection)
+
+        @bot.on("failed")
+        async def on_lobby_failed(message):
+            if not ours(message):
+                return
+            metrics.LOBBY_EVENTS.inc("failed")
+            log.debug(f"message FAILED {message}")
+
+
+    # the lobby connection keeps retrying in the background and does not hold up Matrix:
+    # transactions are accepted once the state store is migrated, and chat for a lobby that is
+    # not logged in waits in the outbox
+    lobby_connect = loop.create_task(startup.run("lobby_connect", start_lobby()))
+    await startup.run("database", start_database())
+
+    appserv.trace_configs.append(spring_lobby_client.requests.trace_config())
+    await startup.run("appservice", appserv.start(hostname, port))
+
+    await startup.run("homeserver", matrix.wait_for_connection())
+    matrix_ready.set()
 
     # appservice_account = await appserv.intent.whoami()
     # user = appserv.intent.user(appservice_account)
 
-    await appserv.intent.set_presence(PresenceState.ONLINE)
+    await startup.run("bot_profile", start_bot_profile())
 
     # location = config["homeserver"]["domain"].split(".")[0]
     # external_id = "MatrixAppService"
@@ -350,6 +560,11 @@ async def sappservice(config_filename, loop):
     appserv.ready = True
     log.info("Initialization complete, running startup actions")
 
+    async def shutdown(signame):
+        lobby_connect.cancel()
+        await dedupe.stop()
+        await spring_lobby_client.exit(signame)
+
     for signame in ('SIGINT', 'SIGTERM'):
         loop.add_signal_handler(getattr(signal, signame),
-                                lambda: asyncio.ensure_future(spring_lobby_client.exit(signame)))
+                                lambda: asyncio.ensure_future(shutdown(signame)))
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sharded mode: one front process keeps the appservice endpoint and hands every Matrix event to the
+worker process that owns its room.
+
+A worker is an ordinary bridge limited to the lobby connections assigned to it; it bridges the
+rooms of those connections, drives their puppets and shares the Postgres state store with the
+other workers. The front talks to the workers over loopback HTTP with the appservice protocol
+itself, so a worker handles forwarded transactions exactly as it would handle the homeserver.
+"""
+
+import asyncio
+import copy
+import logging
+import logging.config
+import signal
+import sys
+
+from typing import Dict, Mapping, Optional, Sequence, Set, Tuple
+
+import aiohttp
+
+from aiohttp import web
+from mautrix.appservice.state_store.asyncpg import PgASStateStore
+from mautrix.types import RoomID
+from mautrix.util.async_db import Database
+
+from sappservice import bridge_state
+from sappservice.config import Config, Settings
+from sappservice.rooms import DEFAULT_CONNECTION, RoomRegistry
+from sappservice.util.backoff import Backoff
+
+# event lists of a transaction that are routed by room
+EVENT_KEYS = ("events", "de.sorunome.msc2409.ephemeral")
+
+# headers passed through to the default worker and back, so media links keep ranges and caching
+PROXY_REQUEST_HEADERS = frozenset(("authorization", "content-type", "accept", "accept-encoding", "range",
+                                   "if-range", "if-none-match", "if-modified-since"))
+PROXY_RESPONSE_HEADERS = frozenset(("content-type", "content-length", "content-encoding", "content-range",
+                                    "content-disposition", "accept-ranges", "etag", "last-modified",
+                                    "cache-control"))
+PROXY_CHUNK_SIZE = 64 * 1024
+
+
+def load_settings(config_filename: str) -> Tuple[Config, Settings]:
+    config = Config(config_filename, None, None)
+    config.load()
+    return config, config.snapshot()
+
+
+def plan(connections: Sequence[str], workers: int, assignment: Mapping[str, int]) -> Dict[str, int]:
+    """
+    Worker index of every lobby connection. Connections without an explicit assignment are
+    spread round-robin in config order.
+    """
+    if workers > len(connections):
+        raise ValueError(f"{workers} workers for {len(connections)} lobby connections")
+    workers = max(1, workers)
+    result = dict()
+    unassigned = 0
+    for name in connections:
+        if name in assignment and assignment[name] < workers:
+            result[name] = assignment[name]
+        else:
+            result[name] = unassigned % workers
+            unassigned += 1
+    return result
+
+
+def worker_settings(settings: Settings, index: int) -> Settings:
+    """
+    ``settings`` as seen by worker ``index``: only its own lobby connections, and the appservice
+    endpoint on its loopback port. The room config stays complete, so every worker knows which
+    connection any channel belongs to.
+    """
+    owners = plan([connection.name for connection in settings.spring.connections],
+                  settings.bridge.sharding_workers, settings.bridge.sharding_assignment)
+    return settings._replace(
+        spring=settings.spring._replace(connections=tuple(connection for connection in settings.spring.connections
+                                                          if owners[connection.name] == index)),
+        appservice=settings.appservice._replace(hostname="127.0.0.1",
+                                                port=settings.bridge.sharding_base_port + index),
+    )
+
+
+class _Worker(object):
+    __slots__ = ("index", "connections", "process", "task", "stopping")
+
+    def __init__(self, index: int, connections: Set[str]) -> None:
+        self.index = index
+        self.connections = connections
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+
+
+class ShardFront(object):
+    """
+    The appservice endpoint of a sharded bridge.
+
+    Each transaction is split by room and every worker gets the part for its rooms, under the same
+    transaction ID; the homeserver is only answered once all of them accepted their part, so a
+    failed worker makes the homeserver retry and the workers that already have the transaction
+    drop it as a duplicate. Events of rooms that are not bridged go to the worker owning the
+    default connection, which also answers user and alias queries.
+
+    Workers that exit are restarted with backoff. ``SIGHUP`` reloads the config and moves
+    connections and their rooms to the workers it now assigns them to.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, config_filename: str, loop: asyncio.AbstractEventLoop) -> None:
+        self.config_filename = config_filename
+        self.loop = loop
+        self.log = logging.getLogger("sharding")
+
+        config, self.settings = load_settings(config_filename)
+        logging.config.dictConfig(copy.deepcopy(config["logging"]))
+
+        self.workers: Dict[int, _Worker] = dict()
+        self.routes: Dict[RoomID, int] = dict()
+        self.default_worker = 0
+
+        self.app = web.Application(client_max_size=self.settings.appservice.max_body_size * 1024 ** 2)
+        for prefix in ("", "/_matrix/app/v1"):
+            self.app.router.add_route("PUT", f"{prefix}/transactions/{{transaction_id}}", self._transaction)
+        self.app.router.add_route("*", "/{tail:.*}", self._proxy)
+
+        self.runner: Optional[web.AppRunner] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._stopping = False
+
+    def _assignment(self, settings: Settings) -> Dict[int, Set[str]]:
+        owners = plan([connection.name for connection in settings.spring.connections],
+                      settings.bridge.sharding_workers, settings.bridge.sharding_assignment)
+        workers: Dict[int, Set[str]] = dict()
+        for name, index in owners.items():
+            workers.setdefault(index, set()).add(name)
+        return workers
+
+    def _route(self, settings: Settings, assignment: Dict[int, Set[str]]) -> None:
+        owner = {name: index for index, names in assignment.items() for name in names}
+        self.routes = {room.room_id: owner[room.connection] for room in RoomRegistry(settings.bridge.rooms)}
+        self.default_worker = owner[DEFAULT_CONNECTION]
+
+    def _url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{self.settings.bridge.sharding_base_port + index}{path}"
+
+    async def _migrate(self) -> None:
+        # once here, rather than racing in every worker
+        db = Database(self.settings.appservice.database)
+        await db.start()
+        try:
+            await PgASStateStore.upgrade_table.upgrade(db.pool)
+            await bridge_state.upgrade_table.upgrade(db.pool)
+        finally:
+            await db.stop()
+
+    async def start(self) -> None:
+        self.log.info(f"Starting sharded appservice front, config file {self.config_filename}")
+        await self._migrate()
+
+        assignment = self._assignment(self.settings)
+        self._route(self.settings, assignment)
+        for index, connections in sorted(assignment.items()):
+            self._start_worker(index, connections)
+
+        # proxied bodies are passed on as they are, still encoded
+        self.session = aiohttp.ClientSession(auto_decompress=False)
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.settings.appservice.hostname, self.settings.appservice.port).start()
+
+        self.loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rebalance()))
+        for signame in ("SIGINT", "SIGTERM"):
+            self.loop.add_signal_handler(getattr(signal, signame), lambda: asyncio.ensure_future(self.stop()))
+
+        self.log.info(f"Front listening on {self.settings.appservice.hostname}:{self.settings.appservice.port} "
+                      f"with {len(self.workers)} workers")
+
+    # workers
+
+    def _start_worker(self, index: int, connections: Set[str]) -> None:
+        worker = self.workers[index] = _Worker(index, connections)
+        worker.task = self.loop.create_task(self._supervise(worker))
+
+    async def _supervise(self, worker: _Worker) -> None:
+        backoff = Backoff(initial=1, maximum=60)
+        while not worker.stopping:
+            self.log.info(f"Starting worker {worker.index} for connections {', '.join(sorted(worker.connections))}")
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "sappservice", "-c", self.config_filename, "--worker", str(worker.index))
+            code = await worker.process.wait()
+            if worker.stopping:
+                break
+            delay = backoff.next()
+            self.log.error(f"Worker {worker.index} exited with {code}, restarting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _stop_worker(self, worker: _Worker, timeout: float = 30) -> None:
+        worker.stopping = True
+        process = worker.process
+        if process is not None and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.log.warning(f"Worker {worker.index} did not stop in {timeout}s, killing it")
+                process.kill()
+                await process.wait()
+        if worker.task is not None:
+            worker.task.cancel()
+
+    async def rebalance(self) -> None:
+        """
+        Reload the config and apply its worker assignment. Workers whose connections change are
+        stopped before any worker takes their connections over, so no lobby account is ever
+        logged in twice.
+        """
+        try:
+            _, settings = load_settings(self.config_filename)
+        except Exception:
+            self.log.exception("Not rebalancing, the config does not load")
+            return
+
+        assignment = self._assignment(settings)
+        changed = [worker for index, worker in self.workers.items() if assignment.get(index) != worker.connections]
+        started = [index for index, connections in assignment.items()
+                   if index not in self.workers or self.workers[index].connections != connections]
+
+        self.log.info(f"Rebalancing: restarting workers {sorted(started)}, "
+                      f"stopping {sorted(worker.index for worker in changed)}")
+
+        await asyncio.gather(*(self._stop_worker(worker) for worker in changed))
+        for worker in changed:
+            del self.workers[worker.index]
+
+        self.settings = settings
+        self._route(settings, assignment)
+        for index in started:
+            self._start_worker(index, assignment[index])
+
+    async def stop(self) -> None:
+        if self._stopping:
+            return
+        self._stopping = True
+        self.log.info("Stopping workers")
+        await asyncio.gather(*(self._stop_worker(worker) for worker in self.workers.values()))
+        if self.runner is not None:
+            await self.runner.cleanup()
+        if self.session is not None:
+            await self.session.close()
+        self.loop.stop()
+
+    # HTTP
+
+    def _authorized(self, request: web.Request) -> bool:
+        token = request.rel_url.query.get("access_token")
+        if token is None:
+            header = request.headers.get("Authorization", "")
+            token = header[len("Bearer "):] if header.startswith("Bearer ") else None
+        return token == self.settings.appservice.hs_token
+
+    def _split(self, body: Dict) -> Dict[int, Dict]:
+        parts: Dict[int, Dict] = dict()
+        for key in EVENT_KEYS:
+            for event in body.get(key) or ():
+                index = self.routes.get(event.get("room_id"), self.default_worker)
+                parts.setdefault(index, {key: [] for key in EVENT_KEYS if key in body})[key].append(event)
+        return parts
+
+    async def _forward(self, index: int, transaction_id: str, part: Dict) -> bool:
+        try:
+            async with self.session.put(self._url(index, f"/transactions/{transaction_id}"),
+                                        params={"access_token": self.settings.appservice.hs_token},
+                                        json=part) as response:
+                if response.status < 300:
+                    return True
+                self.log.warning(f"Worker {index} refused transaction {transaction_id}: {response.status}")
+        except aiohttp.ClientError as e:
+            self.log.warning(f"Worker {index} unreachable for transaction {transaction_id}: {e}")
+        return False
+
+    async def _transaction(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.json_response({"error": "Invalid auth token"}, status=401)
+
+        transaction_id = request.match_info["transaction_id"]
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"error": "Body is not JSON"}, status=400)
+
+        parts = self._split(body)
+        results = await asyncio.gather(*(self._forward(index, transaction_id, part)
+                                         for index, part in parts.items()))
+        if not all(results):
+            # the homeserver retries the whole transaction, workers that have it drop it
+            return web.json_response({"error": "A bridge worker is unavailable"}, status=503)
+        return web.json_response({})
+
+    async def _proxy(self, request: web.Request) -> web.StreamResponse:
+        headers = {key: value for key, value in request.headers.items() if key.lower() in PROXY_REQUEST_HEADERS}
+        proxied = None
+        try:
+            async with self.session.request(request.method, self._url(self.default_worker, request.rel_url.path),
+                                            params=request.rel_url.query, headers=headers,
+                                            data=request.content if request.can_read_body else None) as response:
+                headers = {key: value for key, value in response.headers.items()
+                           if key.lower() in PROXY_RESPONSE_HEADERS}
+                if request.method == "HEAD" or response.status in (204, 304):
+                    return web.Response(status=response.status, reason=response.reason, headers=headers)
+                proxied = web.StreamResponse(status=response.status, reason=response.reason, headers=headers)
+                await proxied.prepare(request)
+                async for chunk in response.content.iter_chunked(PROXY_CHUNK_SIZE):
+                    await proxied.write(chunk)
+                await proxied.write_eof()
+                return proxied
+        except aiohttp.ClientError as e:
+            self.log.warning(f"Worker {self.default_worker} unreachable for {request.rel_url.path}: {e}")
+            if proxied is not None and proxied.prepared:
+                # the status line is out already, the client sees a short body
+                return proxied
+            return web.json_response({"error": "Bridge worker unavailable"}, status=503)
+
+
+def sharded(config_filename: str) -> bool:
+    _, settings = load_settings(config_filename)
+    return settings.bridge.sharding_workers > 0
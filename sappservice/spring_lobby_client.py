@@ -22,89 +22,144 @@ import asyncio
 import logging
 import sys
 
-import re
+from typing import Dict, Optional
 
-from asyncblink import signal as asignal
-
-from asyncspring.lobby import LobbyProtocol, LobbyProtocolWrapper, connections
 from mautrix.appservice import AppService
-from mautrix.errors import MNotFound, MUnknown
-from mautrix.types import PresenceState, UserID, RoomID, Member, Membership
+from mautrix.errors import MUnknown
+
+from sappservice.bridge_state import BridgeStateStore
+from sappservice.config import Settings
+from sappservice.homeserver_scheduler import HomeserverScheduler
+from sappservice.identity import IdentityMapper, MAX_LENGTH
+from sappservice.lobby_connection import LobbyConnection
+from sappservice.lobby_scheduler import BULK
+from sappservice.lobby_writer import MAX_LINE_BYTES, split_message
+from sappservice.membership import MembershipMirror
+from sappservice.metrics import LOBBY_COMMANDS
+from sappservice.outbound import OutboundScheduler
+from sappservice.outbox import LobbyOutbox, OutboxEntry
+from sappservice.presence import PresenceEngine
+from sappservice.profile_cache import ProfileCache
+from sappservice.receipts import ReceiptCoalescer
+from sappservice.rooms import DEFAULT_CONNECTION, RoomRegistry
+from sappservice.sync import MatrixUserSync
 
 
 class SpringLobbyClient(object):
     log: logging.Logger
     appserv: AppService
+    settings: Settings
+    rooms: RoomRegistry
+    profiles: ProfileCache
+    identities: IdentityMapper
+    bridge_state: BridgeStateStore
+    connections: Dict[str, LobbyConnection]
 
-    def __init__(self, appserv, config, loop):
+    def __init__(self, appserv, settings, rooms, profiles, identities, bridge_state, loop):
 
         self.log: logging.Logger = logging.getLogger("lobby")
 
-        self.config = config
+        self.settings = settings
 
-        self.bot = None
         self.appserv = appserv
-        self.presence_timmer = None
-        self.bot_username = self.config["spring.bot_username"]
-        self.bot_password = self.config["spring.bot_password"]
-        self.client_flags = self.config["spring.client_flags"]
-        self.server = self.config["spring.address"]
-        self.port = self.config["spring.port"]
-        self.use_ssl = self.config["spring.ssl"]
-        self.client_name = self.config["spring.client_name"]
-        self.rooms = self.config["bridge.rooms"]
-        self.enabled_rooms = list()
+        self.rooms = rooms
+        self.profiles = profiles
+        self.identities = identities
+        self.bridge_state = bridge_state
+        self.enabled_rooms = set()
+        # the default connection first
+        self.connections = {connection.name: LobbyConnection(connection, settings, rooms, loop)
+                            for connection in settings.spring.connections}
+        self.mirror = MembershipMirror()
+        self.user_sync = MatrixUserSync(appserv, rooms, profiles, identities, store=bridge_state, mirror=self.mirror,
+                                        concurrency=settings.bridge.sync_concurrency)
+        self.requests = HomeserverScheduler(settings.appservice.bot_mxid,
+                                            concurrency=settings.bridge.homeserver_concurrency,
+                                            max_retries=settings.bridge.homeserver_max_retries,
+                                            loop=loop)
+        self.outbound = OutboundScheduler(identities,
+                                          max_depth=settings.bridge.outbound_max_depth,
+                                          merge_window=settings.bridge.outbound_merge_window,
+                                          requests=self.requests,
+                                          loop=loop)
+        self.presence = PresenceEngine(identities, self.mirror,
+                                       requests=self.requests,
+                                       interval=settings.bridge.presence_interval,
+                                       flap_window=settings.bridge.presence_flap_window,
+                                       slots=settings.bridge.presence_slots,
+                                       loop=loop)
+        self.outbox = LobbyOutbox(max_size=settings.bridge.outbox_max_size,
+                                  max_age=settings.bridge.outbox_max_age,
+                                  store=bridge_state if settings.bridge.outbox_persist else None,
+                                  loop=loop)
+        self.receipts = ReceiptCoalescer(appserv,
+                                         interval=settings.bridge.receipt_interval,
+                                         requests=self.requests,
+                                         loop=loop)
 
         self.loop = loop
 
-    async def start(self):
+    async def start(self, on_connected=None):
+        """
+        Connect every lobby connection concurrently. ``on_connected(connection)`` runs as soon as
+        each one is connected, before it reads its first line.
+        """
 
         self.log.info("Starting Spring lobby client")
 
-        server = self.server
-        port = self.port
-        use_ssl = self.use_ssl
-        client_name = self.client_name
+        self.receipts.start()
+        if self.settings.bridge.presence_enabled:
+            self.presence.start()
 
-        await self.appserv.intent.set_presence(PresenceState.ONLINE)
+        await asyncio.gather(*(connection.start(on_connected) for connection in self.connections.values()))
 
-        self.bot = await self.connect(server=server,
-                                      port=port,
-                                      use_ssl=use_ssl,
-                                      name=client_name)
+    def connection_for(self, channel) -> Optional[LobbyConnection]:
+        """
+        The lobby connection that carries ``channel``, or ``None`` when it belongs to another
+        worker of a sharded bridge.
+        """
+        return self.connections.get(self.rooms.connection_of(channel))
 
-        self.log.debug("### Channels to join ###")
-        for room_name, room_data in self.rooms.items():
-            if room_data['enabled'] is True:
-                self.log.debug(f"Join {room_name}")
-                self.bot.channels_to_join.append(room_name)
-            else:
-                self.log.debug(f"Not join {room_name}")
+    async def config_rooms(self, connection: LobbyConnection):
 
-    async def config_rooms(self):
+        self.log.debug(f"### CONFIG ROOMS {connection.name} ###")
 
-        self.log.debug("### CONFIG ROOMS ###")
+        rooms = self.rooms.on_connection(connection.name)
 
-        for room_name, room_data in self.rooms.items():
-            channel = f"#{room_name}"
-            room_id = room_data["room_id"],
-            room_enabled = room_data["enabled"]
+        connection.logged_in()
 
-            self.log.info(f"{room_enabled} channel : {channel} room_name : {room_name} room_id : {room_id}")
-            if room_enabled is True:
-                self.bot.channels_to_join.append(channel)
-                await self.appserv.intent.join_room(room_id[0])
-                self.enabled_rooms.append(room_id[0])
-            else:
-                try:
-                    await self.appserv.intent.leave_room(room_id[0])
-                    self.log.debug("Appservice leaves this room")
-                except MUnknown as mu:
-                    self.log.debug("Appservice not in this room")
+        # a new session lists the members of every channel again, and has none of our clients
+        # until the member sync announces them
+        self.mirror.lobby_reset(room.channel for room in rooms)
+        self.mirror.unbridge(connection.name)
+
+        await asyncio.gather(*(self._config_room(room) for room in rooms))
+
+    async def _config_room(self, room):
+        self.log.info(f"{room.enabled} channel : {room.channel} room_id : {room.room_id}")
+        if room.enabled:
+            try:
+                await self.appserv.intent.join_room(room.room_id)
+                self.enabled_rooms.add(room.room_id)
+            except Exception:
+                self.log.exception(f"Failed to join {room.room_id}")
+        else:
+            try:
+                await self.appserv.intent.leave_room(room.room_id)
+                self.log.debug("Appservice leaves this room")
+            except MUnknown:
+                self.log.debug("Appservice not in this room")
 
-    async def _presence_timer(self, user):
-        self.log.debug(f"SET presence timmer for user : {user}")
-        user.set_presence(PresenceState.ONLINE)
+    async def load_membership(self):
+        """
+        Seed the membership mirror from the state store, so decisions made before the first
+        member sync do not need the homeserver.
+        """
+        for connection in self.connections.values():
+            rooms = [room.room_id for room in self.rooms.enabled if room.connection == connection.name]
+            members = await self.bridge_state.joined_members(rooms) if rooms else dict()
+            self.mirror.load(members, {}, connection.name)
+        self.log.debug(f"Membership mirror loaded: {self.mirror.stats()}")
 
     async def leave_matrix_rooms(self, username):
         user = self.appserv.intent.user(username)
@@ -114,7 +169,7 @@ class SpringLobbyClient(object):
     async def login_matrix_account(self, user_name):
 
         self.log.debug(f"User {user_name} joined from lobby")
-        domain = self.config['homeserver.domain']
+        domain = self.settings.homeserver.domain
 
         # namespace = self.config['appservice.namespace']
         # matrix_id = f"@{namespace}_{user_name.lower()}:{domain}"
@@ -125,24 +180,23 @@ class SpringLobbyClient(object):
         #
         # self.presence_timmer = asyncio.get_event_loop().call_later(29, self._presence_timer, user)
 
-        self.bot.bridged_client_from(domain, user_name.lower, user_name)
+        self.connections[DEFAULT_CONNECTION].membership.bridged_client_from(domain, user_name.lower, user_name)
+        LOBBY_COMMANDS.inc("BRIDGECLIENTFROM")
 
     async def logout_matrix_account(self, user_name):
         self.log.debug(f"User {user_name} leave lobby")
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-        matrix_id = f"@{namespace}_{user_name.lower()}:{domain}"
-        user = self.appserv.intent.user(UserID(matrix_id))
+        domain = self.settings.homeserver.domain
+        user = self.identities.puppet(user_name)
 
-        rooms = await user.get_joined_rooms()
-
-        for room_id in rooms:
+        for room_id in self.mirror.rooms_of(user.mxid):
             await user.leave_room(room_id=room_id)
+            self.mirror.matrix_left(room_id, user.mxid)
 
         # await user.set_presence("offline")
         # self.presence_timmer.cancel()
-        self.bot.un_bridged_client_from(domain, user_name)
+        self.connections[DEFAULT_CONNECTION].membership.un_bridged_client_from(domain, user_name)
+        LOBBY_COMMANDS.inc("UNBRIDGECLIENTFROM")
 
     # async def clean_matrix_rooms(self):
     #
@@ -162,182 +216,76 @@ class SpringLobbyClient(object):
     #                 user = self.appserv.intent.user(user=member)
     #                 await user.leave_room(room_id)
 
-    async def sync_matrix_users(self) -> None:
-        self.log.debug("Sync matrix users")
-
-        bot_username = self.config["appservice.bot_username"]
-
-        for room_name, room_data in self.rooms.items():
-            spring_room = room_data.get('name')
-            room_id = RoomID(room_data.get("room_id"))
-            enabled = room_data.get("enabled")
+    async def sync_matrix_users(self, connection: LobbyConnection) -> None:
+        await self.user_sync.run(connection.bulk, connection.name)
 
-            if enabled:
-                self.log.debug(f"Room {spring_room} enabled")
-                await self.appserv.intent.ensure_joined(room_id=room_id)
-                members = await self.appserv.intent.get_room_members(room_id)
-
-                for mxid in members:
-
-                    self.log.debug(f"member {mxid}")
-
-                    member = await self.appserv.intent.get_room_member_info(room_id=room_id, user_id=mxid)
-
-                    if mxid.startswith(f"@{bot_username}"):
-                        self.log.debug(f"Ignore myself {mxid}")
+    async def join_matrix_room(self, room, clients):
+        self.log.debug("joining matrix room join from lobby")
+        self.log.debug(room)
 
-                    elif mxid.startswith(f"@{self.config['appservice.namespace']}_"):
-                        self.log.debug(f"Ignoring local user {mxid}")
-                    else:
-                        self.log.debug(f"Loging user {mxid}")
-                        await self.appserv.state_store.set_member(room_id, mxid, member)
-            else:
-                self.log.debug(f"Room {spring_room} disabled")
+        room_id = self.rooms.room_id_for(room)
+        if room_id is None:
+            self.log.debug(f"Channel {room} is not bridged")
+            return
 
-        self.log.debug("Start bridging users")
+        self.mirror.lobby_joined(room, clients)
 
-        bridged_clients = list()
-        for room_name, room_data in self.rooms.items():
-            enabled = room_data.get("enabled")
-            if enabled:
-                room_id = RoomID(room_data.get("room_id"))
-                room_users = await self.appserv.intent.get_room_members(room_id)
-                for user in room_users:
-                    bridged_clients.append(user)
+        puppets = {client: self.identities.puppet(client) for client in clients if client != "appservice"}
+        pending = [user for user in puppets.values() if not self.mirror.in_room(room_id, user.mxid)]
+        self.log.debug(f"{len(puppets) - len(pending)} of {len(puppets)} lobby users already in {room}")
 
-        for member in list(set(bridged_clients)):
-            self.log.debug(f"User {member}")
-            localpart, domain = self.appserv.intent.parse_user_id(member)
+        async def join(user):
+            # ensure_joined registers the puppet first if needed and falls back to an invite
+            await user.ensure_joined(room_id)
+            self.mirror.matrix_joined(room_id, user.mxid)
 
-            if localpart == "_discord_bot":
-                continue
+        await self._for_each_puppet("join", pending, join)
 
-            try:
-                displayname = await self.appserv.intent.get_displayname(UserID(member))
-            except Exception as nf:
-                self.log.error(f"user {localpart} has no profile {nf}")
-                displayname = localpart
-
-            if localpart.startswith("_discord_"):
-                localpart = localpart.lstrip("_discord_")
-                domain = "discord"
-            elif localpart.startswith("freenode_"):
-                localpart = localpart.lstrip("freenode_")
-                domain = "freenode.org"
-            elif localpart.startswith("spring_"):
-                localpart = localpart.lstrip("spring_")
-                domain = "springlobby"
-
-            if len(displayname) > 15:
-                displayname = displayname[:15]
-            if len(localpart) > 15:
-                localpart = localpart[:15]
-            if len(domain) > 15:
-                domain = domain[:15]
-
-            domain = domain.replace('-', '_')
-
-            self.log.debug(
-                f"Bridging user {member} for {domain} externalID {localpart} externalUsername {displayname}")
-            self.bot.bridged_client_from(domain, localpart.lower(), displayname)
-
-        self.log.debug("Users bridged")
-        self.log.debug("Join matrix users")
-
-        for room_name, room_data in self.rooms.items():
-            enabled = room_data.get("enabled")
-            if enabled:
-                room_id = RoomID(room_data.get("room_id"))
-                room_users = await self.appserv.intent.get_room_members(room_id)
-
-                for member in room_users:
-
-                    self.log.debug(f"\tMember: {member}")
-
-                    localpart, user_domain = self.appserv.intent.parse_user_id(UserID(member))
-
-                    self.log.debug(f"\t\tdetails: {localpart} {user_domain}")
-
-                    if localpart == self.config["appservice.bot_username"]:
-                        self.log.debug(f"Not bridging the local appservice")
-                        continue
-                    elif localpart == "_discord_bot":
-                        self.log.debug(f"Not bridging the discord appservice")
-                        continue
-
-                    if localpart.startswith(self.config["appservice.namespace"]):
-                        self.log.debug(f"Ignoring local user {localpart}")
-                        continue
-                    elif localpart.startswith("_discord_"):
-                        localpart = localpart.lstrip("_discord_")
-                        user_domain = "discord"
-                    elif localpart.startswith("freenode_"):
-                        localpart = localpart.lstrip("freenode_")
-                        user_domain = "freenode.org"
-                    elif localpart.startswith("spring"):
-                        localpart = localpart.lstrip("spring_")
-                        user_domain = "springlobby"
-
-                    try:
-                        displayname = await self.appserv.intent.get_displayname(UserID(member))
-                    except Exception as nf:
-                        self.log.error(f"user {localpart} has no profile {nf}")
-                        displayname = localpart
-
-                    if len(displayname) > 15:
-                        displayname = displayname[:15]
-                    if len(localpart) > 15:
-                        localpart = localpart[:15]
-                    if len(user_domain) > 15:
-                        self.log.debug("user domain too long")
-                        user_domain = user_domain[:15]
-
-                    self.log.debug(f"user_name = {localpart}")
-                    self.log.debug(f"display_name = {displayname}")
-                    self.log.debug(f"domain = {user_domain}")
-
-                    for _, room in self.rooms.items():
-                        if room["room_id"] == room_id:
-                            self.log.debug(f"Join channel {room.get('name')}, user {localpart}, domain {user_domain}")
-                            self.bot.join_from(room["name"], user_domain, localpart)
+        for client, user in puppets.items():
+            if self.mirror.in_room(room_id, user.mxid):
+                self.presence.joined(client)
 
-    async def join_matrix_room(self, room, clients):
-        self.log.debug("joining matrix room join from lobby")
+    async def leave_matrix_room(self, room, clients):
+        self.log.debug("leaving matrix room left from lobby")
         self.log.debug(room)
 
-        room_id = self.rooms[room]["room_id"]
+        room_id = self.rooms.room_id_for(room)
+        if room_id is None:
+            self.log.debug(f"Channel {room} is not bridged")
+            return
+
         for client in clients:
-            if client != "appservice":
-                domain = self.config['homeserver.domain']
-                namespace = self.config['appservice.namespace']
-                matrix_id = f"@{namespace}_{client.lower()}:{domain}"
-                user = self.appserv.intent.user(UserID(matrix_id))
+            self.mirror.lobby_left(room, client)
 
-                await user.join_room_by_id(room_id=room_id)
+        puppets = {client: self.identities.puppet(client) for client in clients if client != "spring"}
+        pending = [user for user in puppets.values() if self.mirror.in_room(room_id, user.mxid)]
 
-    async def leave_matrix_room(self, room, clients):
-        self.log.debug("leaving matrix room left from lobby")
-        self.log.debug(room)
-        for client in clients:
-            self.log.debug(client)
-            if client != "spring":
-                self.log.debug(f"CLIENT {client}")
+        async def leave(user):
+            await user.leave_room(room_id=room_id)
+            self.mirror.matrix_left(room_id, user.mxid)
 
-                domain = self.config['homeserver.domain']
-                namespace = self.config['appservice.namespace']
+        await self._for_each_puppet("leave", pending, leave)
 
-                matrix_id = f"@{namespace}_{client.lower()}:{domain}"
-                self.log.debug(matrix_id)
+        self.log.debug("succes leaved matrix room left from lobby")
 
-                room_id = RoomID(self.rooms[room]["room_id"])
-                self.log.debug(room_id)
+    async def _for_each_puppet(self, endpoint, puppets, action):
+        """
+        Run ``action(puppet)`` for every puppet, as many at a time as the scheduler allows for
+        ``endpoint``. A failure is logged and does not stop the others.
+        """
+        if not puppets:
+            return
 
-                user = self.appserv.intent.user(user_id=UserID(matrix_id))
+        remaining = iter(puppets)
 
-                self.log.debug(user)
-                await user.leave_room(room_id=room_id)
+        async def worker():
+            for user in remaining:
+                try:
+                    await self.requests.run(endpoint, user.mxid, lambda: action(user))
+                except Exception:
+                    self.log.exception(f"{endpoint} failed for {user.mxid}")
 
-        self.log.debug("succes leaved matrix room left from lobby")
+        await asyncio.gather(*(worker() for _ in range(min(len(puppets), self.requests.limit(endpoint)))))
 
     #
     # async def create_matrix_room(self, room):
@@ -355,184 +303,149 @@ class SpringLobbyClient(object):
     #
     async def said(self, user, room, message):
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-
-        matrix_id = f"@{namespace}_{user.lower()}:{domain}"
-
-        room_id = self.rooms[room]["room_id"]
-
-        user = self.appserv.intent.user(UserID(matrix_id))
+        room_id = self.rooms.room_id_for(room)
+        if room_id is None:
+            return
 
-        await user.send_text(room_id, message)
+        self.outbound.send(room_id, user, message)
 
     async def saidex(self, user, room, message):
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-
-        matrix_id = f"@{namespace}_{user.lower()}:{domain}"
-
-        room_id = self.rooms[room]["room_id"]
-
-        user = self.appserv.intent.user(UserID(matrix_id))
+        room_id = self.rooms.room_id_for(room)
+        if room_id is None:
+            return
 
-        await user.send_emote(room_id, message)
+        self.outbound.send(room_id, user, message, emote=True)
 
     async def matrix_user_joined(self, user_id, room_id, event_id=None):
         """
         Matrix user Joins the room
         """
 
-        hs_domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-        bot_username = self.config["appservice.bot_username"]
-
-        if user_id == f"@{bot_username}:{hs_domain}":
-            self.log.debug(f"Appservice joined {room_id}")
-            return
-        elif user_id.startswith(f"@{namespace}_") and user_id.endswith(f":{hs_domain}"):
+        # the appservice bot, our own puppets and ignored bridges have no lobby identity
+        identity = self.identities.lobby_identity(user_id)
+        if identity is None:
             self.log.debug(f"Local user {user_id} joined room_id {room_id} ignoring")
             return
 
         # obtain the spring room name from config
-        channel = None
-        for room in self.rooms:
-            if self.rooms[room]["room_id"] == room_id:
-                channel = room
-
-        user_domain = self.appserv.intent.user(user_id=user_id).domain
-        user_name = self.appserv.intent.user(user_id=user_id).localpart
-
-        # check is is the our appservice bot
-        if user_name == self.config["appservice.bot_username"] and user_domain == self.config["homeserver.domain"]:
+        channel = self.rooms.channel_for(room_id)
+        if channel is None:
+            self.log.debug(f"Room {room_id} is not bridged")
             return
 
+        user_domain, user_name = identity
+
         self.log.debug(f"Matrix user {user_name} joined room {room_id}")
         if event_id:
-            await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+            self.receipts.mark(room_id, event_id)
 
         if user_name and user_domain:
-            display_name = await self.appserv.intent.get_displayname(user_id=user_id)
-
-            self.bot.bridged_client_from(user_domain, user_name.lower(), display_name)  # TODO check if already bridged
-            self.log.debug(f"Matrix user {user_name} bridged")
-
-            self.bot.join_from(channel, user_domain, user_name)
+            display_name = await self.profiles.get_displayname(self.appserv.intent, user_id)
+            bridged_as = (display_name or user_name)[:MAX_LENGTH]
+            connection = self.connection_for(channel)
+            if connection is None:
+                return
+
+            if self.mirror.bridge(user_id, bridged_as, connection.name):
+                connection.membership.bridged_client_from(user_domain, user_name, bridged_as)
+                LOBBY_COMMANDS.inc("BRIDGECLIENTFROM")
+                self.log.debug(f"Matrix user {user_name} bridged")
+
+            connection.membership.join_from(channel, user_domain, user_name)
+            LOBBY_COMMANDS.inc("JOINFROM")
             self.log.debug(f"Matrix user {user_name} joined {channel}")
 
     async def matrix_user_left(self, user_id, room_id, event_id):
 
-        spring_room = None
-        for key in self.rooms:
-            if self.rooms[key].get("room_id") == room_id:
-                spring_room = key
+        spring_room = self.rooms.channel_for(room_id)
+        if spring_room is None:
+            self.log.debug(f"Room {room_id} is not bridged")
+            return
+
+        identity = self.identities.lobby_identity(user_id)
+        if identity is None:
+            return
 
-        display_name = await self.appserv.intent.get_displayname(user_id=user_id)
-        user_domain = self.appserv.intent.user(user_id=user_id).domain
-        user_name = self.appserv.intent.user(user_id=user_id).localpart
+        user_domain, user_name = identity
 
         if event_id:
-            await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+            self.receipts.mark(room_id, event_id)
+
+        connection = self.connection_for(spring_room)
+        if connection is None:
+            return
 
-        self.bot.leave_from(spring_room, user_domain, display_name)
+        connection.membership.leave_from(spring_room, user_domain, user_name)
+        LOBBY_COMMANDS.inc("LEAVEFROM")
         self.log.debug(f"Matrix user {user_name} leaves {spring_room}")
 
     async def say_from_matrix(self, user_id, room_id, event_id, body, emote=False):
 
-        namespace = self.config['appservice.namespace']
-        if user_id.startswith(f"@{namespace}"):
+        identity = self.identities.lobby_identity(user_id)
+        if identity is None:
             return
 
-        room_name = list(v.get('name') for _, v in self.rooms.items() if v.get('room_id') == room_id)[0]
-
-        room_data = self.rooms.get(room_name)
-
-        channel = room_data.get('name')
-        stored_room_id = room_data.get('room_id')
-        enabled = room_data.get('enabled')
-
-        if enabled is False:
-            self.log.debug(f"room id: {stored_room_id} active: {enabled}")
+        channel = self.rooms.channel_for(room_id)
+        if channel is None:
+            self.log.debug(f"room id: {room_id} not bridged")
             return
 
-        user_name = self.appserv.intent.user(user_id=UserID(user_id)).localpart
-        domain = self.appserv.intent.user(user_id=UserID(user_id)).domain
+        domain, user_name = identity
 
-        if user_name.startswith("_discord"):
-            domain = "discord"
-            user_name = user_name.lstrip("_discord_")
-
-        elif user_name.startswith("freenode_"):
-            domain = "frenode.org"
-            user_name = user_name.lstrip("freenode_")
+        connection = self.connection_for(channel)
+        if connection is None:
+            return
 
         # if emote is True:
         #     self.bot.say_ex(user_name, domain, channel, body)
         # else:
-        self.bot.say_from(user_name, domain, channel, body)
+        # SAYFROM carries one line; longer and multi-line bodies are sent as several
+        limit = MAX_LINE_BYTES - len(f"SAYFROM {channel} {domain} {user_name} ".encode("utf-8"))
+        for line in split_message(body, limit):
+            if connection.accepted:
+                connection.chat.say_from(user_name, domain, channel, line)
+                LOBBY_COMMANDS.inc("SAYFROM")
+            else:
+                self.outbox.add(connection.name, channel, domain, user_name, line)
+
+        self.receipts.mark(room_id, event_id)
+
+    def resume(self, connection: LobbyConnection) -> None:
+        """
+        Send the chat held while ``connection`` was logged out, then let new chat through.
+
+        Held lines are queued behind the member sync, so their senders have joined the channel
+        first. New chat keeps going to the outbox until they are written; what it collected
+        meanwhile is sent next, ahead of anything newer.
+        """
+        session = connection.session
 
-        await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+        def say(view):
+            def send(entry: OutboxEntry) -> None:
+                view.say_from(entry.username, entry.domain, entry.channel, entry.body)
+                LOBBY_COMMANDS.inc("SAYFROM")
+            return send
+
+        def drained() -> None:
+            if connection.session != session:
+                return
+            self.outbox.replay(connection.name, say(connection.chat))
+            connection.accepted = True
+
+        self.outbox.replay(connection.name, say(connection.bulk))
+        connection.commands.call_after(BULK, drained)
 
     async def exit(self, signal_name):
         self.log.debug("Singal received exiting")
+        await asyncio.gather(*(connection.stop() for connection in self.connections.values()))
+        await self.outbound.stop()
+        await self.receipts.stop()
+        await self.presence.stop()
+        await self.outbox.stop()
         # await self.clean_matrix_rooms()
         # loop.stop()
         sys.exit(0)
 
     def login(self):
         pass
-
-    async def connect(self, server, port=8200, use_ssl=False, name=None, flags=None):
-        """
-        Connect to an SpringRTS Lobby server. Returns a proxy to an LobbyProtocol object.
-        """
-        protocol = None
-        while protocol is None:
-            try:
-                transport, protocol = await self.loop.create_connection(lambda: LobbyProtocol(self.bot_username,
-                                                                                              self.bot_password,
-                                                                                              self.client_name,
-                                                                                              self.client_flags
-                                                                                              ),
-                                                                        host=server,
-                                                                        port=port,
-                                                                        ssl=use_ssl)
-            except ConnectionRefusedError as conn_error:
-                self.log.info(f"HOST DOWN! retry in 10 secs {conn_error}")
-                await asyncio.sleep(10)
-
-        self.log.info("connected")
-        protocol.wrapper = LobbyProtocolWrapper(protocol)
-        protocol.server_info = {"host": server, "port": port, "ssl": use_ssl}
-        protocol.netid = f"{id(protocol)}:{server}:{port}{'+' if use_ssl else '-'}"
-
-        if name is not None:
-            protocol.name = name
-
-        if flags is not None:
-            protocol.flags = flags
-
-        asignal("netid-available").send(protocol)
-
-        connections[protocol.netid] = protocol.wrapper
-
-        return protocol.wrapper
-
-    async def reconnect(self, client_wrapper):
-        protocol = None
-        server_info = client_wrapper.server_info
-
-        self.log.info("reconnecting")
-        while protocol is None:
-            await asyncio.sleep(10)
-            try:
-                transport, protocol = await self.loop.create_connection(LobbyProtocol, **server_info)
-                client_wrapper.protocol = protocol
-
-                asignal("netid-available").send(protocol)
-
-                asignal("reconnected").send()
-
-            except ConnectionRefusedError as conn_error:
-                self.log.info(f"HOST DOWN! retry in 10 secs {conn_error}")
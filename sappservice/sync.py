@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from mautrix.appservice import AppService
+from mautrix.types import Membership, RoomID, UserID
+
+from sappservice.bridge_state import BridgeStateStore
+from sappservice.identity import IdentityMapper, LobbyIdentity, MAX_LENGTH
+from sappservice.membership import MembershipMirror
+from sappservice.metrics import LOBBY_COMMANDS
+from sappservice.profile_cache import ProfileCache
+from sappservice.rooms import DEFAULT_CONNECTION, BridgedRoom, RoomRegistry
+
+
+class SyncStats(NamedTuple):
+    rooms: int
+    users: int
+    requests: int
+    commands: int
+    elapsed: float
+
+
+class _SyncedUser(object):
+    __slots__ = ("user_id", "displayname", "channels")
+
+    def __init__(self, user_id: UserID, displayname: Optional[str]) -> None:
+        self.user_id = user_id
+        self.displayname = displayname
+        self.channels: List[str] = list()
+
+
+class MatrixUserSync(object):
+    """
+    Mirrors the Matrix members of every enabled room into the lobby.
+
+    Rooms that were synced before are read from the state cache, which the appservice keeps
+    current from ``m.room.member`` events, so a warm restart makes no homeserver requests for
+    them. Any other room costs one ``/joined_members`` request, which also carries the display
+    names. Users are deduplicated across rooms, so each is bridged once however many channels
+    they share. A new lobby session knows none of the bridged clients, so every run announces
+    everyone. The few remaining homeserver calls run concurrently, at most ``concurrency`` at a
+    time.
+
+    Without a ``store`` every room is fetched from the homeserver. With a ``mirror`` the
+    members read and the names announced are written back to it.
+    """
+
+    log: logging.Logger
+    appserv: AppService
+    rooms: RoomRegistry
+    profiles: ProfileCache
+    identities: IdentityMapper
+    store: Optional[BridgeStateStore]
+    mirror: Optional[MembershipMirror]
+
+    def __init__(self, appserv, rooms, profiles, identities, store: Optional[BridgeStateStore] = None,
+                 mirror: Optional[MembershipMirror] = None, concurrency: int = 8) -> None:
+        self.log = logging.getLogger("lobby.sync")
+        self.appserv = appserv
+        self.rooms = rooms
+        self.profiles = profiles
+        self.identities = identities
+        self.store = store
+        self.mirror = mirror
+        self.concurrency = max(1, concurrency)
+
+        self._requests = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _request(self, coro):
+        async with self._semaphore:
+            self._requests += 1
+            return await coro
+
+    async def _fetch_room(self, room: BridgedRoom) -> Dict[UserID, Optional[str]]:
+        async with self._semaphore:
+            # ensure_joined is answered from the state store when we are already in the room
+            if await self.appserv.intent.ensure_joined(room_id=room.room_id):
+                self._requests += 1
+
+        members = await self._request(self.appserv.intent.get_joined_members(room.room_id))
+
+        for user_id, member in members.items():
+            if member.membership is None:
+                member.membership = Membership.JOIN
+            if self.identities.lobby_identity(user_id) is not None:
+                await self.appserv.state_store.set_member(room.room_id, user_id, member)
+
+        return {user_id: member.displayname for user_id, member in members.items()}
+
+    async def _room_members(self, rooms: List[BridgedRoom]) -> Dict[RoomID, Dict[UserID, Optional[str]]]:
+        warm = await self.store.synced_rooms(room.room_id for room in rooms) if self.store else set()
+        members = await self.store.joined_members(warm) if warm else dict()
+
+        cold = [room for room in rooms if room.room_id not in warm]
+        results = await asyncio.gather(*(self._fetch_room(room) for room in cold), return_exceptions=True)
+
+        fetched, failed = list(), list()
+        for room, result in zip(cold, results):
+            if isinstance(result, Exception):
+                self.log.error(f"Failed to fetch members of {room.channel}: {result}")
+                failed.append(room.room_id)
+                continue
+            members[room.room_id] = result
+            fetched.append(room.room_id)
+
+        # whatever the state cache knows beats skipping the room
+        if self.store and failed:
+            members.update(await self.store.joined_members(failed))
+
+        if self.store and fetched:
+            await self.store.mark_synced(fetched)
+
+        self.log.debug(f"Members of {len(warm)} rooms read from the state cache, {len(fetched)} fetched")
+        return members
+
+    async def _fetch_displayname(self, user: _SyncedUser) -> None:
+        try:
+            user.displayname = await self._request(self.appserv.intent.get_displayname(user.user_id))
+            self.profiles.set(user.user_id, user.displayname)
+        except Exception as nf:
+            self.log.error(f"user {user.user_id} has no profile {nf}")
+
+    async def run(self, bot, connection: str = DEFAULT_CONNECTION) -> SyncStats:
+        """
+        Sync the rooms bridged through ``connection``, sending lobby commands to ``bot``.
+        """
+        self.log.debug(f"Sync matrix users of connection {connection}")
+
+        start = time.monotonic()
+        self._requests = 0
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        rooms = [room for room in self.rooms.enabled if room.connection == connection]
+        members = await self._room_members(rooms)
+
+        users: Dict[UserID, _SyncedUser] = dict()
+        for room in rooms:
+            for user_id, displayname in members.get(room.room_id, {}).items():
+                if self.identities.lobby_identity(user_id) is None:
+                    continue
+
+                if displayname:
+                    self.profiles.set(user_id, displayname)
+
+                user = users.get(user_id)
+                if user is None:
+                    user = users[user_id] = _SyncedUser(user_id, displayname)
+                elif not user.displayname:
+                    user.displayname = displayname
+                user.channels.append(room.channel)
+
+        missing = list()
+        for user in users.values():
+            if not user.displayname:
+                user.displayname = self.profiles.get(user.user_id)
+                if not user.displayname:
+                    missing.append(user)
+        if missing:
+            await asyncio.gather(*(self._fetch_displayname(user) for user in missing))
+
+        bridged: Dict[UserID, str] = dict()
+        joined: List[Tuple[str, str, str]] = list()
+        for user in users.values():
+            identity: LobbyIdentity = self.identities.lobby_identity(user.user_id)
+            bridged[user.user_id] = (user.displayname or identity.username)[:MAX_LENGTH]
+            joined.extend((channel, *identity) for channel in user.channels)
+        joined.sort()
+
+        self.log.debug("Start bridging users")
+
+        for user_id, displayname in bridged.items():
+            bot.bridged_client_from(*self.identities.lobby_identity(user_id), displayname)
+        for channel, domain, username in joined:
+            bot.join_from(channel, domain, username)
+        LOBBY_COMMANDS.inc("BRIDGECLIENTFROM", amount=len(bridged))
+        LOBBY_COMMANDS.inc("JOINFROM", amount=len(joined))
+
+        if self.mirror:
+            self.mirror.load(members, bridged, connection)
+
+        stats = SyncStats(rooms=len(rooms),
+                          users=len(users),
+                          requests=self._requests,
+                          commands=len(bridged) + len(joined),
+                          elapsed=time.monotonic() - start)
+
+        self.log.info(f"Synced {stats.users} matrix users in {stats.rooms} rooms "
+                      f"with {stats.requests} homeserver requests and {stats.commands} lobby commands "
+                      f"in {stats.elapsed:.2f}s")
+        return stats
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter.
+
+    The first delay is ``initial`` (a fast retry for short blips); every following one is drawn
+    uniformly from ``[0, min(maximum, initial * factor ** attempt)]`` so that many clients losing
+    the same server do not retry in lockstep. :meth:`reset` once the connection is healthy again.
+    """
+
+    def __init__(self, initial: float = 0.5, maximum: float = 60, factor: float = 2) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self) -> float:
+        attempt = self.attempts
+        self.attempts += 1
+        if attempt == 0:
+            return self.initial
+        return random.uniform(0, min(self.maximum, self.initial * self.factor ** attempt))
+
+    def reset(self) -> None:
+        self.attempts = 0
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from typing import Any
+
+
+class SampledLogger(object):
+    """
+    Debug logging for the per-event hot paths.
+
+    Callers ask :meth:`sample` once per event and only build log arguments when it returns
+    ``True``. That is a level check while DEBUG is off, and with ``sample_rate`` below 1 only one
+    in every ``1 / sample_rate`` events is formatted while it is on.
+
+    :meth:`log` appends ``key=value`` fields to the message and also passes them as
+    ``extra={"fields": ...}`` for structured handlers.
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate: float = 1.0) -> None:
+        self.logger = logger
+        self.every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self._count = 0
+
+    def sample(self) -> bool:
+        if not self.every or not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        if self.every == 1:
+            return True
+
+        self._count += 1
+        if self._count >= self.every:
+            self._count = 0
+            return True
+        return False
+
+    def log(self, msg: str, *args: Any, **fields: Any) -> None:
+        if fields:
+            msg = msg + "".join(f" {key}=%s" for key in fields)
+            args = args + tuple(fields.values())
+        self.logger.debug(msg, *args, extra={"fields": fields})
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Dict
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of startup. Phases may overlap; each one is logged when it finishes and
+    :meth:`report` logs the whole breakdown against the wall-clock total.
+    """
+
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+        self.started = time.monotonic()
+        self.phases: Dict[str, float] = OrderedDict()
+        self.reported = False
+
+    async def run(self, name: str, awaitable: Awaitable) -> Any:
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            elapsed = self.phases[name] = time.monotonic() - start
+            self.logger.debug(f"Startup phase {name} finished in {elapsed:.3f}s")
+
+    def report(self) -> None:
+        self.reported = True
+        total = time.monotonic() - self.started
+        phases = ", ".join(f"{name} {elapsed:.3f}s" for name, elapsed in self.phases.items())
+        self.logger.info(f"Startup took {total:.3f}s: {phases}")
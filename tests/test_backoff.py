@@ -0,0 +1,21 @@
+from sappservice.util.backoff import Backoff
+
+
+def test_first_retry_is_fast():
+    assert Backoff(initial=0.5, maximum=60).next() == 0.5
+
+
+def test_delays_grow_within_the_cap():
+    backoff = Backoff(initial=1, maximum=10)
+    backoff.next()
+    for attempt in range(1, 20):
+        assert 0 <= backoff.next() <= min(10, 2 ** attempt)
+
+
+def test_reset_starts_over():
+    backoff = Backoff(initial=0.5)
+    for _ in range(5):
+        backoff.next()
+    backoff.reset()
+    assert backoff.attempts == 0
+    assert backoff.next() == 0.5
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from sappservice import dedupe
+from sappservice.dedupe import RecentIds
+
+
+def test_seen_remembers_ids():
+    ids = RecentIds(max_size=10, ttl=60)
+    assert not ids.seen("$a")
+    assert ids.seen("$a")
+    assert "$a" in ids
+    assert "$b" not in ids
+
+
+def test_oldest_ids_are_evicted_past_max_size():
+    ids = RecentIds(max_size=2, ttl=60)
+    for key in ("$a", "$b", "$c"):
+        ids.add(key)
+    assert len(ids) == 2
+    assert "$a" not in ids
+    assert "$b" in ids and "$c" in ids
+
+
+def test_ids_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedupe.time, "monotonic", lambda: now[0])
+
+    ids = RecentIds(max_size=10, ttl=60)
+    ids.add("$a")
+    ids.add("$b", age=50)
+
+    now[0] += 30
+    assert "$a" in ids
+    assert "$b" not in ids
+
+    now[0] += 31
+    assert "$a" not in ids
+    assert len(ids) == 0
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_events_count_as_seen_once_handled(loop):
+    dedup = dedupe.Deduplicator(loop=loop)
+    assert not dedup.duplicate_event("$a")
+    # redelivered while the first delivery is still being handled
+    assert dedup.duplicate_event("$a")
+
+    dedup.event_handled("$a", succeeded=True)
+    assert dedup.duplicate_event("$a")
+
+
+def test_failed_events_are_handled_again(loop):
+    dedup = dedupe.Deduplicator(loop=loop)
+    assert not dedup.duplicate_event("$a")
+    dedup.event_handled("$a", succeeded=False)
+
+    assert not dedup.duplicate_event("$a")
+    assert "$a" not in dedup.events
+
+
+def test_only_handled_events_are_persisted(loop):
+    dedup = dedupe.Deduplicator(store=object(), loop=loop)
+    for event_id, succeeded in (("$a", True), ("$b", False)):
+        dedup.duplicate_event(event_id)
+        dedup.event_handled(event_id, succeeded)
+    assert [event_id for event_id, _ in dedup._pending] == ["$a"]
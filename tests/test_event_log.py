@@ -0,0 +1,34 @@
+import logging
+
+from sappservice.util.event_log import SampledLogger
+
+
+def logger(level=logging.DEBUG):
+    log = logging.getLogger("test.event_log")
+    log.setLevel(level)
+    return log
+
+
+def test_every_event_is_sampled_at_rate_one():
+    events = SampledLogger(logger(), sample_rate=1)
+    assert all(events.sample() for _ in range(10))
+
+
+def test_one_in_every_n_events_is_sampled():
+    events = SampledLogger(logger(), sample_rate=0.25)
+    assert [events.sample() for _ in range(8)] == [False, False, False, True] * 2
+
+
+def test_nothing_is_sampled_at_rate_zero_or_without_debug():
+    assert not any(SampledLogger(logger(), sample_rate=0).sample() for _ in range(10))
+    assert not any(SampledLogger(logger(logging.INFO), sample_rate=1).sample() for _ in range(10))
+
+
+def test_fields_are_appended_and_passed_as_extra(caplog):
+    events = SampledLogger(logger())
+    with caplog.at_level(logging.DEBUG, logger="test.event_log"):
+        events.log("Handled event %s", "$a", room="!main", latency_ms=1.5)
+
+    record = caplog.records[-1]
+    assert record.getMessage() == "Handled event $a room=!main latency_ms=1.5"
+    assert record.fields == {"room": "!main", "latency_ms": 1.5}
@@ -0,0 +1,53 @@
+from mautrix.client import ClientAPI
+
+from sappservice.identity import IdentityMapper, LobbyIdentity
+
+
+class FakeAppService(object):
+    intent = ClientAPI
+
+
+def mapper(**kwargs) -> IdentityMapper:
+    return IdentityMapper(FakeAppService(), domain="example.com", namespace="spring", bot_username="appservice",
+                          **kwargs)
+
+
+def test_plain_users_keep_their_homeserver_as_domain():
+    assert mapper().lobby_identity("@Alice:matrix.org") == LobbyIdentity("matrix.org", "alice")
+
+
+def test_domains_and_usernames_fit_the_lobby():
+    identity = mapper().lobby_identity("@someone_with_a_long_name:my-long-homeserver.example.org")
+    assert identity == LobbyIdentity("my_long_homeser", "someone_with_a_")
+
+
+def test_other_bridges_get_their_own_domain():
+    identities = mapper()
+    assert identities.lobby_identity("@_discord_1234:example.com") == LobbyIdentity("discord", "1234")
+    assert identities.lobby_identity("@freenode_bob:example.com") == LobbyIdentity("freenode.org", "bob")
+
+
+def test_own_users_and_ignored_users_are_not_bridged():
+    identities = mapper(ignored_users=["grumpy"])
+    assert identities.lobby_identity("@spring_alice:example.com") is None
+    assert identities.lobby_identity("@appservice:example.com") is None
+    assert identities.lobby_identity("@grumpy:matrix.org") is None
+    # same localparts on another homeserver are real users
+    assert identities.lobby_identity("@appservice:matrix.org") == LobbyIdentity("matrix.org", "appservice")
+
+
+def test_is_own():
+    identities = mapper()
+    assert identities.is_own("@spring_alice:example.com")
+    assert identities.is_own("@appservice:example.com")
+    assert not identities.is_own("@spring_alice:matrix.org")
+    assert not identities.is_own("@alice:example.com")
+
+
+def test_least_recently_used_lookups_are_dropped_first():
+    identities = mapper(max_size=2)
+    identities.lobby_identity("@a:x.org")
+    identities.lobby_identity("@b:x.org")
+    identities.lobby_identity("@a:x.org")
+    identities.lobby_identity("@c:x.org")
+    assert list(identities._identities) == ["@a:x.org", "@c:x.org"]
@@ -0,0 +1,98 @@
+import asyncio
+
+from sappservice.lobby_scheduler import BULK, CHAT, MEMBERSHIP, LobbyCommandScheduler, TokenBucket
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.commands = []
+
+    def __getattr__(self, command):
+        return lambda *args: self.commands.append((command,) + args)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_token_bucket_allows_bursts():
+    bucket = TokenBucket(rate=1, burst=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    assert 0 < bucket.delay() <= 1
+
+
+def test_token_bucket_without_rate_never_limits():
+    bucket = TokenBucket(rate=0, burst=1)
+    assert all(bucket.consume() for _ in range(100))
+    assert bucket.delay() == 0
+
+
+def test_scheduler_writes_immediately_when_idle():
+    async def scenario():
+        client = FakeClient()
+        scheduler = LobbyCommandScheduler(lambda: client, rate=0)
+        scheduler.view(CHAT).say_from("alice", "matrix.org", "main", "hi")
+        assert client.commands == [("say_from", "alice", "matrix.org", "main", "hi")]
+        await scheduler.stop()
+
+    run(scenario())
+
+
+def test_scheduler_sends_most_urgent_first():
+    async def scenario():
+        client = FakeClient()
+        scheduler = LobbyCommandScheduler(lambda: client, rate=1000, burst=1)
+        scheduler.view(BULK).bulk(0)
+        scheduler.view(BULK).bulk(1)
+        scheduler.view(MEMBERSHIP).membership(2)
+        scheduler.view(CHAT).chat(3)
+        scheduler.view(CHAT).chat(4)
+        while scheduler.depth:
+            await asyncio.sleep(0.005)
+        await scheduler.stop()
+        return client.commands
+
+    # the first command goes out at once, the rest wait for tokens
+    assert run(scenario()) == [("bulk", 0), ("chat", 3), ("chat", 4), ("membership", 2), ("bulk", 1)]
+
+
+def test_commands_without_a_client_are_dropped():
+    async def scenario():
+        scheduler = LobbyCommandScheduler(lambda: None, rate=0)
+        scheduler.view(MEMBERSHIP).join_from("main", "matrix.org", "alice")
+        await scheduler.stop()
+        return scheduler.stats()
+
+    stats = run(scenario())
+    assert stats["dropped"] == 1
+    assert stats["errors"] == 0
+
+
+def test_call_after_runs_once_earlier_commands_are_written():
+    async def scenario():
+        client = FakeClient()
+        scheduler = LobbyCommandScheduler(lambda: client, rate=1000, burst=1)
+        scheduler.view(BULK).bulk(0)
+        scheduler.view(BULK).bulk(1)
+        scheduler.call_after(BULK, lambda: client.commands.append("done"))
+        scheduler.view(BULK).bulk(2)
+        while scheduler.depth:
+            await asyncio.sleep(0.005)
+        await scheduler.stop()
+        return client.commands
+
+    assert run(scenario()) == [("bulk", 0), ("bulk", 1), "done", ("bulk", 2)]
+
+
+def test_call_after_on_an_empty_queue_runs_at_once():
+    async def scenario():
+        done = []
+        scheduler = LobbyCommandScheduler(lambda: FakeClient(), rate=0)
+        scheduler.call_after(CHAT, lambda: done.append(True))
+        return done
+
+    assert run(scenario()) == [True]
@@ -0,0 +1,84 @@
+import asyncio
+
+from sappservice.lobby_writer import CoalescingTransport, split_message
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def test_split_message_keeps_short_lines():
+    assert split_message("hello world", 100) == ["hello world"]
+
+
+def test_split_message_splits_newlines_and_drops_blank_lines():
+    assert split_message("first\n\n  \nsecond\r\nthird", 100) == ["first", "second", "third"]
+
+
+def test_split_message_breaks_at_spaces():
+    assert split_message("aaaa bbbb cccc dddd", 9) == ["aaaa bbbb", "cccc dddd"]
+
+
+def test_split_message_breaks_long_words():
+    assert split_message("x" * 12, 5) == ["xxxxx", "xxxxx", "xx"]
+
+
+def test_split_message_never_splits_characters():
+    lines = split_message("ééééé", 5)
+    assert lines == ["éé", "éé", "é"]
+    assert all(len(line.encode("utf-8")) <= 5 for line in lines)
+
+
+def test_split_message_keeps_indentation():
+    assert split_message("héllo wörld\n\n  second line  ", 8) == ["héllo", "wörld", "  second", "line"]
+    assert split_message("code:\n    indented\n\tTabbed", 100) == ["code:", "    indented", "\tTabbed"]
+
+
+def test_split_message_gives_oversized_characters_their_own_line():
+    assert split_message("ab 😀", 3) == ["ab", "😀"]
+    assert split_message("😀😀", 1) == ["😀", "😀"]
+
+
+def test_split_message_never_returns_empty_lines():
+    assert all(split_message("   a    b   \n\t\n c  ", 1))
+    assert split_message("", 10) == []
+
+
+def test_coalescing_transport_writes_once_per_loop_iteration():
+    loop = asyncio.new_event_loop()
+    try:
+        transport = FakeTransport()
+        coalescing = CoalescingTransport(transport, loop)
+        for line in (b"SAYFROM a\n", b"SAYFROM b\n", b"JOINFROM c\n"):
+            coalescing.write(line)
+        assert transport.written == []
+
+        loop.run_until_complete(asyncio.sleep(0))
+        assert transport.written == [b"SAYFROM a\nSAYFROM b\nJOINFROM c\n"]
+        assert (coalescing.writes, coalescing.flushes) == (3, 1)
+    finally:
+        loop.close()
+
+
+def test_coalescing_transport_flushes_on_close():
+    loop = asyncio.new_event_loop()
+    try:
+        transport = FakeTransport()
+        coalescing = CoalescingTransport(transport, loop)
+        coalescing.write(b"EXIT\n")
+        coalescing.close()
+        assert transport.written == [b"EXIT\n"]
+        assert transport.closed
+    finally:
+        loop.close()
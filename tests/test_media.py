@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from sappservice.media import MediaProxy, _CachedMedia, parse_mxc, short_id
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def proxy(loop, cache_dir, max_size=10):
+    media = MediaProxy(None, None, "https://example.com", "https://bridge.example.com", str(cache_dir), max_size,
+                       loop=loop)
+    media.fetched = []
+
+    async def fetch(key, mxc, thumbnail):
+        media.fetched.append(key)
+        await asyncio.sleep(0)
+        size = int(mxc.rsplit("/", 1)[1])
+        with open(media._path(key), "wb") as stream:
+            stream.write(b"x" * size)
+        with open(f"{media._path(key)}.meta", "w") as stream:
+            json.dump({"mxc": mxc, "content_type": "image/png"}, stream)
+        return _CachedMedia(size, "image/png")
+
+    media._fetch = fetch
+    media.start()
+    return media
+
+
+def test_short_ids_are_stable():
+    assert short_id("mxc://example.com/abc") == short_id("mxc://example.com/abc")
+    assert len(short_id("mxc://example.com/abc")) == 12
+    assert parse_mxc("mxc://example.com/abc") == ("example.com", "abc")
+    assert parse_mxc("https://example.com/abc") is None
+
+
+def test_cached_media_is_fetched_once(loop, tmp_path):
+    media = proxy(loop, tmp_path)
+    loop.run_until_complete(media._get("a", "mxc://example.com/4", False))
+    loop.run_until_complete(media._get("a", "mxc://example.com/4", False))
+
+    assert media.fetched == ["a"]
+    assert media.stats()["hits"] == 1 and media.stats()["misses"] == 1
+
+
+def test_concurrent_requests_share_one_download(loop, tmp_path):
+    media = proxy(loop, tmp_path)
+
+    async def requests():
+        return await asyncio.gather(*(media._get("a", "mxc://example.com/4", False) for _ in range(3)))
+
+    assert len(set(loop.run_until_complete(requests()))) == 1
+    assert media.fetched == ["a"]
+
+
+def test_least_recently_served_file_is_evicted(loop, tmp_path):
+    media = proxy(loop, tmp_path)
+    for key in ("a", "b"):
+        loop.run_until_complete(media._get(key, "mxc://example.com/4", False))
+    loop.run_until_complete(media._get("a", "mxc://example.com/4", False))
+    loop.run_until_complete(media._get("c", "mxc://example.com/4", False))
+    media._evict()
+
+    assert list(media._cache) == ["a", "c"]
+    assert not os.path.exists(tmp_path / "b") and not os.path.exists(tmp_path / "b.meta")
+    assert media.stats()["bytes"] == 8
+
+
+def test_files_being_served_are_not_evicted(loop, tmp_path):
+    media = proxy(loop, tmp_path)
+    media._pin("a")
+    loop.run_until_complete(media._get("a", "mxc://example.com/8", False))
+    loop.run_until_complete(media._get("b", "mxc://example.com/8", False))
+    media._evict()
+    assert list(media._cache) == ["a"]
+    media._unpin("a")
+
+    # a file larger than the whole cache is kept until it has been sent
+    media._pin("c")
+    loop.run_until_complete(media._get("c", "mxc://example.com/12", False))
+    media._evict()
+    assert "c" in media._cache
+    media._unpin("c")
+    assert "c" not in media._cache and not os.path.exists(tmp_path / "c")
+
+
+def test_start_indexes_files_of_a_previous_run(loop, tmp_path):
+    media = proxy(loop, tmp_path)
+    loop.run_until_complete(media._get("a", "mxc://example.com/4", False))
+    (tmp_path / "orphan").write_bytes(b"no meta")
+
+    media = proxy(loop, tmp_path)
+    assert list(media._cache) == ["a"]
+    assert not os.path.exists(tmp_path / "orphan")
@@ -0,0 +1,73 @@
+from sappservice.membership import MembershipMirror
+
+
+def test_matrix_membership_reports_transitions():
+    mirror = MembershipMirror()
+    assert mirror.matrix_joined("!room", "@alice:example.com")
+    assert not mirror.matrix_joined("!room", "@alice:example.com")
+    assert mirror.in_room("!room", "@alice:example.com")
+    assert mirror.rooms_of("@alice:example.com") == {"!room"}
+
+    assert mirror.matrix_left("!room", "@alice:example.com")
+    assert not mirror.matrix_left("!room", "@alice:example.com")
+    assert not mirror.joined_any("@alice:example.com")
+    assert mirror.stats()["matrix_users"] == 0
+
+
+def test_bridge_records_names_per_connection():
+    mirror = MembershipMirror()
+    assert mirror.bridge("@alice:example.com", "Alice")
+    assert not mirror.bridge("@alice:example.com", "Alice")
+    assert mirror.bridge("@alice:example.com", "Alicia")
+    assert mirror.bridge("@alice:example.com", "Alice", "other")
+
+    assert mirror.bridged_as("@alice:example.com") == "Alicia"
+    assert mirror.bridged_as("@alice:example.com", "other") == "Alice"
+    assert mirror.bridged_as("@bob:example.com") is None
+
+
+def test_unbridge_forgets_one_connection():
+    mirror = MembershipMirror()
+    mirror.bridge("@alice:example.com", "Alice")
+    mirror.bridge("@alice:example.com", "Alice", "other")
+    mirror.bridge("@bob:example.com", "Bob")
+    mirror.matrix_joined("!room", "@bob:example.com")
+
+    mirror.unbridge()
+
+    assert mirror.bridged_as("@alice:example.com") is None
+    assert mirror.bridged_as("@alice:example.com", "other") == "Alice"
+    assert mirror.in_room("!room", "@bob:example.com")
+    # a new session announces the user again
+    assert mirror.bridge("@bob:example.com", "Bob")
+
+
+def test_load_replaces_the_rooms_it_covers():
+    mirror = MembershipMirror()
+    mirror.matrix_joined("!a", "@alice:example.com")
+    mirror.matrix_joined("!b", "@alice:example.com")
+
+    mirror.load({"!a": ["@bob:example.com"]}, {"@bob:example.com": "Bob"})
+
+    assert not mirror.in_room("!a", "@alice:example.com")
+    assert mirror.in_room("!b", "@alice:example.com")
+    assert mirror.in_room("!a", "@bob:example.com")
+    assert mirror.bridged_as("@bob:example.com") == "Bob"
+
+
+def test_lobby_membership():
+    mirror = MembershipMirror()
+    assert mirror.lobby_joined("main", ["alice", "bob"]) == ["alice", "bob"]
+    assert mirror.lobby_joined("main", ["bob", "carol"]) == ["carol"]
+    assert mirror.in_channel("main", "carol")
+
+    assert mirror.lobby_left("main", "carol")
+    assert not mirror.lobby_left("main", "carol")
+
+    mirror.lobby_joined("dev", ["alice"])
+    mirror.lobby_reset(["main"])
+    assert not mirror.in_channel("main", "alice")
+    assert mirror.in_channel("dev", "alice")
+
+    mirror.lobby_reset()
+    assert mirror.stats()["lobby_users"] == 0
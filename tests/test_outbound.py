@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from sappservice.outbound import OutboundScheduler
+
+
+class FakePuppet(object):
+    def __init__(self, username, sent):
+        self.mxid = f"@spring_{username}:example.com"
+        self.username = username
+        self.sent = sent
+
+    async def send_text(self, room_id, text):
+        self.sent.append((room_id, self.username, text))
+
+    async def send_emote(self, room_id, text):
+        self.sent.append((room_id, self.username, f"* {text}"))
+
+
+class FakeIdentities(object):
+    def __init__(self):
+        self.sent = []
+
+    def puppet(self, username):
+        return FakePuppet(username, self.sent)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def drain(loop, outbound, delay=0.05):
+    loop.run_until_complete(asyncio.sleep(delay))
+    loop.run_until_complete(outbound.stop())
+
+
+def test_messages_beyond_max_depth_are_dropped(loop):
+    outbound = OutboundScheduler(FakeIdentities(), max_depth=2, loop=loop)
+    results = [outbound.send("!main:example.com", "alice", str(n)) for n in range(3)]
+    # a second room has its own queue
+    assert outbound.send("!dev:example.com", "alice", "other room")
+    drain(loop, outbound)
+
+    assert results == [True, True, False]
+    assert outbound.stats()["dropped"] == 1
+    assert [text for room_id, _, text in outbound.identities.sent if room_id == "!main:example.com"] == ["0", "1"]
+
+
+def test_lines_within_the_merge_window_are_sent_as_one(loop):
+    outbound = OutboundScheduler(FakeIdentities(), merge_window=0.02, loop=loop)
+    for text in ("one", "two", "three"):
+        outbound.send("!main:example.com", "alice", text)
+    drain(loop, outbound)
+
+    assert outbound.identities.sent == [("!main:example.com", "alice", "one\ntwo\nthree")]
+    assert outbound.stats()["merged"] == 2
+
+
+def test_merging_stops_at_another_user_or_an_emote(loop):
+    outbound = OutboundScheduler(FakeIdentities(), merge_window=0.02, loop=loop)
+    outbound.send("!main:example.com", "alice", "one")
+    outbound.send("!main:example.com", "alice", "two")
+    outbound.send("!main:example.com", "bob", "three")
+    outbound.send("!main:example.com", "bob", "waves", emote=True)
+    outbound.send("!main:example.com", "bob", "four")
+    drain(loop, outbound)
+
+    assert [text for _, _, text in outbound.identities.sent] == ["one\ntwo", "three", "* waves", "four"]
+
+
+def test_without_a_merge_window_every_line_is_its_own_event(loop):
+    outbound = OutboundScheduler(FakeIdentities(), loop=loop)
+    for text in ("one", "two"):
+        outbound.send("!main:example.com", "alice", text)
+    drain(loop, outbound)
+
+    assert [text for _, _, text in outbound.identities.sent] == ["one", "two"]
+    assert outbound.stats()["merged"] == 0
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+
+from sappservice.lobby_scheduler import BULK, CHAT, LobbyCommandScheduler
+from sappservice.outbox import LobbyOutbox
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.lines = []
+
+    def say_from(self, username, domain, channel, body):
+        self.lines.append(body)
+
+    def join_from(self, channel, domain, username):
+        self.lines.append(f"JOIN {username}")
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_replay_is_in_order_and_forgets_the_lines(loop):
+    outbox = LobbyOutbox(loop=loop)
+    for body in ("one", "two", "three"):
+        outbox.add("default", "main", "matrix.org", "alice", body)
+    outbox.add("other", "dev", "matrix.org", "bob", "elsewhere")
+
+    sent = []
+    assert outbox.replay("default", lambda entry: sent.append(entry.body)) == 3
+    assert sent == ["one", "two", "three"]
+    assert outbox.replay("default", lambda entry: sent.append(entry.body)) == 0
+    assert len(outbox) == 1
+
+
+def test_oldest_lines_are_dropped_when_full(loop):
+    outbox = LobbyOutbox(max_size=2, loop=loop)
+    for body in ("one", "two", "three"):
+        outbox.add("default", "main", "matrix.org", "alice", body)
+
+    sent = []
+    outbox.replay("default", lambda entry: sent.append(entry.body))
+    assert sent == ["two", "three"]
+    assert outbox.stats()["dropped_full"] == 1
+
+
+def test_stale_lines_are_not_replayed(loop):
+    outbox = LobbyOutbox(max_age=60, loop=loop)
+    outbox.add("default", "main", "matrix.org", "alice", "old")
+    outbox.add("default", "main", "matrix.org", "alice", "new")
+    queue = outbox._queues["default"]
+    queue[0] = queue[0]._replace(queued_at=time.time() - 120)
+
+    sent = []
+    outbox.replay("default", lambda entry: sent.append(entry.body))
+    assert sent == ["new"]
+    assert outbox.stats()["dropped_stale"] == 1
+
+
+def test_held_chat_stays_ahead_of_new_chat():
+    # how SpringLobbyClient.resume hands held lines to a connection that logged in again
+    async def scenario():
+        client = FakeClient()
+        scheduler = LobbyCommandScheduler(lambda: client, rate=1000, burst=1)
+        chat, bulk = scheduler.view(CHAT), scheduler.view(BULK)
+        outbox = LobbyOutbox()
+        accepted = [False]
+
+        def say(body):
+            if accepted[0]:
+                chat.say_from("alice", "matrix.org", "main", body)
+            else:
+                outbox.add("default", "main", "matrix.org", "alice", body)
+
+        say("held1")
+        say("held2")
+        # the member sync after login
+        for username in ("alice", "bob"):
+            bulk.join_from("main", "matrix.org", username)
+
+        def drained():
+            outbox.replay("default", lambda entry: chat.say_from(entry.username, entry.domain, entry.channel,
+                                                                 entry.body))
+            accepted[0] = True
+
+        outbox.replay("default", lambda entry: bulk.say_from(entry.username, entry.domain, entry.channel,
+                                                             entry.body))
+        scheduler.call_after(BULK, drained)
+
+        say("new1")
+        await asyncio.sleep(0)
+        say("new2")
+        while scheduler.depth or not accepted[0]:
+            await asyncio.sleep(0.005)
+        say("new3")
+        while scheduler.depth:
+            await asyncio.sleep(0.005)
+        await scheduler.stop()
+        return client.lines
+
+    loop = asyncio.new_event_loop()
+    try:
+        lines = loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+    assert lines == ["JOIN alice", "JOIN bob", "held1", "held2", "new1", "new2", "new3"]
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from mautrix.types import PresenceState
+
+from sappservice.membership import MembershipMirror
+from sappservice.presence import PresenceEngine
+
+
+class FakePuppet(object):
+    def __init__(self, mxid, sent):
+        self.mxid = mxid
+        self.sent = sent
+
+    async def set_presence(self, presence, status, ignore_cache=False):
+        self.sent.append((self.mxid, presence))
+
+
+class FakeIdentities(object):
+    def __init__(self):
+        self.sent = []
+
+    def puppet_id(self, username):
+        return f"@spring_{username}:example.com"
+
+    def puppet(self, username):
+        return FakePuppet(self.puppet_id(username), self.sent)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def engine(loop, *bridged):
+    mirror = MembershipMirror()
+    for username in bridged:
+        mirror.matrix_joined("!main:example.com", f"@spring_{username}:example.com")
+    return PresenceEngine(FakeIdentities(), mirror, flap_window=0, slots=1, loop=loop)
+
+
+def test_only_users_with_a_bridged_puppet_are_tracked(loop):
+    presence = engine(loop, "alice")
+    presence.online("alice")
+    presence.online("bob")
+    assert presence.stats()["online"] == 1
+
+    presence.mirror.matrix_joined("!main:example.com", "@spring_bob:example.com")
+    presence.joined("bob")
+    assert presence.stats()["online"] == 2
+
+
+def test_joined_keeps_a_known_status(loop):
+    presence = engine(loop, "alice")
+    presence.status("alice", 2)
+    presence.joined("alice")
+    loop.run_until_complete(presence.tick())
+    assert presence.identities.sent == [("@spring_alice:example.com", PresenceState.UNAVAILABLE)]
+
+
+def test_removeuser_before_anything_was_sent_forgets_right_away(loop):
+    presence = engine(loop, "alice")
+    presence.online("alice")
+    presence.offline("alice")
+    assert presence.stats()["online"] == 0 and presence.stats()["pending"] == 0
+    loop.run_until_complete(presence.tick())
+    assert presence.identities.sent == []
+
+
+def test_removeuser_sends_offline_then_forgets(loop):
+    presence = engine(loop, "alice")
+    presence.online("alice")
+    loop.run_until_complete(presence.tick())
+    presence.offline("alice")
+    loop.run_until_complete(presence.tick())
+
+    assert presence.identities.sent == [("@spring_alice:example.com", PresenceState.ONLINE),
+                                        ("@spring_alice:example.com", PresenceState.OFFLINE)]
+    assert presence.stats()["online"] == 0
+    # forgotten, so a second REMOVEUSER sends nothing
+    presence.offline("alice")
+    assert presence.stats()["pending"] == 0
@@ -0,0 +1,58 @@
+import asyncio
+
+from sappservice import profile_cache
+from sappservice.profile_cache import ProfileCache
+
+
+class FakeIntent(object):
+    def __init__(self):
+        self.requests = 0
+
+    async def get_displayname(self, user_id):
+        self.requests += 1
+        return user_id[1:].split(":")[0].title()
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(profile_cache.time, "monotonic", lambda: now[0])
+
+    cache = ProfileCache(ttl=60)
+    cache.set("@alice:matrix.org", "Alice")
+    now[0] += 59
+    assert cache.get("@alice:matrix.org") == "Alice"
+
+    now[0] += 2
+    assert cache.get("@alice:matrix.org", "gone") == "gone"
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ProfileCache(max_size=2)
+    cache.set("@a:x.org", "A")
+    cache.set("@b:x.org", "B")
+    cache.get("@a:x.org")
+    cache.set("@c:x.org", "C")
+
+    assert cache.get("@b:x.org") is None
+    assert cache.get("@a:x.org") == "A" and cache.get("@c:x.org") == "C"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_missing_names_are_cached_too():
+    cache = ProfileCache()
+    cache.set("@a:x.org", None)
+    assert cache.get("@a:x.org", "default") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_homeserver_is_only_asked_on_a_miss():
+    cache = ProfileCache()
+    intent = FakeIntent()
+    loop = asyncio.new_event_loop()
+    try:
+        for _ in range(3):
+            assert loop.run_until_complete(cache.get_displayname(intent, "@alice:matrix.org")) == "Alice"
+    finally:
+        loop.close()
+    assert intent.requests == 1
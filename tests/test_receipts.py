@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from sappservice.receipts import ReceiptCoalescer
+
+
+class FakeIntent(object):
+    def __init__(self):
+        self.read = []
+
+    async def mark_read(self, room_id, event_id):
+        self.read.append((room_id, event_id))
+
+
+class FakeAppService(object):
+    def __init__(self):
+        self.intent = FakeIntent()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_only_the_latest_event_of_each_room_is_sent(loop):
+    appserv = FakeAppService()
+    receipts = ReceiptCoalescer(appserv, loop=loop)
+    for room_id, event_id in (("!main", "$1"), ("!dev", "$2"), ("!main", "$3"), ("!main", "$4")):
+        receipts.mark(room_id, event_id)
+    loop.run_until_complete(receipts.flush())
+
+    assert sorted(appserv.intent.read) == [("!dev", "$2"), ("!main", "$4")]
+    assert receipts.sent == 2 and receipts.coalesced == 2
+
+    loop.run_until_complete(receipts.flush())
+    assert receipts.sent == 2
+
+
+def test_stop_flushes_pending_receipts(loop):
+    appserv = FakeAppService()
+    receipts = ReceiptCoalescer(appserv, interval=3600, loop=loop)
+    receipts.start()
+    receipts.mark("!main", "$1")
+    loop.run_until_complete(receipts.stop())
+
+    assert appserv.intent.read == [("!main", "$1")]
@@ -0,0 +1,154 @@
+import asyncio
+
+from mautrix.client import ClientAPI
+from mautrix.types import Member
+
+from sappservice.identity import IdentityMapper
+from sappservice.membership import MembershipMirror
+from sappservice.profile_cache import ProfileCache
+from sappservice.rooms import RoomRegistry
+from sappservice.sync import MatrixUserSync
+
+
+class FakeStateStore(object):
+    def __init__(self):
+        self.members = []
+
+    async def set_member(self, room_id, user_id, member):
+        self.members.append((room_id, user_id))
+
+
+class FakeIntent(object):
+    parse_user_id = ClientAPI.parse_user_id
+
+    def __init__(self, members, displaynames=None):
+        self.members = members
+        self.displaynames = displaynames or {}
+        self.fetched = []
+
+    async def ensure_joined(self, room_id):
+        return False
+
+    async def get_joined_members(self, room_id):
+        self.fetched.append(room_id)
+        if room_id not in self.members:
+            raise Exception("not in room")
+        return {user_id: Member(displayname=displayname) for user_id, displayname in self.members[room_id].items()}
+
+    async def get_displayname(self, user_id):
+        self.fetched.append(user_id)
+        return self.displaynames.get(user_id)
+
+
+class FakeAppService(object):
+    def __init__(self, intent):
+        self.intent = intent
+        self.state_store = FakeStateStore()
+
+
+class FakeStore(object):
+    """
+    The warm half of the bridge state: rooms synced before and the state cache behind them.
+    """
+
+    def __init__(self, synced=(), cached=None):
+        self.synced = set(synced)
+        self.cached = cached or {}
+
+    async def synced_rooms(self, room_ids):
+        return {room_id for room_id in room_ids if room_id in self.synced}
+
+    async def mark_synced(self, room_ids):
+        self.synced.update(room_ids)
+
+    async def joined_members(self, room_ids):
+        return {room_id: dict(self.cached[room_id]) for room_id in room_ids if room_id in self.cached}
+
+
+class FakeBot(object):
+    def __init__(self):
+        self.commands = []
+
+    def bridged_client_from(self, domain, username, displayname):
+        self.commands.append(("BRIDGECLIENTFROM", domain, username, displayname))
+
+    def join_from(self, channel, domain, username):
+        self.commands.append(("JOINFROM", channel, domain, username))
+
+
+ROOMS = RoomRegistry({"main": {"room_id": "!main:example.com", "enabled": True},
+                      "dev": {"room_id": "!dev:example.com", "enabled": True},
+                      "off": {"room_id": "!off:example.com", "enabled": False}})
+
+
+def user_sync(intent, store=None, mirror=None):
+    appserv = FakeAppService(intent)
+    identities = IdentityMapper(appserv, domain="example.com", namespace="spring", bot_username="appservice")
+    return MatrixUserSync(appserv, ROOMS, ProfileCache(), identities, store=store, mirror=mirror)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_cold_rooms_are_fetched_and_marked_synced():
+    intent = FakeIntent({"!main:example.com": {"@alice:matrix.org": "Alice", "@appservice:example.com": None},
+                         "!dev:example.com": {"@bob:matrix.org": "Bob"}})
+    store = FakeStore()
+    stats = run(user_sync(intent, store).run(FakeBot()))
+
+    assert sorted(intent.fetched) == ["!dev:example.com", "!main:example.com"]
+    assert store.synced == {"!main:example.com", "!dev:example.com"}
+    assert stats.rooms == 2 and stats.users == 2 and stats.requests == 2
+
+
+def test_warm_rooms_are_read_from_the_state_cache():
+    intent = FakeIntent({"!dev:example.com": {"@bob:matrix.org": "Bob"}})
+    store = FakeStore(synced={"!main:example.com"}, cached={"!main:example.com": {"@alice:matrix.org": "Alice"}})
+    bot = FakeBot()
+    stats = run(user_sync(intent, store).run(bot))
+
+    assert intent.fetched == ["!dev:example.com"]
+    assert stats.requests == 1
+    assert ("JOINFROM", "main", "matrix.org", "alice") in bot.commands
+
+
+def test_failed_cold_rooms_fall_back_to_the_state_cache():
+    intent = FakeIntent({"!main:example.com": {"@alice:matrix.org": "Alice"}})
+    store = FakeStore(cached={"!dev:example.com": {"@bob:matrix.org": "Bob"}})
+    bot = FakeBot()
+    run(user_sync(intent, store).run(bot))
+
+    assert ("JOINFROM", "dev", "matrix.org", "bob") in bot.commands
+    assert "!dev:example.com" not in store.synced
+
+
+def test_users_are_bridged_once_and_join_every_channel():
+    intent = FakeIntent({"!main:example.com": {"@alice:matrix.org": "Alice", "@bob:matrix.org": None},
+                         "!dev:example.com": {"@alice:matrix.org": "Alice",
+                                              "@spring_somebody:example.com": "Puppet"}},
+                        displaynames={"@bob:matrix.org": "Bobby"})
+    bot = FakeBot()
+    stats = run(user_sync(intent).run(bot))
+
+    assert sorted(bot.commands) == [("BRIDGECLIENTFROM", "matrix.org", "alice", "Alice"),
+                                    ("BRIDGECLIENTFROM", "matrix.org", "bob", "Bobby"),
+                                    ("JOINFROM", "dev", "matrix.org", "alice"),
+                                    ("JOINFROM", "main", "matrix.org", "alice"),
+                                    ("JOINFROM", "main", "matrix.org", "bob")]
+    # every client is announced before it joins a channel
+    assert [command[0] for command in bot.commands] == ["BRIDGECLIENTFROM"] * 2 + ["JOINFROM"] * 3
+    assert stats.commands == 5
+
+
+def test_the_mirror_learns_members_and_bridged_names():
+    intent = FakeIntent({"!main:example.com": {"@alice:matrix.org": "Alice"}, "!dev:example.com": {}})
+    mirror = MembershipMirror()
+    run(user_sync(intent, mirror=mirror).run(FakeBot()))
+
+    assert mirror.in_room("!main:example.com", "@alice:matrix.org")
+    assert mirror.bridged_as("@alice:matrix.org") == "Alice"